@@ -1,6 +1,9 @@
 # actions.py
+import os
+import numpy as np
 from PIL import Image
 import blend_functions
+from layer_cache import LayerCache, gamma_lut, opacity_lut
 
 def apply_opacity(image, opacity=1.0):
     """
@@ -14,20 +17,111 @@ def apply_opacity(image, opacity=1.0):
     image.putalpha(a)
     return image
 
-# Register actions in a dictionary.
-# Blend functions require a base image (passed during processing), so their signature is different.
-ACTIONS = {
-    "apply_opacity": apply_opacity,
-    "blend_normal": blend_functions.blend_normal,
-    "blend_screen": blend_functions.blend_screen,
-    "blend_multiply": blend_functions.blend_multiply
-}
+# ---------------- Array Actions ----------------
+# Array actions take and return an H x W x 4 uint8 RGBA array and may work in place,
+# so a chain of them runs on one buffer with no PIL <-> NumPy conversions in between.
+
+def apply_opacity_array(arr, opacity=1.0):
+    """Array version of apply_opacity: scales the alpha channel in place (same rounding and clipping)."""
+    arr[..., 3] = opacity_lut(float(opacity))[arr[..., 3]]
+    return arr
+
+def adjust_gamma_array(arr, gamma=1.0):
+    """Applies the composer's gamma curve to all four channels in place."""
+    gamma = float(gamma)
+    if gamma != 1.0:
+        np.take(gamma_lut(gamma), arr, out=arr)
+    return arr
+
+def flip_array(arr, direction="horizontal"):
+    """Mirrors the image horizontally or vertically (returns a view, no copy)."""
+    if direction.lower() == "vertical":
+        return arr[::-1]
+    return arr[:, ::-1]
+
+def _wrap_slices(offset, size):
+    """(destination, source) slice pairs that shift one axis by offset (0 <= offset < size) with wraparound."""
+    if not offset:
+        return [(slice(None), slice(None))]
+    return [(slice(offset, None), slice(None, size - offset)), (slice(None, offset), slice(size - offset, None))]
+
+def roll_array(arr, x_offset=0, y_offset=0, out=None):
+    """
+    Wraparound shift, like the composer's roll transformation. A shift cannot be done in place,
+    so it is written into out (a same-shaped spare buffer from process_layer), one slice
+    assignment per wrapped block; returns arr itself when both offsets wrap to 0.
+    """
+    height, width = arr.shape[:2]
+    dy, dx = int(y_offset) % height, int(x_offset) % width
+    if not dx and not dy:
+        return arr
+    if out is None:
+        out = np.empty_like(arr)
+    for dst_y, src_y in _wrap_slices(dy, height):
+        for dst_x, src_x in _wrap_slices(dx, width):
+            out[dst_y, dst_x] = arr[src_y, src_x]
+    return out
+
+# ---------------- Registry ----------------
+# ACTIONS maps a name to its function; ACTION_SPECS records what each one works on:
+#   kind  - "array" (uint8 RGBA array in, array out) or "pil" (PIL image in, image out)
+#   blend - True if the action also takes the base image (passed during processing)
+#   out   - True if an array action writes into a spare buffer passed as out= instead of in place
+ACTIONS = {}
+ACTION_SPECS = {}
+
+def register_action(name, func, kind="pil", blend=False, out=False):
+    """Registers (or replaces) an action for process_layer."""
+    if kind not in ("pil", "array"):
+        raise ValueError(f"Action kind must be 'pil' or 'array', not '{kind}'.")
+    if out and kind != "array":
+        raise ValueError("Only array actions can take an out buffer.")
+    ACTIONS[name] = func
+    ACTION_SPECS[name] = {"kind": kind, "blend": blend, "out": out}
+
+register_action("apply_opacity", apply_opacity_array, kind="array")
+register_action("adjust_gamma", adjust_gamma_array, kind="array")
+register_action("flip", flip_array, kind="array")
+register_action("roll", roll_array, kind="array", out=True)
+register_action("blend_normal", blend_functions.blend_normal, blend=True)
+register_action("blend_screen", blend_functions.blend_screen, blend=True)
+register_action("blend_multiply", blend_functions.blend_multiply, blend=True)
+register_action("blend_overlay", blend_functions.blend_overlay, blend=True)
+register_action("blend_soft_light", blend_functions.blend_soft_light, blend=True)
+register_action("blend_lighten", blend_functions.blend_lighten, blend=True)
+register_action("blend_darken", blend_functions.blend_darken, blend=True)
+register_action("blend_difference", blend_functions.blend_difference, blend=True)
+
+# ---------------- Source Cache ----------------
+SOURCE_CACHE_MB = 512
+
+# Decoded RGBA sources, kept across compose runs. Entries are read-only arrays keyed by
+# (path, mtime, size), so an edited file is decoded again.
+_source_cache = LayerCache(SOURCE_CACHE_MB * 1024 * 1024)
+
+def get_source_cache():
+    return _source_cache
+
+def load_source(path):
+    """Returns the decoded RGBA pixels of path as a read-only array, from the cache when unchanged."""
+    st = os.stat(path)
+    cache_key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    arr = _source_cache.get(cache_key)
+    if arr is None:
+        arr = np.array(Image.open(path).convert("RGBA"))
+        arr.flags.writeable = False
+        _source_cache.put(cache_key, arr, arr.nbytes)
+    return arr
+
+def load_source_image(path):
+    """Like load_source, as a new PIL image the caller may modify."""
+    return Image.fromarray(load_source(path).copy(), mode="RGBA")
 
 def process_layer(layer_config, base_image=None):
     """
     Processes a layer image based on a configuration dictionary.
     The layer configuration should be a dictionary like:
-    
+
         {
            "source": "path/to/layer_image.png",
            "actions": [
@@ -35,19 +129,47 @@ def process_layer(layer_config, base_image=None):
                {"name": "blend_screen", "params": {}}
            ]
         }
-    
-    For blend actions (those whose name starts with "blend") the base_image is passed to the action function.
+
+    For blend actions the base_image is passed to the action function.
+    The source is decoded once and cached across calls. Consecutive array actions share one
+    buffer, plus a spare that out= actions write into and swap with; the layer is converted
+    between array and PIL image only where the action kind changes.
     """
-    image = Image.open(layer_config["source"]).convert("RGBA")
+    steps = []
     for act in layer_config.get("actions", []):
         action_name = act["name"]
-        params = act.get("params", {})
-        func = ACTIONS.get(action_name)
-        if func is None:
+        if action_name not in ACTIONS:
             raise ValueError(f"Action '{action_name}' not registered.")
+        steps.append((ACTIONS[action_name], ACTION_SPECS[action_name], act.get("params", {})))
+
+    # The cached source is read-only, so the layer starts from a private copy.
+    image = load_source(layer_config["source"]).copy()
+    spare = None
+    for func, spec, params in steps:
+        if spec["kind"] == "array":
+            if isinstance(image, Image.Image):
+                image = np.array(image.convert("RGBA"))
+            if not spec["out"]:
+                image = func(image, **params)
+                continue
+            if spare is None or spare.shape != image.shape:
+                spare = np.empty_like(image)
+            result = func(image, out=spare, **params)
+            if result is spare:
+                # The old buffer (image, or the array a flipped view looks into) becomes the next spare.
+                owner = image if image.base is None else image.base
+                reusable = (isinstance(owner, np.ndarray) and owner.shape == image.shape
+                            and owner.dtype == image.dtype and owner.flags.writeable)
+                spare = owner if reusable else None
+            image = result
+            continue
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(np.ascontiguousarray(image), mode="RGBA")
         # If the action is a blend action and a base image is provided, then call it with both images.
-        if action_name.startswith("blend") and base_image is not None:
+        if spec["blend"] and base_image is not None:
             image = func(base_image, image, **params)
         else:
             image = func(image, **params)
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(np.ascontiguousarray(image), mode="RGBA")
     return image
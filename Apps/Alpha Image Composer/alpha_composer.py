@@ -1,146 +1,17 @@
 import os
 import json
 import threading
+import multiprocessing
+import time
+from collections import deque
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import tkinter.scrolledtext as scrolledtext
-from PIL import Image, ImageChops
-import numpy as np
+from composer_engine import BLEND_MODES, DETAIL, INFO, PNG_STRATEGIES, run_composite, validate_layers_config
 
 # ---------------- Global Stop Event ----------------
 stop_event = threading.Event()
 
-# ---------------- Helper Functions ----------------
-
-def set_opacity(im, opacity):
-    """Applies an opacity factor to an RGBA image."""
-    if im.mode != 'RGBA':
-        im = im.convert('RGBA')
-    r, g, b, a = im.split()
-    a = a.point(lambda p: int(p * opacity))
-    im.putalpha(a)
-    return im
-
-def adjust_gamma(im, gamma):
-    """Adjusts the gamma of the image."""
-    if gamma == 1.0:
-        return im
-    arr = np.array(im).astype(np.float32)/255.0
-    invGamma = 1.0/gamma
-    adjusted = np.power(arr, invGamma)
-    adjusted = np.clip(adjusted*255, 0, 255).astype(np.uint8)
-    return Image.fromarray(adjusted, mode="RGBA")
-
-def apply_transformations(im, transformations):
-    """
-    Applies a list of transformation dictionaries to an image.
-    Each dict should have keys:
-       - "match": transformation only applies if this equals (case-insensitively) the layer name.
-       - "action": one of "rotate", "flip", "roll"
-       - "params": a dict of parameters (collected from the UI fields).
-    Transformations are applied in order.
-    """
-    for t in transformations:
-        action = t.get("action", "").lower()
-        params = t.get("params", {})
-        if action == "rotate":
-            angle = float(params.get("angle", 0))
-            im = im.rotate(angle, expand=False)
-        elif action == "flip":
-            direction = params.get("direction", "horizontal").lower()
-            if direction == "horizontal":
-                im = im.transpose(Image.FLIP_LEFT_RIGHT)
-            elif direction == "vertical":
-                im = im.transpose(Image.FLIP_TOP_BOTTOM)
-        elif action == "roll":
-            x_offset = int(params.get("x_offset", 0))
-            y_offset = int(params.get("y_offset", 0))
-            arr = np.array(im)
-            arr = np.roll(arr, shift=x_offset, axis=1)
-            arr = np.roll(arr, shift=y_offset, axis=0)
-            im = Image.fromarray(arr, mode="RGBA")
-    return im
-
-# (Remaining helper functions remain unchanged: build_exact_dict, build_mapping, etc.)
-
-def build_exact_dict(folder, constant):
-    d = {}
-    constant = constant.lower()
-    for root_dir, dirs, files in os.walk(folder):
-        for file in files:
-            if file.lower().endswith((".jpg", ".jpeg", ".png")):
-                base, _ = os.path.splitext(file)
-                base_lower = base.lower()
-                if constant and base_lower.endswith(constant):
-                    key = base_lower[:-len(constant)]
-                    d[key] = os.path.join(root_dir, file)
-    return d
-
-def build_mapping(folder, constant):
-    mapping = {}
-    constant = constant.lower()
-    for root, dirs, files in os.walk(folder):
-        for file in files:
-            if file.lower().endswith((".jpg", ".jpeg", ".png")):
-                base, _ = os.path.splitext(file)
-                base_lower = base.lower()
-                if constant and base_lower.endswith(constant):
-                    key = base_lower[:-len(constant)]
-                else:
-                    key = base_lower
-                mapping[key] = os.path.join(root, file)
-    return mapping
-
-def find_best_match(parent_key, mapping):
-    best_path = None
-    best_length = 0
-    for key, path in mapping.items():
-        if key in parent_key and len(key)>best_length:
-            best_path = path
-            best_length = len(key)
-    return best_path
-
-def apply_alpha_override(main_image, alpha_image, opacity):
-    if main_image.size != alpha_image.size:
-        alpha_image = alpha_image.resize(main_image.size, Image.LANCZOS)
-    new_alpha = alpha_image.point(lambda p: int(p * opacity))
-    main_image.putalpha(new_alpha)
-    return main_image
-
-def get_default_alpha(width, height):
-    return Image.new('L', (width, height), 255)
-
-def get_default_bottom(width, height):
-    return Image.new('RGBA', (width, height), (255,255,255,255))
-
-def blend_images(base, layer, blend_mode):
-    if blend_mode.lower()=="normal":
-        return Image.alpha_composite(base, layer)
-    else:
-        base_arr = np.array(base).astype(np.float32)/255.0
-        layer_arr = np.array(layer).astype(np.float32)/255.0
-        base_alpha = base_arr[...,3:4]
-        layer_alpha = layer_arr[...,3:4]
-        base_rgb = base_arr[..., :3]*base_alpha
-        layer_rgb = layer_arr[..., :3]*layer_alpha
-        if blend_mode.lower()=="screen":
-            screen_rgb = 1.0-(1.0-base_rgb)*(1.0-layer_rgb)
-            blended_rgb = base_rgb + (screen_rgb-base_rgb)*layer_alpha
-        elif blend_mode.lower()=="multiply":
-            blended_rgb = base_rgb * layer_rgb
-        elif blend_mode.lower()=="add":
-            blended_rgb = np.clip(base_rgb+layer_rgb, 0,1)
-        elif blend_mode.lower()=="subtract":
-            blended_rgb = np.clip(base_rgb-layer_rgb, 0,1)
-        else:
-            blended_rgb = base_rgb
-        blended_alpha = layer_alpha+base_alpha*(1.0-layer_alpha)
-        with np.errstate(divide='ignore', invalid='ignore'):
-            out_rgb = np.where(blended_alpha==0, 0, blended_rgb/blended_alpha)
-        final_arr = np.concatenate([out_rgb, blended_alpha],axis=-1)
-        final_arr = (np.clip(final_arr,0,1)*255).astype(np.uint8)
-        return Image.fromarray(final_arr, mode="RGBA")
-
 # ---------------- Transformation Editor (Inline) ----------------
 
 def update_transformation_params(tr_widgets):
@@ -269,7 +140,7 @@ def add_layer():
     alpha_const_entry = tk.Entry(frame, textvariable=alpha_const_var, width=12)
     alpha_mode_combobox = ttk.Combobox(frame, textvariable=alpha_mode_var, values=["Parent", "Child", "Exact"], state="readonly", width=8)
     alpha_opacity_entry = tk.Entry(frame, textvariable=alpha_opacity_var, width=5)
-    blend_mode_combobox = ttk.Combobox(frame, textvariable=blend_mode_var, values=["Normal", "Multiply", "Screen", "Add", "Subtract"], state="readonly", width=10)
+    blend_mode_combobox = ttk.Combobox(frame, textvariable=blend_mode_var, values=BLEND_MODES, state="readonly", width=10)
     gamma_entry = tk.Entry(frame, textvariable=gamma_var, width=8)
     
     main_mode_combobox.bind("<<ComboboxSelected>>", on_dynamic_mode_change)
@@ -410,168 +281,90 @@ def browse_export_folder():
 
 # ---------------- Export Options Widgets will use variables created after root ----------------
 # ---------------- Thread-Safe Logging ----------------
+# Worker threads append to a ring buffer; the UI drains it in batches on a timer, so a
+# busy run no longer floods the Tk event queue with one callback per line.
+
+LOG_BUFFER_LINES = 5000    # lines held between drains before the oldest are dropped
+LOG_WIDGET_LINES = 10000   # lines kept in the log window
+LOG_DRAIN_MS = 100
 
-def log_message(msg):
-    root.after(0, lambda: log_text.insert(tk.END, msg + "\n"))
+log_buffer = deque(maxlen=LOG_BUFFER_LINES)
+log_lock = threading.Lock()
+log_state = {"level": INFO, "dropped": 0}
+progress_state = {"done": 0, "total": 0, "start": None}
+
+def log_message(msg, level=INFO):
+    if level < log_state["level"]:
+        return
+    with log_lock:
+        if len(log_buffer) == LOG_BUFFER_LINES:
+            log_state["dropped"] += 1
+        log_buffer.append(msg)
+
+def report_progress(done, total):
+    with log_lock:
+        progress_state["done"] = done
+        progress_state["total"] = total
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+def update_progress():
+    with log_lock:
+        done, total, start = progress_state["done"], progress_state["total"], progress_state["start"]
+    if not total or start is None:
+        return
+    progress_bar.configure(maximum=total, value=done)
+    elapsed = time.perf_counter() - start
+    rate = done / elapsed if elapsed > 0 else 0.0
+    eta = format_duration((total - done) / rate) if rate > 0 else "--"
+    progress_label.configure(text=f"{done}/{total} keys  {rate:.2f} keys/s  ETA {eta}")
+
+def drain_log():
+    """Moves buffered log lines into the log window in one insert, then refreshes the progress bar."""
+    with log_lock:
+        lines = list(log_buffer)
+        log_buffer.clear()
+        dropped = log_state["dropped"]
+        log_state["dropped"] = 0
+    if dropped:
+        log_text.insert(tk.END, f"... {dropped} log line(s) dropped ...\n")
+    if lines:
+        log_text.insert(tk.END, "\n".join(lines) + "\n")
+        excess = int(log_text.index("end-1c").split(".")[0]) - LOG_WIDGET_LINES
+        if excess > 0:
+            log_text.delete("1.0", f"{excess + 1}.0")
+        log_text.see(tk.END)
+    update_progress()
+    root.after(LOG_DRAIN_MS, drain_log)
 
 # ---------------- Multithreaded Processing ----------------
 
 def process_images_worker(params):
-    folder = params["folder"]
     export_folder = params["export_folder"]
-    target_width = params["target_width"]
-    target_height = params["target_height"]
-    layers_config = params["layers_config"]
-    output_format = params["output_format"]
-    quality = params["quality"]
-    append_suffix = params["append_suffix"]
-    suffix_value = params["suffix_value"]
-
     try:
-        os.makedirs(export_folder, exist_ok=True)
-        log_message("Building layer dictionaries...")
-
-        parent_layer = [layer for layer in layers_config if layer["main_mode"].lower()=="parent"][0]
-        parent_dict = build_exact_dict(folder, parent_layer["main_constant"])
-        if not parent_dict:
-            root.after(0, lambda: messagebox.showerror("Error", "No images found for parent layer."))
-            return
-        log_message(f"Found {len(parent_dict)} parent image(s) from layer '{parent_layer['name']}'.")
-        log_message(f"Parent keys: {', '.join(parent_dict.keys())}\n")
-
-        main_layer_dicts = []
-        for layer in layers_config:
-            mode = layer["main_mode"].lower()
-            const = layer["main_constant"]
-            if mode=="parent":
-                main_layer_dicts.append(parent_dict)
-            elif mode=="exact":
-                d = build_exact_dict(folder, const)
-                main_layer_dicts.append(d)
-            elif mode=="child":
-                mapping = build_mapping(folder, const)
-                d = {}
-                for pkey in parent_dict.keys():
-                    match = find_best_match(pkey, mapping)
-                    if match:
-                        d[pkey] = match
-                main_layer_dicts.append(d)
-            else:
-                root.after(0, lambda: messagebox.showerror("Error", f"Invalid main mode for layer '{layer['name']}'."))
-                return
-
-        alpha_override_maps = []
-        for layer in layers_config:
-            if layer["use_alpha"]:
-                a_mode = layer["alpha_mode"].lower()
-                a_const = layer["alpha_constant"]
-                if a_mode in ("parent","exact"):
-                    a_map = build_exact_dict(folder, a_const)
-                elif a_mode=="child":
-                    a_map = build_mapping(folder, a_const)
-                else:
-                    root.after(0, lambda: messagebox.showerror("Error", f"Invalid alpha mode for layer '{layer['name']}'."))
-                    return
-                alpha_override_maps.append(a_map)
-            else:
-                alpha_override_maps.append(None)
-
-        common_keys = set(parent_dict.keys())
-        for d in main_layer_dicts:
-            common_keys = common_keys & set(d.keys())
-        log_message(f"Processing composite for {len(common_keys)} key(s) (intersection across all layers).\n")
-        if not common_keys:
+        key_count, completed = run_composite(params, stop_event, log_message, progress=report_progress)
+        if not key_count:
             root.after(0, lambda: messagebox.showinfo("Info", "No composite entries found where all layers are available."))
             return
-
-        for key in common_keys:
-            if stop_event.is_set():
-                log_message("Processing stopped by user.")
-                return
-            try:
-                composite_img = None
-                log_message(f"Processing composite for key: '{key}'")
-                for idx, layer in enumerate(layers_config):
-                    img_path = main_layer_dicts[idx].get(key)
-                    if not img_path:
-                        raise Exception(f"Missing main image for layer '{layer['name']}' (key: {key}).")
-                    log_message(f"  Layer '{layer['name']}' main image: {img_path}")
-                    img = Image.open(img_path).convert("RGBA")
-                    if img.size != (target_width, target_height):
-                        img = img.resize((target_width, target_height), Image.LANCZOS)
-                        log_message(f"    Resized image to {target_width}x{target_height}.")
-                    trans_list = layer.get("transformations", [])
-                    filtered_trans = [t for t in trans_list if t.get("match", "").lower()==layer["name"].lower()]
-                    if filtered_trans:
-                        img = apply_transformations(img, filtered_trans)
-                        log_message(f"    Applied transformations: {filtered_trans}")
-                    m_opacity = float(layer["main_opacity"])
-                    img = set_opacity(img, m_opacity)
-                    
-                    if layer["use_alpha"]:
-                        alpha_map = alpha_override_maps[idx]
-                        override_path = None
-                        if layer["alpha_mode"].lower()=="child":
-                            override_path = find_best_match(key, alpha_map)
-                        elif layer["alpha_mode"].lower() in ("exact", "parent"):
-                            override_path = alpha_map.get(key) if key in alpha_map else None
-                        if override_path:
-                            log_message(f"    Alpha override image: {override_path}")
-                            a_img = Image.open(override_path).convert("L")
-                            if a_img.size != (target_width, target_height):
-                                a_img = a_img.resize((target_width, target_height), Image.LANCZOS)
-                            a_opacity = float(layer["alpha_opacity"])
-                            img = apply_alpha_override(img, a_img, a_opacity)
-                        else:
-                            log_message("    No alpha override image found; using main alpha.")
-                    
-                    try:
-                        layer_gamma = float(layer.get("gamma", "1.0"))
-                    except:
-                        layer_gamma = 1.0
-                    if layer_gamma != 1.0:
-                        img = adjust_gamma(img, layer_gamma)
-                        log_message(f"    Applied gamma correction: {layer_gamma}")
-                    
-                    blend_mode = layer["blend_mode"].lower()
-                    if composite_img is None:
-                        composite_img = img
-                    else:
-                        composite_img = blend_images(composite_img, img, blend_mode)
-                if append_suffix:
-                    filename = key + suffix_value
-                else:
-                    filename = key
-                if output_format.lower()=="jpg":
-                    ext = ".jpg"
-                    composite_to_save = composite_img.convert("RGB")
-                else:
-                    ext = ".png"
-                    compress_level = max(0, min(9, int((100-quality)/10)))
-                    composite_to_save = composite_img
-                if preserve_structure_var.get():
-                    parent_path = parent_dict[key]
-                    rel_path = os.path.relpath(parent_path, folder)
-                    rel_dir = os.path.dirname(rel_path)
-                    final_export_folder = os.path.join(export_folder, rel_dir)
-                    os.makedirs(final_export_folder, exist_ok=True)
-                    output_path = os.path.join(final_export_folder, f"{filename}{ext}")
-                else:
-                    output_path = os.path.join(export_folder, f"{filename}{ext}")
-                if output_format.lower()=="jpg":
-                    composite_to_save.save(output_path, quality=quality)
-                else:
-                    composite_to_save.save(output_path, compress_level=compress_level)
-                log_message(f"Composite for key '{key}' saved to: {output_path}\n")
-            except Exception as e:
-                log_message(f"Error processing key '{key}': {e}\n")
-        root.after(0, lambda: messagebox.showinfo("Done", f"Processed composites for {len(common_keys)} key(s).\nOutput saved in:\n{export_folder}"))
+        if not completed:
+            return
+        root.after(0, lambda: messagebox.showinfo("Done", f"Processed composites for {key_count} key(s).\nOutput saved in:\n{export_folder}"))
     except Exception as e:
         root.after(0, lambda e=e: messagebox.showerror("Error", str(e)))
 
 def start_processing():
     stop_event.clear()
     log_text.delete("1.0", tk.END)
+    with log_lock:
+        log_buffer.clear()
+        log_state["dropped"] = 0
+        progress_state.update(done=0, total=0, start=time.perf_counter())
+    log_state["level"] = DETAIL if log_level_var.get() == "Detailed" else INFO
+    progress_bar.configure(value=0)
+    progress_label.configure(text="")
     folder = folder_path_entry.get().strip()
     if not folder:
         messagebox.showerror("Error", "Please select a source folder.")
@@ -586,24 +379,53 @@ def start_processing():
         messagebox.showerror("Error", "Target width and height must be integers.")
         return
     layers_config = get_layers_config()
-    if not layers_config:
-        messagebox.showerror("Error", "No layer configuration available.")
+    try:
+        validate_layers_config(layers_config)
+    except ValueError as e:
+        messagebox.showerror("Error", str(e))
         return
-    for layer in layers_config:
-        try:
-            op = float(layer["main_opacity"])
-            if not (0.0<=op<=1.0):
-                raise ValueError
-            if layer["use_alpha"]:
-                aop = float(layer["alpha_opacity"])
-                if not (0.0<=aop<=1.0):
-                    raise ValueError
-        except:
-            messagebox.showerror("Error", f"Opacity values for layer '{layer['name']}' must be numbers between 0 and 1.")
-            return
-    parent_layers = [layer for layer in layers_config if layer["main_mode"].lower()=="parent"]
-    if len(parent_layers)!=1:
-        messagebox.showerror("Error", "There must be exactly one layer set to 'Parent'.")
+    try:
+        workers = int(workers_var.get())
+        if workers < 1:
+            raise ValueError
+    except (ValueError, tk.TclError):
+        messagebox.showerror("Error", "Workers must be a positive integer.")
+        return
+    try:
+        layer_cache_mb = int(layer_cache_var.get())
+        if layer_cache_mb < 0:
+            raise ValueError
+    except (ValueError, tk.TclError):
+        messagebox.showerror("Error", "Layer cache size must be a whole number of MB (0 disables it).")
+        return
+    try:
+        prefetch_depth = int(prefetch_depth_var.get())
+        write_depth = int(write_depth_var.get())
+        if prefetch_depth < 1 or write_depth < 1:
+            raise ValueError
+    except (ValueError, tk.TclError):
+        messagebox.showerror("Error", "Prefetch and write queue depths must be positive integers.")
+        return
+    try:
+        stage_processes = int(stage_processes_var.get())
+        if stage_processes < 0:
+            raise ValueError
+    except (ValueError, tk.TclError):
+        messagebox.showerror("Error", "Stage processes must be a whole number (0 runs the stages on threads).")
+        return
+    try:
+        strip_height = int(strip_height_var.get())
+        if strip_height < 0:
+            raise ValueError
+    except (ValueError, tk.TclError):
+        messagebox.showerror("Error", "Strip height must be a whole number of rows (0 composites full frames).")
+        return
+    try:
+        png_threads = int(png_threads_var.get())
+        if png_threads < 1:
+            raise ValueError
+    except (ValueError, tk.TclError):
+        messagebox.showerror("Error", "PNG threads must be a positive integer.")
         return
     output_format = output_format_var.get()
     quality = int(quality_var.get())
@@ -619,7 +441,25 @@ def start_processing():
         "output_format": output_format,
         "quality": quality,
         "append_suffix": append_suffix,
-        "suffix_value": suffix_value
+        "suffix_value": suffix_value,
+        "preserve_structure": preserve_structure_var.get(),
+        "cache_scan": cache_scan_var.get(),
+        "float_pipeline": float_pipeline_var.get(),
+        "layer_cache_mb": layer_cache_mb,
+        "incremental": incremental_var.get(),
+        "pipelined": pipelined_var.get(),
+        "prefetch_depth": prefetch_depth,
+        "write_depth": write_depth,
+        "stage_processes": stage_processes,
+        "strip_height": strip_height,
+        "png_strategy": png_strategy_var.get(),
+        "png_threads": png_threads,
+        "jpeg_progressive": jpeg_progressive_var.get(),
+        "jpeg_optimize": jpeg_optimize_var.get(),
+        "webp_lossless": webp_lossless_var.get(),
+        "webp_method": int(webp_method_var.get()),
+        "fixed_point": fixed_point_var.get(),
+        "workers": workers
     }
     threading.Thread(target=process_images_worker, args=(params,), daemon=True).start()
 
@@ -629,122 +469,209 @@ def stop_processing():
 
 # ---------------- GUI Layout ----------------
 
-root = tk.Tk()
-root.title("Unlimited Layers Image Composer")
-style = ttk.Style(root)
-style.theme_use("clam")
-
-# Folders Frame
-folders_frame = ttk.LabelFrame(root, text="Folders")
-folders_frame.grid(row=0, column=0, columnspan=3, padx=10, pady=10, sticky="ew")
-folder_label = ttk.Label(folders_frame, text="Source Folder:")
-folder_label.grid(row=0, column=0, padx=5, pady=5, sticky="e")
-folder_path_entry = ttk.Entry(folders_frame, width=50)
-folder_path_entry.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
-browse_button = ttk.Button(folders_frame, text="Browse...", command=browse_folder)
-browse_button.grid(row=0, column=2, padx=5, pady=5)
-export_label = ttk.Label(folders_frame, text="Export Folder:")
-export_label.grid(row=1, column=0, padx=5, pady=5, sticky="e")
-export_folder_entry = ttk.Entry(folders_frame, width=50)
-export_folder_entry.grid(row=1, column=1, padx=5, pady=5, sticky="ew")
-export_browse_button = ttk.Button(folders_frame, text="Browse...", command=browse_export_folder)
-export_browse_button.grid(row=1, column=2, padx=5, pady=5)
-
-# Target Dimensions Frame
-dim_frame = ttk.LabelFrame(root, text="Target Dimensions")
-dim_frame.grid(row=1, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
-target_width_label = ttk.Label(dim_frame, text="Width:")
-target_width_label.grid(row=0, column=0, padx=5, pady=5, sticky="e")
-target_width_entry = ttk.Entry(dim_frame, width=10)
-target_width_entry.grid(row=0, column=1, padx=5, pady=5, sticky="w")
-target_width_entry.insert(0, "4096")
-target_height_label = ttk.Label(dim_frame, text="Height:")
-target_height_label.grid(row=0, column=2, padx=5, pady=5, sticky="e")
-target_height_entry = ttk.Entry(dim_frame, width=10)
-target_height_entry.grid(row=0, column=3, padx=5, pady=5, sticky="w")
-target_height_entry.insert(0, "2048")
-
-# Options Frame
-options_frame = ttk.LabelFrame(root, text="Options")
-options_frame.grid(row=2, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
-preserve_structure_var = tk.BooleanVar()
-preserve_structure_check = ttk.Checkbutton(options_frame, text="Preserve Parent Image Directory Structure", variable=preserve_structure_var)
-preserve_structure_check.grid(row=0, column=0, padx=5, pady=5, sticky="w")
-output_format_var = tk.StringVar(master=root, value="jpg")
-output_format_label = ttk.Label(options_frame, text="Export Format:")
-output_format_label.grid(row=0, column=1, padx=5, pady=5, sticky="w")
-output_format_combo = ttk.Combobox(options_frame, textvariable=output_format_var, values=["jpg", "png"], state="readonly", width=5)
-output_format_combo.grid(row=0, column=2, padx=5, pady=5, sticky="w")
-quality_var = tk.IntVar(master=root, value=80)
-quality_label = ttk.Label(options_frame, text="Quality:")
-quality_label.grid(row=0, column=3, padx=5, pady=5, sticky="w")
-quality_scale = ttk.Scale(options_frame, from_=0, to=100, orient="horizontal", variable=quality_var)
-quality_scale.grid(row=0, column=4, padx=5, pady=5, sticky="w")
-quality_entry = ttk.Entry(options_frame, textvariable=quality_var, width=5)
-quality_entry.grid(row=0, column=5, padx=5, pady=5, sticky="w")
-append_suffix_var = tk.BooleanVar(master=root, value=True)
-suffix_var = tk.StringVar(master=root, value="_composited")
-suffix_check = ttk.Checkbutton(options_frame, text="Append Suffix", variable=append_suffix_var)
-suffix_check.grid(row=1, column=1, padx=5, pady=5, sticky="w")
-suffix_entry = ttk.Entry(options_frame, textvariable=suffix_var, width=15)
-suffix_entry.grid(row=1, column=2, padx=5, pady=5, sticky="w")
-
-# Layers Configuration Frame
-layers_lf = ttk.LabelFrame(root, text="Layers Configuration")
-# Ensure it expands with the window.
-layers_lf.grid(row=3, column=0, columnspan=3, padx=10, pady=10, sticky="nsew")
-# Set weights so the frame grows.
-layers_lf.columnconfigure(0, weight=1)
-layers_lf.rowconfigure(0, weight=1)
-layers_canvas = tk.Canvas(layers_lf, width=1150, height=200)
-layers_canvas.grid(row=0, column=0, sticky="nsew")
-# Configure canvas to expand within its container.
-layers_canvas.columnconfigure(0, weight=1)
-layers_canvas.rowconfigure(0, weight=1)
-
-def _on_mousewheel(event):
-    layers_canvas.yview_scroll(int(-1 * (event.delta / 120)), "units")
-
-# Bind the mousewheel event to the canvas.
-layers_canvas.bind_all("<MouseWheel>", _on_mousewheel)
-
-layers_scrollbar = ttk.Scrollbar(layers_lf, orient="vertical", command=layers_canvas.yview)
-layers_scrollbar.grid(row=0, column=1, sticky="ns", padx=5, pady=5)
-layers_canvas.configure(yscrollcommand=layers_scrollbar.set)
-layers_frame = tk.Frame(layers_canvas)
-layers_canvas.create_window((0,0), window=layers_frame, anchor="nw")
-def on_configure(event):
-    layers_canvas.configure(scrollregion=layers_canvas.bbox("all"))
-layers_frame.bind("<Configure>", on_configure)
-headers = ["Name", "Main Const", "Main Mode", "M. Opac", "Use Alpha", "Alpha Const", "Alpha Mode", "A. Opac", "Blend Mode", "Gamma", "Transforms"]
-for col, header in enumerate(headers):
-    hdr = ttk.Label(layers_frame, text=header, relief="groove")
-    hdr.grid(row=0, column=col, padx=2, pady=2, sticky="ew")
-add_layer()
-if layer_rows:
-    layer_rows[0]["main_mode_combobox"].set("Parent")
-
-# Buttons for layer configuration management
-buttons_frame = ttk.Frame(root)
-buttons_frame.grid(row=4, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
-add_layer_button = ttk.Button(buttons_frame, text="Add Layer", command=add_layer)
-add_layer_button.grid(row=0, column=0, padx=5, pady=5)
-remove_layer_button = ttk.Button(buttons_frame, text="Remove Last Layer", command=remove_last_layer)
-remove_layer_button.grid(row=0, column=1, padx=5, pady=5)
-save_config_button = ttk.Button(buttons_frame, text="Save Config", command=export_config)
-save_config_button.grid(row=0, column=2, padx=5, pady=5)
-load_config_button = ttk.Button(buttons_frame, text="Load Config", command=load_config)
-load_config_button.grid(row=0, column=3, padx=5, pady=5)
-
-# Process and Stop Buttons, Log Window
-process_button = ttk.Button(root, text="Process", command=start_processing)
-process_button.grid(row=5, column=0, padx=10, pady=10)
-stop_button = ttk.Button(root, text="Stop", command=stop_processing)
-stop_button.grid(row=5, column=1, padx=10, pady=10)
-log_text = scrolledtext.ScrolledText(root, width=100, height=15)
-log_text.grid(row=6, column=0, columnspan=3, padx=10, pady=10, sticky="nsew")
-root.columnconfigure(0, weight=1)
-root.columnconfigure(1, weight=1)
-root.columnconfigure(2, weight=1)
-root.rowconfigure(6, weight=1)
-root.mainloop()
+if __name__ == "__main__":
+    # Worker processes re-import this script on Windows; only the parent builds the GUI.
+    multiprocessing.freeze_support()
+
+    root = tk.Tk()
+    root.title("Unlimited Layers Image Composer")
+    style = ttk.Style(root)
+    style.theme_use("clam")
+
+    # Folders Frame
+    folders_frame = ttk.LabelFrame(root, text="Folders")
+    folders_frame.grid(row=0, column=0, columnspan=3, padx=10, pady=10, sticky="ew")
+    folder_label = ttk.Label(folders_frame, text="Source Folder:")
+    folder_label.grid(row=0, column=0, padx=5, pady=5, sticky="e")
+    folder_path_entry = ttk.Entry(folders_frame, width=50)
+    folder_path_entry.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
+    browse_button = ttk.Button(folders_frame, text="Browse...", command=browse_folder)
+    browse_button.grid(row=0, column=2, padx=5, pady=5)
+    export_label = ttk.Label(folders_frame, text="Export Folder:")
+    export_label.grid(row=1, column=0, padx=5, pady=5, sticky="e")
+    export_folder_entry = ttk.Entry(folders_frame, width=50)
+    export_folder_entry.grid(row=1, column=1, padx=5, pady=5, sticky="ew")
+    export_browse_button = ttk.Button(folders_frame, text="Browse...", command=browse_export_folder)
+    export_browse_button.grid(row=1, column=2, padx=5, pady=5)
+
+    # Target Dimensions Frame
+    dim_frame = ttk.LabelFrame(root, text="Target Dimensions")
+    dim_frame.grid(row=1, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
+    target_width_label = ttk.Label(dim_frame, text="Width:")
+    target_width_label.grid(row=0, column=0, padx=5, pady=5, sticky="e")
+    target_width_entry = ttk.Entry(dim_frame, width=10)
+    target_width_entry.grid(row=0, column=1, padx=5, pady=5, sticky="w")
+    target_width_entry.insert(0, "4096")
+    target_height_label = ttk.Label(dim_frame, text="Height:")
+    target_height_label.grid(row=0, column=2, padx=5, pady=5, sticky="e")
+    target_height_entry = ttk.Entry(dim_frame, width=10)
+    target_height_entry.grid(row=0, column=3, padx=5, pady=5, sticky="w")
+    target_height_entry.insert(0, "2048")
+
+    # Options Frame
+    options_frame = ttk.LabelFrame(root, text="Options")
+    options_frame.grid(row=2, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
+    preserve_structure_var = tk.BooleanVar()
+    preserve_structure_check = ttk.Checkbutton(options_frame, text="Preserve Parent Image Directory Structure", variable=preserve_structure_var)
+    preserve_structure_check.grid(row=0, column=0, padx=5, pady=5, sticky="w")
+    output_format_var = tk.StringVar(master=root, value="jpg")
+    output_format_label = ttk.Label(options_frame, text="Export Format:")
+    output_format_label.grid(row=0, column=1, padx=5, pady=5, sticky="w")
+    output_format_combo = ttk.Combobox(options_frame, textvariable=output_format_var, values=["jpg", "png", "webp"], state="readonly", width=5)
+    output_format_combo.grid(row=0, column=2, padx=5, pady=5, sticky="w")
+    quality_var = tk.IntVar(master=root, value=80)
+    quality_label = ttk.Label(options_frame, text="Quality:")
+    quality_label.grid(row=0, column=3, padx=5, pady=5, sticky="w")
+    quality_scale = ttk.Scale(options_frame, from_=0, to=100, orient="horizontal", variable=quality_var)
+    quality_scale.grid(row=0, column=4, padx=5, pady=5, sticky="w")
+    quality_entry = ttk.Entry(options_frame, textvariable=quality_var, width=5)
+    quality_entry.grid(row=0, column=5, padx=5, pady=5, sticky="w")
+    append_suffix_var = tk.BooleanVar(master=root, value=True)
+    suffix_var = tk.StringVar(master=root, value="_composited")
+    suffix_check = ttk.Checkbutton(options_frame, text="Append Suffix", variable=append_suffix_var)
+    suffix_check.grid(row=1, column=1, padx=5, pady=5, sticky="w")
+    suffix_entry = ttk.Entry(options_frame, textvariable=suffix_var, width=15)
+    suffix_entry.grid(row=1, column=2, padx=5, pady=5, sticky="w")
+    workers_var = tk.StringVar(master=root, value="1")
+    workers_label = ttk.Label(options_frame, text="Workers:")
+    workers_label.grid(row=1, column=3, padx=5, pady=5, sticky="w")
+    workers_entry = ttk.Entry(options_frame, textvariable=workers_var, width=5)
+    workers_entry.grid(row=1, column=4, padx=5, pady=5, sticky="w")
+    cache_scan_var = tk.BooleanVar(master=root, value=False)
+    cache_scan_check = ttk.Checkbutton(options_frame, text="Cache Folder Scan", variable=cache_scan_var)
+    cache_scan_check.grid(row=1, column=0, padx=5, pady=5, sticky="w")
+    float_pipeline_var = tk.BooleanVar(master=root, value=False)
+    float_pipeline_check = ttk.Checkbutton(options_frame, text="Float Pipeline", variable=float_pipeline_var)
+    float_pipeline_check.grid(row=2, column=0, padx=5, pady=5, sticky="w")
+    layer_cache_var = tk.StringVar(master=root, value="512")
+    layer_cache_label = ttk.Label(options_frame, text="Layer Cache (MB total):")
+    layer_cache_label.grid(row=2, column=1, padx=5, pady=5, sticky="w")
+    layer_cache_entry = ttk.Entry(options_frame, textvariable=layer_cache_var, width=6)
+    layer_cache_entry.grid(row=2, column=2, padx=5, pady=5, sticky="w")
+    incremental_var = tk.BooleanVar(master=root, value=False)
+    incremental_check = ttk.Checkbutton(options_frame, text="Skip Up-to-Date Outputs", variable=incremental_var)
+    incremental_check.grid(row=2, column=3, columnspan=2, padx=5, pady=5, sticky="w")
+    pipelined_var = tk.BooleanVar(master=root, value=False)
+    pipelined_check = ttk.Checkbutton(options_frame, text="Pipelined I/O", variable=pipelined_var)
+    pipelined_check.grid(row=3, column=0, padx=5, pady=5, sticky="w")
+    prefetch_depth_var = tk.StringVar(master=root, value="2")
+    prefetch_depth_label = ttk.Label(options_frame, text="Prefetch Depth:")
+    prefetch_depth_label.grid(row=3, column=1, padx=5, pady=5, sticky="w")
+    prefetch_depth_entry = ttk.Entry(options_frame, textvariable=prefetch_depth_var, width=5)
+    prefetch_depth_entry.grid(row=3, column=2, padx=5, pady=5, sticky="w")
+    write_depth_var = tk.StringVar(master=root, value="2")
+    write_depth_label = ttk.Label(options_frame, text="Write Depth:")
+    write_depth_label.grid(row=3, column=3, padx=5, pady=5, sticky="w")
+    write_depth_entry = ttk.Entry(options_frame, textvariable=write_depth_var, width=5)
+    write_depth_entry.grid(row=3, column=4, padx=5, pady=5, sticky="w")
+    strip_height_var = tk.StringVar(master=root, value="0")
+    strip_height_label = ttk.Label(options_frame, text="Strip Height:")
+    strip_height_label.grid(row=3, column=5, padx=5, pady=5, sticky="w")
+    strip_height_entry = ttk.Entry(options_frame, textvariable=strip_height_var, width=6)
+    strip_height_entry.grid(row=3, column=6, padx=5, pady=5, sticky="w")
+    strip_height_note = ttk.Label(options_frame, text="(resized layers can differ by a level or two)", foreground="gray")
+    strip_height_note.grid(row=3, column=7, columnspan=2, padx=5, pady=5, sticky="w")
+    png_strategy_var = tk.StringVar(master=root, value="default")
+    png_strategy_label = ttk.Label(options_frame, text="PNG Strategy:")
+    png_strategy_label.grid(row=4, column=0, padx=5, pady=5, sticky="w")
+    png_strategy_combo = ttk.Combobox(options_frame, textvariable=png_strategy_var, values=list(PNG_STRATEGIES), state="readonly", width=9)
+    png_strategy_combo.grid(row=4, column=1, padx=5, pady=5, sticky="w")
+    png_threads_var = tk.StringVar(master=root, value="1")
+    png_threads_label = ttk.Label(options_frame, text="PNG Threads:")
+    png_threads_label.grid(row=4, column=2, padx=5, pady=5, sticky="w")
+    png_threads_entry = ttk.Entry(options_frame, textvariable=png_threads_var, width=5)
+    png_threads_entry.grid(row=4, column=3, padx=5, pady=5, sticky="w")
+    jpeg_progressive_var = tk.BooleanVar(master=root, value=False)
+    jpeg_progressive_check = ttk.Checkbutton(options_frame, text="Progressive JPEG", variable=jpeg_progressive_var)
+    jpeg_progressive_check.grid(row=4, column=4, padx=5, pady=5, sticky="w")
+    jpeg_optimize_var = tk.BooleanVar(master=root, value=False)
+    jpeg_optimize_check = ttk.Checkbutton(options_frame, text="Optimize JPEG", variable=jpeg_optimize_var)
+    jpeg_optimize_check.grid(row=4, column=5, padx=5, pady=5, sticky="w")
+    webp_lossless_var = tk.BooleanVar(master=root, value=False)
+    webp_lossless_check = ttk.Checkbutton(options_frame, text="Lossless WebP", variable=webp_lossless_var)
+    webp_lossless_check.grid(row=4, column=6, padx=5, pady=5, sticky="w")
+    webp_method_var = tk.StringVar(master=root, value="4")
+    webp_method_label = ttk.Label(options_frame, text="WebP Method:")
+    webp_method_label.grid(row=4, column=7, padx=5, pady=5, sticky="w")
+    webp_method_combo = ttk.Combobox(options_frame, textvariable=webp_method_var, values=[str(m) for m in range(7)], state="readonly", width=3)
+    webp_method_combo.grid(row=4, column=8, padx=5, pady=5, sticky="w")
+    stage_processes_var = tk.StringVar(master=root, value="0")
+    stage_processes_label = ttk.Label(options_frame, text="Stage Processes:")
+    stage_processes_label.grid(row=5, column=0, padx=5, pady=5, sticky="w")
+    stage_processes_entry = ttk.Entry(options_frame, textvariable=stage_processes_var, width=5)
+    stage_processes_entry.grid(row=5, column=1, padx=5, pady=5, sticky="w")
+    fixed_point_var = tk.BooleanVar(master=root, value=False)
+    fixed_point_check = ttk.Checkbutton(options_frame, text="Fixed-Point Blend", variable=fixed_point_var)
+    fixed_point_check.grid(row=5, column=2, columnspan=2, padx=5, pady=5, sticky="w")
+    log_level_var = tk.StringVar(master=root, value="Normal")
+    log_level_label = ttk.Label(options_frame, text="Log Detail:")
+    log_level_label.grid(row=1, column=5, padx=5, pady=5, sticky="w")
+    log_level_combo = ttk.Combobox(options_frame, textvariable=log_level_var, values=["Normal", "Detailed"], state="readonly", width=9)
+    log_level_combo.grid(row=1, column=6, padx=5, pady=5, sticky="w")
+
+    # Layers Configuration Frame
+    layers_lf = ttk.LabelFrame(root, text="Layers Configuration")
+    # Ensure it expands with the window.
+    layers_lf.grid(row=3, column=0, columnspan=3, padx=10, pady=10, sticky="nsew")
+    # Set weights so the frame grows.
+    layers_lf.columnconfigure(0, weight=1)
+    layers_lf.rowconfigure(0, weight=1)
+    layers_canvas = tk.Canvas(layers_lf, width=1150, height=200)
+    layers_canvas.grid(row=0, column=0, sticky="nsew")
+    # Configure canvas to expand within its container.
+    layers_canvas.columnconfigure(0, weight=1)
+    layers_canvas.rowconfigure(0, weight=1)
+
+    def _on_mousewheel(event):
+        layers_canvas.yview_scroll(int(-1 * (event.delta / 120)), "units")
+
+    # Bind the mousewheel event to the canvas.
+    layers_canvas.bind_all("<MouseWheel>", _on_mousewheel)
+
+    layers_scrollbar = ttk.Scrollbar(layers_lf, orient="vertical", command=layers_canvas.yview)
+    layers_scrollbar.grid(row=0, column=1, sticky="ns", padx=5, pady=5)
+    layers_canvas.configure(yscrollcommand=layers_scrollbar.set)
+    layers_frame = tk.Frame(layers_canvas)
+    layers_canvas.create_window((0,0), window=layers_frame, anchor="nw")
+    def on_configure(event):
+        layers_canvas.configure(scrollregion=layers_canvas.bbox("all"))
+    layers_frame.bind("<Configure>", on_configure)
+    headers = ["Name", "Main Const", "Main Mode", "M. Opac", "Use Alpha", "Alpha Const", "Alpha Mode", "A. Opac", "Blend Mode", "Gamma", "Transforms"]
+    for col, header in enumerate(headers):
+        hdr = ttk.Label(layers_frame, text=header, relief="groove")
+        hdr.grid(row=0, column=col, padx=2, pady=2, sticky="ew")
+    add_layer()
+    if layer_rows:
+        layer_rows[0]["main_mode_combobox"].set("Parent")
+
+    # Buttons for layer configuration management
+    buttons_frame = ttk.Frame(root)
+    buttons_frame.grid(row=4, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
+    add_layer_button = ttk.Button(buttons_frame, text="Add Layer", command=add_layer)
+    add_layer_button.grid(row=0, column=0, padx=5, pady=5)
+    remove_layer_button = ttk.Button(buttons_frame, text="Remove Last Layer", command=remove_last_layer)
+    remove_layer_button.grid(row=0, column=1, padx=5, pady=5)
+    save_config_button = ttk.Button(buttons_frame, text="Save Config", command=export_config)
+    save_config_button.grid(row=0, column=2, padx=5, pady=5)
+    load_config_button = ttk.Button(buttons_frame, text="Load Config", command=load_config)
+    load_config_button.grid(row=0, column=3, padx=5, pady=5)
+
+    # Process and Stop Buttons, Log Window
+    process_button = ttk.Button(root, text="Process", command=start_processing)
+    process_button.grid(row=5, column=0, padx=10, pady=10)
+    stop_button = ttk.Button(root, text="Stop", command=stop_processing)
+    stop_button.grid(row=5, column=1, padx=10, pady=10)
+    progress_frame = ttk.Frame(root)
+    progress_frame.grid(row=5, column=2, padx=10, pady=10, sticky="ew")
+    progress_bar = ttk.Progressbar(progress_frame, orient="horizontal", mode="determinate", length=250)
+    progress_bar.pack(side="left", padx=5)
+    progress_label = ttk.Label(progress_frame, text="")
+    progress_label.pack(side="left", padx=5)
+    log_text = scrolledtext.ScrolledText(root, width=100, height=15)
+    log_text.grid(row=6, column=0, columnspan=3, padx=10, pady=10, sticky="nsew")
+    root.after(LOG_DRAIN_MS, drain_log)
+    root.columnconfigure(0, weight=1)
+    root.columnconfigure(1, weight=1)
+    root.columnconfigure(2, weight=1)
+    root.rowconfigure(6, weight=1)
+    root.mainloop()
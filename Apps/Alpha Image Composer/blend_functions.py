@@ -1,6 +1,7 @@
 # blend_functions.py
 import numpy as np
 from PIL import Image, ImageChops
+from blend_kernels import blend_arrays
 
 def blend_normal(base, overlay):
     """
@@ -9,46 +10,23 @@ def blend_normal(base, overlay):
     """
     return Image.alpha_composite(base, overlay)
 
+def _blend(base, overlay, mode):
+    """Runs a blend_kernels mode on two same-size RGBA images and returns a new RGBA image."""
+    return Image.fromarray(blend_arrays(np.asarray(base), np.asarray(overlay), mode), mode="RGBA")
+
 def blend_screen(base, overlay):
     """
     Blends two RGBA images using the screen blend mode.
     
-    Both images are converted to numpy arrays scaled to [0,1]. Their RGB channels are
-    premultiplied by the alpha channel, and then the screen blend formula is applied:
+    The RGB channels are premultiplied by the alpha channel, and then the screen blend
+    formula is applied:
     
         screen_rgb = 1 - (1 - base_rgb) * (1 - overlay_rgb)
     
     Then the result is interpolated with the overlay's alpha and the composite alpha is 
     computed using the source-over rule. Finally, the blended result is unpremultiplied.
     """
-    # Convert images to float arrays (range [0,1])
-    base_arr = np.array(base).astype(np.float32) / 255.0
-    overlay_arr = np.array(overlay).astype(np.float32) / 255.0
-
-    # Extract alpha channels (shape: H x W x 1)
-    base_alpha = base_arr[..., 3:4]
-    overlay_alpha = overlay_arr[..., 3:4]
-
-    # Premultiply the RGB channels.
-    base_rgb = base_arr[..., :3] * base_alpha
-    overlay_rgb = overlay_arr[..., :3] * overlay_alpha
-
-    # Compute the screen blend in premultiplied space.
-    screen_rgb = 1.0 - (1.0 - base_rgb) * (1.0 - overlay_rgb)
-    # Interpolate using the overlay's alpha.
-    blended_rgb = base_rgb + (screen_rgb - base_rgb) * overlay_alpha
-
-    # Compute the composite alpha using the source-over formula.
-    blended_alpha = overlay_alpha + base_alpha * (1.0 - overlay_alpha)
-
-    # Unpremultiply: divide the RGB by the composite alpha (where nonzero).
-    with np.errstate(divide="ignore", invalid="ignore"):
-        out_rgb = np.where(blended_alpha == 0, 0, blended_rgb / blended_alpha)
-
-    # Reassemble the RGBA image.
-    final_arr = np.concatenate([out_rgb, blended_alpha], axis=-1)
-    final_arr = (np.clip(final_arr, 0, 1) * 255).astype(np.uint8)
-    return Image.fromarray(final_arr, mode="RGBA")
+    return _blend(base, overlay, "screen")
 
 def blend_multiply(base, overlay):
     """
@@ -58,26 +36,34 @@ def blend_multiply(base, overlay):
     according to the overlay's alpha. The composite alpha is computed using source-over,
     and the result is unpremultiplied.
     """
-    base_arr = np.array(base).astype(np.float32) / 255.0
-    overlay_arr = np.array(overlay).astype(np.float32) / 255.0
-
-    base_alpha = base_arr[..., 3:4]
-    overlay_alpha = overlay_arr[..., 3:4]
+    return _blend(base, overlay, "multiply")
 
-    base_rgb = base_arr[..., :3] * base_alpha
-    overlay_rgb = overlay_arr[..., :3] * overlay_alpha
+def blend_overlay(base, overlay):
+    """
+    Blends two RGBA images using the overlay blend mode: multiply where the base is dark,
+    screen where it is light (2 * b * o for b <= 0.5, else 1 - 2 * (1 - b) * (1 - o)).
+    Interpolation, alpha and unpremultiplying work as in blend_screen.
+    """
+    return _blend(base, overlay, "overlay")
 
-    multiplied_rgb = base_rgb * overlay_rgb
-    blended_rgb = base_rgb + (multiplied_rgb - base_rgb) * overlay_alpha
+def blend_soft_light(base, overlay):
+    """
+    Blends two RGBA images using the soft light blend mode (the W3C formula): the overlay
+    gently darkens or lightens the base depending on whether it is below or above 0.5.
+    """
+    return _blend(base, overlay, "soft_light")
 
-    blended_alpha = overlay_alpha + base_alpha * (1.0 - overlay_alpha)
+def blend_lighten(base, overlay):
+    """Blends two RGBA images keeping the lighter of the two colours per channel."""
+    return _blend(base, overlay, "lighten")
 
-    with np.errstate(divide="ignore", invalid="ignore"):
-        out_rgb = np.where(blended_alpha == 0, 0, blended_rgb / blended_alpha)
+def blend_darken(base, overlay):
+    """Blends two RGBA images keeping the darker of the two colours per channel."""
+    return _blend(base, overlay, "darken")
 
-    final_arr = np.concatenate([out_rgb, blended_alpha], axis=-1)
-    final_arr = (np.clip(final_arr, 0, 1) * 255).astype(np.uint8)
-    return Image.fromarray(final_arr, mode="RGBA")
+def blend_difference(base, overlay):
+    """Blends two RGBA images using the absolute difference of their colours."""
+    return _blend(base, overlay, "difference")
 
 if __name__ == "__main__":
     # Example usage if run as a standalone script.
@@ -0,0 +1,414 @@
+# blend_kernels.py
+# Blend maths shared by blend_functions.py (main.py's actions) and composer_engine.py (alpha_composer.py).
+# Every kernel writes into caller-provided buffers with out= ufuncs, so blending a layer allocates
+# nothing once a frame's buffers exist.
+import numpy as np
+
+class BlendScratch:
+    """Work buffers for blending an H x W region: two float32 RGB planes, an alpha plane and a mask."""
+
+    def __init__(self, height, width):
+        self.rgb = np.empty((height, width, 3), dtype=np.float32)
+        self.tmp = np.empty((height, width, 3), dtype=np.float32)
+        self.alpha = np.empty((height, width, 1), dtype=np.float32)
+        self.mask = np.empty((height, width, 3), dtype=bool)
+
+    def rows(self, n):
+        """A view of the first n rows, for strips shorter than the buffers."""
+        view = BlendScratch.__new__(BlendScratch)
+        view.rgb, view.tmp, view.alpha, view.mask = self.rgb[:n], self.tmp[:n], self.alpha[:n], self.mask[:n]
+        return view
+
+class BlendBuffers:
+    """
+    float32 copies of both layers plus scratch planes: everything blend_arrays needs for an
+    H x W region. Callers that blend many layers of one size keep one and pass it in.
+    """
+
+    def __init__(self, height, width):
+        self.shape = (height, width)
+        self.base = np.empty((height, width, 4), dtype=np.float32)
+        self.layer = np.empty((height, width, 4), dtype=np.float32)
+        self.scratch = BlendScratch(height, width)
+
+    def rows(self, n):
+        """A view of the first n rows, for strips shorter than the buffers."""
+        view = BlendBuffers.__new__(BlendBuffers)
+        view.shape = (n, self.shape[1])
+        view.base, view.layer, view.scratch = self.base[:n], self.layer[:n], self.scratch.rows(n)
+        return view
+
+# ---------------- Mode Functions ----------------
+# Each takes premultiplied base and layer colour (b, l), writes the mode's colour into out and may
+# use scratch.tmp / scratch.mask. Interpolated modes are then mixed as b + (f - b) * layer_alpha.
+
+def _screen(b, l, out, scratch):
+    np.subtract(1.0, b, out=out)
+    np.subtract(1.0, l, out=scratch.tmp)
+    out *= scratch.tmp
+    np.subtract(1.0, out, out=out)
+
+def _multiply(b, l, out, scratch):
+    np.multiply(b, l, out=out)
+
+def _overlay(b, l, out, scratch):
+    # 2bl where b <= 0.5, else 1 - 2(1 - b)(1 - l) == 2(b + l) - 2bl - 1
+    np.multiply(b, l, out=out)
+    out *= 2.0
+    np.add(b, l, out=scratch.tmp)
+    scratch.tmp *= 2.0
+    scratch.tmp -= out
+    scratch.tmp -= 1.0
+    np.greater(b, 0.5, out=scratch.mask)
+    np.copyto(out, scratch.tmp, where=scratch.mask)
+
+def _soft_light(b, l, out, scratch):
+    # W3C soft light: b + (2l - 1) * g, with g = b(1 - b) where l <= 0.5, else D(b) - b and
+    # D(b) = ((16b - 12)b + 4)b for b <= 0.25, sqrt(b) above.
+    tmp, mask = scratch.tmp, scratch.mask
+    np.multiply(b, 16.0, out=tmp)
+    tmp -= 12.0
+    tmp *= b
+    tmp += 4.0
+    tmp *= b
+    np.sqrt(b, out=out)
+    np.less_equal(b, 0.25, out=mask)
+    np.copyto(out, tmp, where=mask)
+    out -= b
+    np.subtract(1.0, b, out=tmp)
+    tmp *= b
+    np.less_equal(l, 0.5, out=mask)
+    np.copyto(out, tmp, where=mask)
+    np.multiply(l, 2.0, out=tmp)
+    tmp -= 1.0
+    out *= tmp
+    out += b
+
+def _lighten(b, l, out, scratch):
+    np.maximum(b, l, out=out)
+
+def _darken(b, l, out, scratch):
+    np.minimum(b, l, out=out)
+
+def _difference(b, l, out, scratch):
+    np.subtract(b, l, out=out)
+    np.abs(out, out=out)
+
+# Direct modes write the blended colour itself (out may be b).
+
+def _normal(b, l, layer_alpha, out, scratch):
+    np.subtract(1.0, layer_alpha, out=scratch.alpha)
+    np.multiply(b, scratch.alpha, out=out)
+    out += l
+
+def _product(b, l, layer_alpha, out, scratch):
+    np.multiply(b, l, out=out)
+
+def _add(b, l, layer_alpha, out, scratch):
+    np.add(b, l, out=out)
+    np.clip(out, 0, 1, out=out)
+
+def _subtract(b, l, layer_alpha, out, scratch):
+    np.subtract(b, l, out=out)
+    np.clip(out, 0, 1, out=out)
+
+INTERPOLATED_MODES = {
+    "screen": _screen,
+    "multiply": _multiply,
+    "overlay": _overlay,
+    "soft_light": _soft_light,
+    "lighten": _lighten,
+    "darken": _darken,
+    "difference": _difference,
+}
+DIRECT_MODES = {
+    "normal": _normal,
+    # The composer's multiply: a straight product of premultiplied colour, not mixed by layer alpha.
+    "product": _product,
+    "add": _add,
+    "subtract": _subtract,
+}
+MODES = tuple(DIRECT_MODES) + tuple(INTERPOLATED_MODES)
+
+def blend_rgb(mode, b, l, layer_alpha, out, scratch):
+    """Writes the premultiplied colour of layer (l, straight layer_alpha) blended onto b into out (may be b)."""
+    direct = DIRECT_MODES.get(mode)
+    if direct is not None:
+        direct(b, l, layer_alpha, out, scratch)
+        return out
+    fn = INTERPOLATED_MODES.get(mode)
+    if fn is None:
+        raise ValueError(f"Unknown blend mode '{mode}'.")
+    fn(b, l, scratch.rgb, scratch)
+    scratch.rgb -= b
+    scratch.rgb *= layer_alpha
+    np.add(b, scratch.rgb, out=out)
+    return out
+
+# ---------------- Premultiplied Float ----------------
+def blend_premultiplied(comp, layer, mode, scratch):
+    """
+    Blends a premultiplied float32 RGBA layer into the premultiplied composite comp in place.
+    scratch is a BlendScratch of the same height and width.
+    """
+    comp_rgb, comp_alpha = comp[..., :3], comp[..., 3:4]
+    layer_rgb, layer_alpha = layer[..., :3], layer[..., 3:4]
+    if mode == "screen":
+        # b + (screen - b) * a  ==  b + l * (1 - b) * a, in three passes instead of five.
+        np.subtract(1.0, comp_rgb, out=scratch.rgb)
+        scratch.rgb *= layer_rgb
+        scratch.rgb *= layer_alpha
+        comp_rgb += scratch.rgb
+    else:
+        blend_rgb(mode, comp_rgb, layer_rgb, layer_alpha, comp_rgb, scratch)
+    comp_alpha *= 1.0 - layer_alpha
+    comp_alpha += layer_alpha
+    # Straight colour is clipped to 1, i.e. premultiplied colour to alpha.
+    np.minimum(comp_rgb, comp_alpha, out=comp_rgb)
+    return comp
+
+# ---------------- Straight 8-bit ----------------
+def blend_arrays(base, layer, mode, out=None, buffers=None, fixed_point=False):
+    """
+    Blends two straight-alpha H x W x 4 uint8 RGBA arrays and returns the uint8 result (written to
+    out when given). Colour is premultiplied, blended, mixed by the source-over alpha and
+    unpremultiplied, then truncated to 8 bits. buffers is an optional BlendBuffers of at least
+    the arrays' size to reuse between calls; without one the planes are allocated for this call.
+    fixed_point runs the same blend in integer arithmetic on small row bands (see
+    _blend_arrays_fixed): it is several times faster and within one level of the float result.
+    """
+    height, width = base.shape[:2]
+    if out is None:
+        out = np.empty((height, width, 4), dtype=np.uint8)
+    if fixed_point:
+        return _blend_arrays_fixed(base, layer, mode, out)
+    if buffers is None:
+        buffers = BlendBuffers(height, width)
+    elif buffers.shape[0] != height:
+        buffers = buffers.rows(height)
+
+    b, l, scratch = buffers.base, buffers.layer, buffers.scratch
+    np.copyto(b, base)
+    b /= 255.0
+    np.copyto(l, layer)
+    l /= 255.0
+    b_rgb, b_alpha = b[..., :3], b[..., 3:4]
+    l_rgb, l_alpha = l[..., :3], l[..., 3:4]
+    b_rgb *= b_alpha
+    l_rgb *= l_alpha
+
+    blend_rgb(mode, b_rgb, l_rgb, l_alpha, b_rgb, scratch)
+    np.subtract(1.0, l_alpha, out=scratch.alpha)
+    scratch.alpha *= b_alpha
+    np.add(l_alpha, scratch.alpha, out=b_alpha)
+
+    # Where the result alpha is 0 both inputs were transparent, so the colour is already 0 in every
+    # mode and dividing by a tiny alpha keeps it 0 without a masked divide.
+    np.maximum(b_alpha, np.finfo(np.float32).tiny, out=scratch.alpha)
+    b_rgb /= scratch.alpha
+    np.clip(b, 0, 1, out=b)
+    b *= 255
+    np.copyto(out, b, casting="unsafe")
+    return out
+
+# ---------------- Fixed Point ----------------
+# The fixed-point path keeps premultiplied colour as colour * alpha, i.e. in units of 1 / 65025,
+# so nothing is lost to an 8-bit premultiply before the final unpremultiply. Bands are planar
+# (3 x rows x width) uint32 so every pass is a contiguous integer ufunc; signed steps run on int32
+# views of the same planes.
+FIXED_ONE = 255 * 255
+FIXED_BAND_PIXELS = 1 << 16
+
+class FixedPlanes:
+    """uint32 work planes for one band of the fixed-point blend."""
+
+    def __init__(self, rows, width):
+        shape = (3, rows, width)
+        self.base = np.empty(shape, dtype=np.uint32)
+        self.layer = np.empty(shape, dtype=np.uint32)
+        self.blend = np.empty(shape, dtype=np.uint32)
+        self.tmp = np.empty(shape, dtype=np.uint32)
+        self.spare = np.empty(shape, dtype=np.float32)
+        self.mask = np.empty(shape, dtype=bool)
+        self.base_alpha = np.empty((rows, width), dtype=np.uint32)
+        self.layer_alpha = np.empty((rows, width), dtype=np.uint32)
+        self.alpha = np.empty((rows, width), dtype=np.uint32)
+
+    def rows(self, n):
+        """A view of the first n rows, for the last band of a frame."""
+        view = FixedPlanes.__new__(FixedPlanes)
+        for name in ("base", "layer", "blend", "tmp", "spare", "mask"):
+            setattr(view, name, getattr(self, name)[:, :n])
+        for name in ("base_alpha", "layer_alpha", "alpha"):
+            setattr(view, name, getattr(self, name)[:n])
+        return view
+
+def _div255(x, tmp):
+    """x = x / 255 in place, rounded down to within one, via (x + (x >> 8) + (x >> 16) + 1) >> 8."""
+    np.right_shift(x, 8, out=tmp)
+    x += tmp
+    tmp >>= 8
+    x += tmp
+    x += 1
+    x >>= 8
+
+def _fixed_product(a, b, out, tmp):
+    """out = a * b / 65025 for a, b in 0..65025 (the product fits uint32)."""
+    np.multiply(a, b, out=out)
+    _div255(out, tmp)
+    _div255(out, tmp)
+
+def _signed(x):
+    return x.view(np.int32)
+
+# Fixed-point mode functions mirror the float ones: b and l are premultiplied colour in 1/65025
+# units, out receives the mode's colour and planes supplies tmp / spare / mask.
+
+def _fixed_screen(b, l, out, planes):
+    _fixed_product(b, l, planes.tmp, out)
+    np.add(b, l, out=out)
+    out -= planes.tmp
+
+def _fixed_multiply(b, l, out, planes):
+    _fixed_product(b, l, out, planes.tmp)
+
+def _fixed_overlay(b, l, out, planes):
+    tmp = planes.tmp
+    _fixed_product(b, l, out, tmp)
+    out += out
+    np.add(b, l, out=tmp)
+    tmp += tmp
+    tmp -= out
+    tmp -= FIXED_ONE
+    np.greater(b, FIXED_ONE // 2, out=planes.mask)
+    np.copyto(out, tmp, where=planes.mask)
+
+def _fixed_soft_light(b, l, out, planes):
+    tmp, mask = planes.tmp, planes.mask
+    # D(b) - b, D(b) = ((16b - 12)b + 4)b for b <= 0.25, sqrt(b) above; the square root is taken in float32.
+    spare = planes.spare.view(np.uint32)
+    _fixed_product(b, b, tmp, spare)
+    tmp *= 16
+    np.multiply(b, 12, out=out)
+    tmp -= out
+    tmp += 4 * FIXED_ONE
+    tmp *= b
+    _div255(tmp, out)
+    _div255(tmp, out)
+    root = planes.spare
+    np.copyto(root, b)
+    np.sqrt(root, out=root)
+    root *= 255
+    np.copyto(out, root, casting="unsafe")
+    np.less_equal(b, FIXED_ONE // 4, out=mask)
+    np.copyto(out, tmp, where=mask)
+    out -= b
+    # b(1 - b) where l <= 0.5
+    np.subtract(FIXED_ONE, b, out=tmp)
+    _fixed_product(tmp, b, tmp, spare)
+    np.less_equal(l, FIXED_ONE // 2, out=mask)
+    np.copyto(out, tmp, where=mask)
+    np.add(l, l, out=tmp)
+    tmp -= FIXED_ONE
+    signed_out = _signed(out)
+    signed_out *= _signed(tmp)
+    _div255(signed_out, _signed(tmp))
+    _div255(signed_out, _signed(tmp))
+    out += b
+
+def _fixed_lighten(b, l, out, planes):
+    np.maximum(b, l, out=out)
+
+def _fixed_darken(b, l, out, planes):
+    np.minimum(b, l, out=out)
+
+def _fixed_difference(b, l, out, planes):
+    np.subtract(b, l, out=out)
+    np.abs(_signed(out), out=_signed(out))
+
+# Direct modes write the blended colour into b.
+
+def _fixed_normal(b, l, planes):
+    np.subtract(255, planes.layer_alpha, out=planes.alpha)
+    b *= planes.alpha
+    _div255(b, planes.tmp)
+    b += l
+
+def _fixed_product_mode(b, l, planes):
+    _fixed_product(b, l, b, planes.tmp)
+
+def _fixed_add(b, l, planes):
+    b += l
+    np.minimum(b, FIXED_ONE, out=b)
+
+def _fixed_subtract(b, l, planes):
+    b -= l
+    np.maximum(_signed(b), 0, out=_signed(b))
+
+FIXED_INTERPOLATED_MODES = {
+    "screen": _fixed_screen,
+    "multiply": _fixed_multiply,
+    "overlay": _fixed_overlay,
+    "soft_light": _fixed_soft_light,
+    "lighten": _fixed_lighten,
+    "darken": _fixed_darken,
+    "difference": _fixed_difference,
+}
+FIXED_DIRECT_MODES = {
+    "normal": _fixed_normal,
+    "product": _fixed_product_mode,
+    "add": _fixed_add,
+    "subtract": _fixed_subtract,
+}
+
+def _blend_band_fixed(base, layer, mode, out, planes):
+    b, l, tmp = planes.base, planes.layer, planes.tmp
+    b_alpha, l_alpha, alpha = planes.base_alpha, planes.layer_alpha, planes.alpha
+    np.copyto(b_alpha, base[..., 3])
+    np.copyto(l_alpha, layer[..., 3])
+    np.copyto(b, base[..., :3].transpose(2, 0, 1))
+    b *= b_alpha
+    np.copyto(l, layer[..., :3].transpose(2, 0, 1))
+    l *= l_alpha
+
+    direct = FIXED_DIRECT_MODES.get(mode)
+    if direct is not None:
+        direct(b, l, planes)
+    else:
+        f = planes.blend
+        FIXED_INTERPOLATED_MODES[mode](b, l, f, planes)
+        f -= b
+        signed_f = _signed(f)
+        signed_f *= _signed(l_alpha)
+        _div255(signed_f, _signed(tmp))
+        b += f
+
+    # Result alpha in 1/65025 units: la * 255 + ba * (255 - la).
+    np.subtract(255, l_alpha, out=alpha)
+    alpha *= b_alpha
+    np.multiply(l_alpha, 255, out=tmp[0])
+    alpha += tmp[0]
+    # Clipping colour to [0, alpha] is the float path's clip of straight colour to [0, 1].
+    np.clip(_signed(b), 0, _signed(alpha), out=_signed(b))
+    b *= 255
+    np.maximum(alpha, 1, out=tmp[0])
+    np.floor_divide(b, tmp[0], out=b)
+    np.copyto(out[..., :3], b.transpose(1, 2, 0), casting="unsafe")
+    np.floor_divide(alpha, 255, out=alpha)
+    np.copyto(out[..., 3], alpha, casting="unsafe")
+
+def _blend_arrays_fixed(base, layer, mode, out):
+    """
+    blend_arrays in integer arithmetic, FIXED_BAND_PIXELS at a time so the work planes stay in
+    cache. Products are rescaled with shifts (_div255); the only divide is the final unpremultiply.
+    """
+    if mode not in FIXED_DIRECT_MODES and mode not in FIXED_INTERPOLATED_MODES:
+        raise ValueError(f"Unknown blend mode '{mode}'.")
+    height, width = base.shape[:2]
+    band = max(1, min(height, FIXED_BAND_PIXELS // max(1, width)))
+    planes = FixedPlanes(band, width)
+    for y0 in range(0, height, band):
+        y1 = min(height, y0 + band)
+        _blend_band_fixed(base[y0:y1], layer[y0:y1], mode,
+                          out[y0:y1], planes if y1 - y0 == band else planes.rows(y1 - y0))
+    return out
@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import PIL
+from PIL import Image
+from composer_engine import (BLEND_MODES, INFO, adjust_gamma, apply_transformations, blend_images, run_composite, set_opacity)
+
+# Equirect sizes (2:1) the composer is normally run at.
+SIZES = {
+    "2k": (2048, 1024),
+    "4k": (4096, 2048),
+    "8k": (8192, 4096),
+}
+ROLL_FLIP = [
+    {"match": "bench", "action": "roll", "params": {"x_offset": "512", "y_offset": "0"}},
+    {"match": "bench", "action": "flip", "params": {"direction": "horizontal"}},
+    {"match": "bench", "action": "roll", "params": {"x_offset": "-128", "y_offset": "64"}},
+]
+ROTATE = [{"match": "bench", "action": "rotate", "params": {"angle": "90"}}]
+
+def synthetic_layer(width, height, seed):
+    """A noisy RGBA gradient with a varying alpha, so no blend or LUT pass hits a trivial case."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    arr = np.empty((height, width, 4), dtype=np.uint8)
+    arr[..., 0] = x
+    arr[..., 1] = y
+    arr[..., 2] = (x + y) / 2
+    arr[..., 3] = 255 - y / 2
+    arr ^= rng.integers(0, 32, size=arr.shape, dtype=np.uint8)
+    return Image.fromarray(arr, mode="RGBA")
+
+def time_call(fn, repeat, setup=None):
+    """Runs fn(setup()) repeat times, timing only fn. Returns the list of seconds."""
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg)
+        times.append(time.perf_counter() - start)
+    return times
+
+def summarize(name, size_name, width, height, times):
+    best = min(times)
+    pixels = width * height
+    return {
+        "name": name,
+        "size": size_name,
+        "width": width,
+        "height": height,
+        "repeat": len(times),
+        "min_s": round(best, 6),
+        "median_s": round(statistics.median(times), 6),
+        "mean_s": round(statistics.mean(times), 6),
+        "mpix_per_s": round(pixels / best / 1e6, 3) if best > 0 else None,
+    }
+
+def bench_functions(size_name, width, height, repeat, report):
+    """Times the helper functions on one pair of synthetic layers."""
+    base = synthetic_layer(width, height, 1)
+    layer = synthetic_layer(width, height, 2)
+
+    # The engine's own mode names are passed through; results are labelled in lower case.
+    for mode in BLEND_MODES:
+        name = f"blend_images:{mode.lower()}"
+        times = time_call(lambda _: blend_images(base, layer, mode), repeat)
+        report(summarize(name, size_name, width, height, times))
+        if mode.lower() != "normal":
+            times = time_call(lambda _: blend_images(base, layer, mode, fixed_point=True), repeat)
+            report(summarize(f"{name}:fixed", size_name, width, height, times))
+
+    times = time_call(lambda im: set_opacity(im, 0.7), repeat, setup=layer.copy)
+    report(summarize("set_opacity", size_name, width, height, times))
+    times = time_call(lambda _: adjust_gamma(layer, 1.4), repeat)
+    report(summarize("adjust_gamma", size_name, width, height, times))
+    times = time_call(lambda _: apply_transformations(layer, ROLL_FLIP), repeat)
+    report(summarize("apply_transformations:roll_flip", size_name, width, height, times))
+    times = time_call(lambda _: apply_transformations(layer, ROTATE), repeat)
+    report(summarize("apply_transformations:rotate", size_name, width, height, times))
+
+def write_key_sources(folder, width, height, keys):
+    """Writes base, overlay and mask layers for keys bench_0..bench_{keys-1}, as a parent/child set."""
+    for k in range(keys):
+        synthetic_layer(width, height, 10 + k).save(os.path.join(folder, f"bench_{k}_base.png"), compress_level=1)
+        synthetic_layer(width, height, 20 + k).save(os.path.join(folder, f"bench_{k}_overlay.png"), compress_level=1)
+        synthetic_layer(width, height, 30 + k).getchannel("A").save(os.path.join(folder, f"bench_{k}_mask.png"),
+                                                                     compress_level=1)
+
+def bench_layers_config():
+    """Three layers touching every per-layer step: alpha override, gamma, transforms and two blend modes."""
+    return [
+        {"name": "base", "main_constant": "_base", "main_mode": "Parent", "main_opacity": "1.0",
+         "use_alpha": False, "alpha_constant": "", "alpha_mode": "Child", "alpha_opacity": "1.0",
+         "blend_mode": "Normal", "gamma": "1.0", "transformations": []},
+        {"name": "overlay", "main_constant": "_overlay", "main_mode": "Child", "main_opacity": "0.8",
+         "use_alpha": True, "alpha_constant": "_mask", "alpha_mode": "Child", "alpha_opacity": "0.9",
+         "blend_mode": "Screen", "gamma": "1.4",
+         "transformations": [dict(t, match="overlay") for t in ROLL_FLIP]},
+        {"name": "shade", "main_constant": "_overlay", "main_mode": "Child", "main_opacity": "0.5",
+         "use_alpha": False, "alpha_constant": "", "alpha_mode": "Child", "alpha_opacity": "1.0",
+         "blend_mode": "Multiply", "gamma": "0.8", "transformations": []},
+    ]
+
+def bench_per_key(size_name, width, height, keys, output_format, float_pipeline, report):
+    """
+    Times the full per-key path the GUI worker runs (decode, resize, transform, tone, blend, encode)
+    through run_composite, with the layer cache off so every key pays for every layer.
+    """
+    work = tempfile.mkdtemp(prefix="composer_bench_")
+    try:
+        write_key_sources(work, width, height, keys)
+        params = {
+            "folder": work,
+            "export_folder": os.path.join(work, "output"),
+            "target_width": width,
+            "target_height": height,
+            "layers_config": bench_layers_config(),
+            "output_format": output_format,
+            "quality": 80,
+            "append_suffix": True,
+            "suffix_value": "_composited",
+            "preserve_structure": False,
+            "float_pipeline": float_pipeline,
+            "layer_cache_mb": 0,
+            "workers": 1,
+        }
+        results = []
+        run_composite(params, threading.Event(), lambda msg, level=INFO: None, results)
+        errors = [r["error"] for r in results if r["error"]]
+        if errors:
+            raise Exception(f"Per-key benchmark failed: {errors[0]}")
+        name = f"per_key:{output_format}" + (":float" if float_pipeline else "")
+        report(summarize(name, size_name, width, height, [r["seconds"] for r in results]))
+        report(summarize(name.replace("per_key", "encode", 1), size_name, width, height,
+                         [r["encode_seconds"] for r in results]))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+def compare(results, baseline_path):
+    """Prints min-time ratios against a previous run's JSON (ratio < 1 means faster now)."""
+    with open(baseline_path, "r") as f:
+        baseline = {(r["name"], r["size"]): r for r in json.load(f)["results"]}
+    print(f"{'benchmark':<36} {'size':<5} {'before':>10} {'after':>10} {'ratio':>7}", file=sys.stderr)
+    for r in results:
+        old = baseline.get((r["name"], r["size"]))
+        if old is None or not old["min_s"]:
+            continue
+        print(f"{r['name']:<36} {r['size']:<5} {old['min_s']:>10.4f} {r['min_s']:>10.4f} "
+              f"{r['min_s'] / old['min_s']:>7.2f}", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Alpha Image Composer hot paths on synthetic RGBA layers and emit JSON timings "
+                    "that can be compared across commits or Pillow/NumPy upgrades."
+    )
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES), help="Resolutions to run")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per helper benchmark (min/median/mean reported)")
+    parser.add_argument("--keys", type=int, default=3, help="Keys composited for each per-key benchmark")
+    parser.add_argument("--skip-per-key", action="store_true", help="Only time the helper functions")
+    parser.add_argument("--output", default=None, help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", default=None, help="Previous JSON results to print a before/after table against")
+    args = parser.parse_args()
+    if args.repeat < 1 or args.keys < 1:
+        parser.error("--repeat and --keys must be at least 1")
+
+    results = []
+    def report(result):
+        results.append(result)
+        print(f"{result['name']:<36} {result['size']:<5} min {result['min_s']:.4f}s  "
+              f"median {result['median_s']:.4f}s", file=sys.stderr)
+
+    for size_name in args.sizes:
+        width, height = SIZES[size_name]
+        bench_functions(size_name, width, height, args.repeat, report)
+        if not args.skip_per_key:
+            for output_format, float_pipeline in (("jpg", False), ("png", False), ("jpg", True)):
+                bench_per_key(size_name, width, height, args.keys, output_format, float_pipeline, report)
+
+    report_json = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeat": args.repeat,
+            "keys": args.keys,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report_json, f, indent=4)
+    else:
+        json.dump(report_json, sys.stdout, indent=4)
+        print()
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
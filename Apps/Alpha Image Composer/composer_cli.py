@@ -0,0 +1,140 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from composer_engine import INFO, PNG_STRATEGIES, print_log, run_composite, validate_layers_config
+
+def load_layers_config(config_path):
+    """Loads a layer config saved by the GUI's 'Save Config' button."""
+    with open(config_path, "r") as f:
+        layers_config = json.load(f)
+    validate_layers_config(layers_config)
+    return layers_config
+
+def run_config(config_path, args, stop_event):
+    """Runs one saved config. Returns its summary dict (timings, failures and output paths per key)."""
+    summary = {"config": config_path, "keys": 0, "completed": False, "succeeded": 0, "failed": 0,
+               "skipped": 0, "seconds": 0.0, "error": None, "results": []}
+    start = time.perf_counter()
+    try:
+        params = {
+            "folder": args.source,
+            "export_folder": args.export or os.path.join(args.source, "output"),
+            "target_width": args.width,
+            "target_height": args.height,
+            "layers_config": load_layers_config(config_path),
+            "output_format": args.format,
+            "quality": args.quality,
+            "append_suffix": args.suffix is not None,
+            "suffix_value": args.suffix or "",
+            "preserve_structure": args.preserve_structure,
+            "cache_scan": args.cache_scan,
+            "float_pipeline": args.float_pipeline,
+            "layer_cache_mb": args.layer_cache_mb,
+            "incremental": args.incremental,
+            "pipelined": args.pipelined,
+            "prefetch_depth": args.prefetch_depth,
+            "write_depth": args.write_depth,
+            "stage_processes": args.stage_processes,
+            "strip_height": args.strip_height,
+            "png_strategy": args.png_strategy,
+            "png_threads": args.png_threads,
+            "jpeg_progressive": args.jpeg_progressive,
+            "jpeg_optimize": args.jpeg_optimize,
+            "webp_lossless": args.webp_lossless,
+            "webp_method": args.webp_method,
+            "fixed_point": args.fixed_point,
+            "workers": args.workers
+        }
+        log = print_log if args.verbose else (lambda msg, level=INFO: None)
+        summary["keys"], summary["completed"] = run_composite(params, stop_event, log, summary["results"])
+    except Exception as e:
+        summary["error"] = str(e)
+    summary["seconds"] = round(time.perf_counter() - start, 4)
+    summary["failed"] = sum(1 for r in summary["results"] if r["error"])
+    summary["skipped"] = sum(1 for r in summary["results"] if r["skipped"])
+    summary["succeeded"] = len(summary["results"]) - summary["failed"] - summary["skipped"]
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run Alpha Image Composer layer configs without the GUI. Each config (as saved by the GUI's "
+                    "'Save Config' button) is composited in turn and a JSON summary of per-key timings, failures "
+                    "and output paths is written to stdout or --summary."
+    )
+    parser.add_argument("configs", nargs="+", help="Layer config JSON file(s), run back to back")
+    parser.add_argument("--source", required=True, help="Source folder containing the layer images")
+    parser.add_argument("--export", default=None, help="Export folder (default: <source>/output)")
+    parser.add_argument("--width", type=int, default=4096, help="Target width")
+    parser.add_argument("--height", type=int, default=2048, help="Target height")
+    parser.add_argument("--format", choices=["jpg", "png", "webp"], default="jpg", help="Export format")
+    parser.add_argument("--quality", type=int, default=80, help="JPEG/WebP quality, or PNG compression (0-100)")
+    parser.add_argument("--suffix", default="_composited", help="Suffix appended to output names")
+    parser.add_argument("--no-suffix", dest="suffix", action="store_const", const=None, help="Do not append a suffix")
+    parser.add_argument("--preserve-structure", action="store_true", help="Preserve the parent image directory structure")
+    parser.add_argument("--workers", type=int, default=1, help="Number of compositing processes")
+    parser.add_argument("--float-pipeline", action="store_true", help="Composite in premultiplied float32")
+    parser.add_argument("--fixed-point", action="store_true",
+                        help="Blend 8-bit layers in integer arithmetic (faster, within one level; ignored with --float-pipeline)")
+    parser.add_argument("--layer-cache-mb", type=int, default=512, help="Prepared layer cache budget in MB, shared out between the --workers processes (0 disables)")
+    parser.add_argument("--cache-scan", action="store_true", help="Reuse the saved folder scan if no directory changed")
+    parser.add_argument("--pipelined", action="store_true", help="Overlap decoding, compositing and encoding (single process)")
+    parser.add_argument("--prefetch-depth", type=int, default=2, help="Keys decoded ahead of the compositor in pipelined mode")
+    parser.add_argument("--write-depth", type=int, default=2, help="Composites queued for encoding in pipelined mode")
+    parser.add_argument("--stage-processes", type=int, default=0,
+                        help="Run pipelined decode/encode in this many processes over shared memory (0 = threads)")
+    parser.add_argument("--strip-height", type=int, default=0,
+                        help="Composite and encode this many rows at a time to bound memory (0 = full frames). "
+                             "Resized layers are resampled strip by strip, so their pixels can differ from "
+                             "full-frame output by a level or two; same-size layers are identical")
+    parser.add_argument("--png-strategy", choices=list(PNG_STRATEGIES), default="default",
+                        help="zlib strategy for PNG output (huffman and rle are much faster, slightly larger)")
+    parser.add_argument("--png-threads", type=int, default=1, help="Threads deflating each PNG (1 = Pillow's encoder)")
+    parser.add_argument("--jpeg-progressive", action="store_true", help="Write progressive JPEGs")
+    parser.add_argument("--jpeg-optimize", action="store_true", help="Optimize JPEG Huffman tables (smaller, slower)")
+    parser.add_argument("--webp-lossless", action="store_true", help="Write lossless WebP")
+    parser.add_argument("--webp-method", type=int, choices=range(7), default=4, metavar="0-6",
+                        help="WebP effort, 0 fastest to 6 smallest")
+    parser.add_argument("--incremental", action="store_true", help="Only recomposite keys whose inputs or config changed")
+    parser.add_argument("--summary", default=None, help="Write the JSON summary to this file instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="Print the per-layer log")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.source):
+        parser.error(f"Source folder not found: {args.source}")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.prefetch_depth < 1 or args.write_depth < 1:
+        parser.error("--prefetch-depth and --write-depth must be at least 1")
+    if args.stage_processes < 0:
+        parser.error("--stage-processes cannot be negative")
+    if args.strip_height < 0:
+        parser.error("--strip-height cannot be negative")
+    if args.png_threads < 1:
+        parser.error("--png-threads must be at least 1")
+
+    stop_event = threading.Event()
+    summaries = []
+    for config_path in args.configs:
+        summary = run_config(config_path, args, stop_event)
+        summaries.append(summary)
+        print(f"{config_path}: {summary['succeeded']} succeeded, {summary['failed']} failed, {summary['skipped']} skipped "
+              f"of {summary['keys']} key(s) in {summary['seconds']:.1f}s"
+              + (f" ({summary['error']})" if summary["error"] else ""), file=sys.stderr)
+
+    report = {"configs": summaries}
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    failed = any(s["error"] or s["failed"] or not s["completed"] for s in summaries)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,1858 @@
+# composer_engine.py
+# Compositing core shared by the Alpha Image Composer GUI and its worker processes.
+# Nothing in here touches Tk, so it can be imported by multiprocessing workers.
+import io
+import os
+import json
+import logging
+import hashlib
+import tempfile
+import time
+import threading
+import struct
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from PIL import Image, ImageChops
+import numpy as np
+from blend_kernels import BlendBuffers, BlendScratch, blend_arrays, blend_premultiplied
+from layer_cache import IDENTITY_TABLE, LayerCache, alpha_table, gamma_table, opacity_table
+
+# ---------------- Logging ----------------
+# Every log callable takes (msg, level=INFO). Per-layer lines are logged at DETAIL so a
+# front end can drop them; per-key and run-level lines use INFO.
+
+INFO = logging.INFO
+DETAIL = logging.DEBUG
+
+def print_log(msg, level=INFO):
+    print(msg)
+
+def _buffer_log(lines):
+    """Returns a log callable that collects (msg, level) pairs in lines."""
+    def log(msg, level=INFO):
+        lines.append((msg, level))
+    return log
+
+# ---------------- Helper Functions ----------------
+
+def set_opacity(im, opacity):
+    """Applies an opacity factor to an RGBA image."""
+    if im.mode != 'RGBA':
+        im = im.convert('RGBA')
+    im.putalpha(im.getchannel('A').point(opacity_table(opacity)))
+    return im
+
+def adjust_gamma(im, gamma):
+    """Adjusts the gamma of the image (all four channels, as before)."""
+    if gamma == 1.0:
+        return im
+    return im.point(gamma_table(gamma) * 4)
+
+def _flush_flips_and_rolls(im, flip_h, flip_v, dx, dy):
+    """Applies an accumulated wraparound roll, then the net flip, as at most two passes."""
+    dx %= im.width
+    dy %= im.height
+    if dx or dy:
+        # Same result as np.roll on both axes, done in C without NumPy copies.
+        im = ImageChops.offset(im, dx, dy)
+    if flip_h and flip_v:
+        im = im.transpose(Image.ROTATE_180)
+    elif flip_h:
+        im = im.transpose(Image.FLIP_LEFT_RIGHT)
+    elif flip_v:
+        im = im.transpose(Image.FLIP_TOP_BOTTOM)
+    return im
+
+def apply_transformations(im, transformations):
+    """
+    Applies a list of transformation dictionaries to an image.
+    Each dict should have keys:
+       - "match": transformation only applies if this equals (case-insensitively) the layer name.
+       - "action": one of "rotate", "flip", "roll"
+       - "params": a dict of parameters (collected from the UI fields).
+    Transformations are applied in order. Consecutive flips and rolls are fused into one
+    roll plus one flip (a roll after a flip equals the mirrored roll before it).
+    """
+    flip_h = flip_v = False
+    dx = dy = 0
+    for t in transformations:
+        action = t.get("action", "").lower()
+        params = t.get("params", {})
+        if action == "rotate":
+            im = _flush_flips_and_rolls(im, flip_h, flip_v, dx, dy)
+            flip_h = flip_v = False
+            dx = dy = 0
+            angle = float(params.get("angle", 0))
+            im = im.rotate(angle, expand=False)
+        elif action == "flip":
+            direction = params.get("direction", "horizontal").lower()
+            if direction == "horizontal":
+                flip_h = not flip_h
+            elif direction == "vertical":
+                flip_v = not flip_v
+        elif action == "roll":
+            x_offset = int(params.get("x_offset", 0))
+            y_offset = int(params.get("y_offset", 0))
+            dx += -x_offset if flip_h else x_offset
+            dy += -y_offset if flip_v else y_offset
+    return _flush_flips_and_rolls(im, flip_h, flip_v, dx, dy)
+
+# ---------------- File Catalogue ----------------
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+CATALOGUE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".alpha_composer", "catalogues")
+
+def scan_folder(folder):
+    """
+    Walks folder once with os.scandir, in the same order as os.walk.
+    Returns (entries, dir_mtimes): entries is a list of (lowercase base name, path)
+    for every image file, dir_mtimes maps each visited directory to its st_mtime_ns.
+    """
+    entries = []
+    dir_mtimes = {}
+    stack = [folder]
+    while stack:
+        top = stack.pop()
+        subdirs = []
+        try:
+            dir_mtimes[top] = os.stat(top).st_mtime_ns
+            with os.scandir(top) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        # Like os.walk(followlinks=False): list linked dirs but don't descend.
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        base, _ = os.path.splitext(entry.name)
+                        entries.append((base.lower(), os.path.join(top, entry.name)))
+        except OSError:
+            continue
+        stack.extend(reversed(subdirs))
+    return entries, dir_mtimes
+
+def _catalogue_cache_path(folder, cache_dir):
+    digest = hashlib.sha1(os.path.abspath(folder).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"{digest}.json")
+
+def _load_cached_catalogue(cache_path, folder):
+    try:
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+        if cached.get("folder") != os.path.abspath(folder):
+            return None
+        # Adding, removing or renaming a file or sub folder bumps its parent directory's mtime.
+        for dir_path, mtime in cached["dir_mtimes"].items():
+            if os.stat(dir_path).st_mtime_ns != mtime:
+                return None
+        return [tuple(entry) for entry in cached["entries"]]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def get_file_catalogue(folder, cache_dir=None, log=print_log):
+    """
+    Returns the image catalogue of folder (see scan_folder).
+    With a cache_dir, a catalogue saved by a previous run is reused as long as no
+    directory mtime under folder has changed, so unchanged shares are not rescanned.
+    """
+    cache_path = None
+    if cache_dir:
+        cache_path = _catalogue_cache_path(folder, cache_dir)
+        entries = _load_cached_catalogue(cache_path, folder)
+        if entries is not None:
+            log(f"Reusing cached folder scan ({len(entries)} image(s)).")
+            return entries
+    entries, dir_mtimes = scan_folder(folder)
+    log(f"Scanned source folder: {len(entries)} image(s) in {len(dir_mtimes)} folder(s).")
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path, "w") as f:
+                json.dump({"folder": os.path.abspath(folder), "dir_mtimes": dir_mtimes, "entries": entries}, f)
+        except OSError as e:
+            log(f"Could not save folder scan cache: {e}")
+    return entries
+
+def build_exact_dict(folder, constant, catalogue=None):
+    if catalogue is None:
+        catalogue, _ = scan_folder(folder)
+    d = {}
+    constant = constant.lower()
+    if not constant:
+        return d
+    for base_lower, path in catalogue:
+        if base_lower.endswith(constant):
+            d[base_lower[:-len(constant)]] = path
+    return d
+
+def build_mapping(folder, constant, catalogue=None):
+    if catalogue is None:
+        catalogue, _ = scan_folder(folder)
+    mapping = {}
+    constant = constant.lower()
+    for base_lower, path in catalogue:
+        if constant and base_lower.endswith(constant):
+            key = base_lower[:-len(constant)]
+        else:
+            key = base_lower
+        mapping[key] = path
+    return mapping
+
+def find_best_match(parent_key, mapping):
+    best_path = None
+    best_length = 0
+    for key, path in mapping.items():
+        if key in parent_key and len(key)>best_length:
+            best_path = path
+            best_length = len(key)
+    return best_path
+
+class MatchIndex:
+    """
+    Aho-Corasick automaton over the keys of a build_mapping dict.
+    find_best_match returns the same winner as the module-level find_best_match
+    (longest key contained in the parent key, earliest mapping entry on ties) in a
+    single pass over the parent key instead of a scan of every mapping key.
+    """
+
+    def __init__(self, mapping):
+        self.paths = list(mapping.values())
+        self.lengths = []
+        self.goto = [{}]
+        self.fail = [0]
+        self.best = [-1]  # index of the best key ending at this node, following fail links
+        for order, key in enumerate(mapping.keys()):
+            self.lengths.append(len(key))
+            if not key:
+                continue  # the linear scan never picks an empty key
+            node = 0
+            for ch in key:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(-1)
+                node = nxt
+            self.best[node] = order
+        # Breadth-first pass to set fail links; a node's own key is always longer than any on its fail chain.
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            if self.best[node] == -1:
+                self.best[node] = self.best[self.fail[node]]
+            for ch, child in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0)
+                queue.append(child)
+
+    def find_best_match(self, parent_key):
+        goto, fail, best, lengths = self.goto, self.fail, self.best, self.lengths
+        node = 0
+        winner = -1
+        for ch in parent_key:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            order = best[node]
+            if order != -1 and (winner == -1 or lengths[order] > lengths[winner]
+                                or (lengths[order] == lengths[winner] and order < winner)):
+                winner = order
+        return self.paths[winner] if winner != -1 else None
+
+def apply_alpha_override(main_image, alpha_image, opacity):
+    if main_image.size != alpha_image.size:
+        alpha_image = alpha_image.resize(main_image.size, Image.LANCZOS)
+    new_alpha = alpha_image.point(opacity_table(opacity))
+    main_image.putalpha(new_alpha)
+    return main_image
+
+def get_default_alpha(width, height):
+    return Image.new('L', (width, height), 255)
+
+def get_default_bottom(width, height):
+    return Image.new('RGBA', (width, height), (255,255,255,255))
+
+# Blend modes offered by the GUI, and the blend_kernels mode each one runs. The composer's Multiply
+# is the plain product of premultiplied colour (not mixed by layer alpha like the other modes).
+BLEND_MODES = ["Normal", "Multiply", "Screen", "Add", "Subtract",
+               "Overlay", "Soft Light", "Lighten", "Darken", "Difference"]
+_KERNEL_MODES = {name.lower(): name.lower().replace(" ", "_") for name in BLEND_MODES}
+_KERNEL_MODES["multiply"] = "product"
+
+def kernel_mode(blend_mode):
+    """The blend_kernels mode for a layer's blend_mode setting (case-insensitive)."""
+    try:
+        return _KERNEL_MODES[blend_mode.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown blend mode '{blend_mode}'.")
+
+def blend_images(base, layer, blend_mode, fixed_point=False, buffers=None):
+    """Blends layer onto base (RGBA images). buffers is an optional BlendBuffers reused between calls."""
+    if blend_mode.lower()=="normal":
+        return Image.alpha_composite(base, layer)
+    blended = blend_arrays(np.asarray(base), np.asarray(layer), kernel_mode(blend_mode),
+                           buffers=buffers, fixed_point=fixed_point)
+    return Image.fromarray(blended, mode="RGBA")
+
+# ---------------- Layer Resolution ----------------
+
+def build_layer_dicts(folder, layers_config, log=print_log, cache_dir=None):
+    """
+    Resolves the image paths of every layer for every parent key from a single folder scan.
+    Returns (parent_dict, main_layer_dicts, alpha_override_maps), all keyed by parent key;
+    raises ValueError on a bad config. cache_dir enables the persisted scan (see get_file_catalogue).
+    """
+    log("Building layer dictionaries...")
+    catalogue = get_file_catalogue(folder, cache_dir, log)
+
+    parent_layer = [layer for layer in layers_config if layer["main_mode"].lower()=="parent"][0]
+    parent_dict = build_exact_dict(folder, parent_layer["main_constant"], catalogue)
+    if not parent_dict:
+        raise ValueError("No images found for parent layer.")
+    log(f"Found {len(parent_dict)} parent image(s) from layer '{parent_layer['name']}'.")
+    log(f"Parent keys: {', '.join(parent_dict.keys())}\n")
+
+    # Child lookups are resolved once per constant and shared by every layer and alpha map using it.
+    child_dicts = {}
+    def resolve_child(const):
+        d = child_dicts.get(const.lower())
+        if d is None:
+            index = MatchIndex(build_mapping(folder, const, catalogue))
+            d = {}
+            for pkey in parent_dict.keys():
+                match = index.find_best_match(pkey)
+                if match:
+                    d[pkey] = match
+            child_dicts[const.lower()] = d
+        return d
+
+    main_layer_dicts = []
+    for layer in layers_config:
+        mode = layer["main_mode"].lower()
+        const = layer["main_constant"]
+        if mode=="parent":
+            main_layer_dicts.append(parent_dict)
+        elif mode=="exact":
+            main_layer_dicts.append(build_exact_dict(folder, const, catalogue))
+        elif mode=="child":
+            main_layer_dicts.append(resolve_child(const))
+        else:
+            raise ValueError(f"Invalid main mode for layer '{layer['name']}'.")
+
+    alpha_override_maps = []
+    for layer in layers_config:
+        if layer["use_alpha"]:
+            a_mode = layer["alpha_mode"].lower()
+            a_const = layer["alpha_constant"]
+            if a_mode in ("parent","exact"):
+                a_map = build_exact_dict(folder, a_const, catalogue)
+            elif a_mode=="child":
+                a_map = resolve_child(a_const)
+            else:
+                raise ValueError(f"Invalid alpha mode for layer '{layer['name']}'.")
+            alpha_override_maps.append(a_map)
+        else:
+            alpha_override_maps.append(None)
+
+    return parent_dict, main_layer_dicts, alpha_override_maps
+
+def find_common_keys(parent_dict, main_layer_dicts):
+    """Returns the parent keys available in every layer, sorted so runs are repeatable."""
+    common_keys = set(parent_dict.keys())
+    for d in main_layer_dicts:
+        common_keys = common_keys & set(d.keys())
+    return sorted(common_keys)
+
+# ---------------- Premultiplied Float Pipeline ----------------
+
+def quantize_premultiplied(comp):
+    """Unpremultiplies a float32 composite buffer in place and quantizes it to an 8-bit RGBA image."""
+    comp_rgb, comp_alpha = comp[..., :3], comp[..., 3:4]
+    np.divide(comp_rgb, comp_alpha, out=comp_rgb, where=comp_alpha > 0)
+    np.clip(comp, 0, 1, out=comp)
+    comp *= 255
+    return Image.fromarray(comp.astype(np.uint8), mode="RGBA")
+
+# ---------------- Layer Cache ----------------
+
+_layer_cache = None
+
+def get_layer_cache(job):
+    """
+    Returns this process's layer cache sized from job["layer_cache_mb"], or None when disabled.
+    Pool workers get their share of the budget (see _process_keys_parallel).
+    Strip mode never holds a whole prepared layer, so it runs without the cache.
+    """
+    global _layer_cache
+    max_bytes = int(float(job.get("layer_cache_mb", 0)) * 1024 * 1024)
+    if max_bytes <= 0 or job.get("strip_height"):
+        return None
+    if _layer_cache is None or _layer_cache.max_bytes != max_bytes:
+        _layer_cache = LayerCache(max_bytes)
+    return _layer_cache
+
+def find_shared_paths(main_layer_dicts):
+    """Returns the image paths a layer uses for more than one key; only those are worth caching."""
+    shared = set()
+    for d in main_layer_dicts:
+        seen = set()
+        for path in d.values():
+            if path in seen:
+                shared.add(path)
+            seen.add(path)
+    return shared
+
+def layer_cache_key(key, idx, job):
+    """
+    Cache key of a prepared layer: source path and mtime, target size, transformations,
+    opacity, gamma and alpha override. Returns None if the layer's image is not shared.
+    """
+    layer = job["layers_config"][idx]
+    img_path = job["main_layer_dicts"][idx].get(key)
+    if not img_path or img_path not in job.get("shared_paths", ()):
+        return None
+    override = None
+    if layer["use_alpha"]:
+        a_path = job["alpha_override_maps"][idx].get(key)
+        if a_path:
+            override = (a_path, os.stat(a_path).st_mtime_ns, layer["alpha_opacity"])
+    trans = [t for t in layer.get("transformations", []) if t.get("match", "").lower()==layer["name"].lower()]
+    return (img_path, os.stat(img_path).st_mtime_ns, job["target_width"], job["target_height"],
+            json.dumps(trans, sort_keys=True), layer["main_opacity"], _parse_gamma(layer),
+            override, bool(job.get("float_pipeline")))
+
+# ---------------- Per-Key Compositing ----------------
+
+def _parse_gamma(layer):
+    try:
+        return float(layer.get("gamma", "1.0"))
+    except:
+        return 1.0
+
+def _layer_transformations(layer):
+    trans_list = layer.get("transformations", [])
+    return [t for t in trans_list if t.get("match", "").lower()==layer["name"].lower()]
+
+def open_layer_image(key, idx, job, log=print_log):
+    """Decodes a layer's main image for key as RGBA, at its own size and untransformed."""
+    layer = job["layers_config"][idx]
+    img_path = job["main_layer_dicts"][idx].get(key)
+    if not img_path:
+        raise Exception(f"Missing main image for layer '{layer['name']}' (key: {key}).")
+    log(f"  Layer '{layer['name']}' main image: {img_path}", DETAIL)
+    return Image.open(img_path).convert("RGBA")
+
+def load_layer_image(key, idx, job, log=print_log):
+    """Opens a layer's main image for key, resized to the target size and transformed."""
+    layer = job["layers_config"][idx]
+    target_size = (job["target_width"], job["target_height"])
+    img = open_layer_image(key, idx, job, log)
+    if img.size != target_size:
+        img = img.resize(target_size, Image.LANCZOS)
+        log(f"    Resized image to {target_size[0]}x{target_size[1]}.", DETAIL)
+    filtered_trans = _layer_transformations(layer)
+    if filtered_trans:
+        img = apply_transformations(img, filtered_trans)
+        log(f"    Applied transformations: {filtered_trans}", DETAIL)
+    return img
+
+def open_alpha_override(key, idx, job, log=print_log):
+    """Decodes a layer's alpha override image for key as 'L' at its own size, or returns None."""
+    # Alpha maps are keyed by parent key in every mode (child maps are pre-resolved).
+    override_path = job["alpha_override_maps"][idx].get(key)
+    if not override_path:
+        log("    No alpha override image found; using main alpha.", DETAIL)
+        return None
+    log(f"    Alpha override image: {override_path}", DETAIL)
+    return Image.open(override_path).convert("L")
+
+def load_alpha_override(key, idx, job, log=print_log):
+    """Opens a layer's alpha override image for key as a resized 'L' image, or returns None."""
+    a_img = open_alpha_override(key, idx, job, log)
+    target_size = (job["target_width"], job["target_height"])
+    if a_img is not None and a_img.size != target_size:
+        a_img = a_img.resize(target_size, Image.LANCZOS)
+    return a_img
+
+def load_layer(key, idx, job, log=print_log):
+    """Decodes a layer's main image and alpha override (or None). Returns (img, a_img)."""
+    img = load_layer_image(key, idx, job, log)
+    a_img = load_alpha_override(key, idx, job, log) if job["layers_config"][idx]["use_alpha"] else None
+    return img, a_img
+
+def tone_layer(img, a_img, layer):
+    """
+    8-bit path: applies a layer's opacity, alpha override (a_img, or None) and gamma to img.
+    Opacity and gamma are fused into lookup tables so each channel is mapped once.
+    """
+    layer_gamma = _parse_gamma(layer)
+    rgb_table = gamma_table(layer_gamma)
+    if a_img is not None:
+        # The override replaces the main alpha, so the main opacity never reaches the output.
+        img.putalpha(a_img.point(alpha_table(float(layer["alpha_opacity"]), layer_gamma)))
+        if layer_gamma != 1.0:
+            img = img.point(rgb_table * 3 + IDENTITY_TABLE)
+        return img
+    return img.point(rgb_table * 3 + alpha_table(float(layer["main_opacity"]), layer_gamma))
+
+def tone_layer_float(img, a_img, layer, out):
+    """Float path: writes img, premultiplied and with tone_layer's adjustments, into out."""
+    np.divide(np.asarray(img), 255.0, out=out)
+    layer_alpha = out[..., 3:4]
+    layer_alpha *= float(layer["main_opacity"])
+
+    if a_img is not None:
+        # Like apply_alpha_override, the override replaces the (opacity-scaled) main alpha.
+        np.multiply(np.asarray(a_img)[..., None], float(layer["alpha_opacity"]) / 255.0, out=layer_alpha)
+
+    layer_gamma = _parse_gamma(layer)
+    if layer_gamma != 1.0:
+        # adjust_gamma works on all four channels, alpha included.
+        np.power(out, 1.0 / layer_gamma, out=out)
+
+    out[..., :3] *= layer_alpha
+    return out
+
+def _log_gamma(layer, log):
+    layer_gamma = _parse_gamma(layer)
+    if layer_gamma != 1.0:
+        log(f"    Applied gamma correction: {layer_gamma}", DETAIL)
+
+def prepare_layer(key, idx, job, log=print_log, loaded=None):
+    """
+    8-bit path: returns the layer image with opacity, alpha override and gamma applied.
+    loaded is an optional (img, a_img) pair already decoded by load_layer.
+    """
+    layer = job["layers_config"][idx]
+    img, a_img = loaded or load_layer(key, idx, job, log)
+    img = tone_layer(img, a_img, layer)
+    _log_gamma(layer, log)
+    return img
+
+def prepare_layer_float(key, idx, job, out, log=print_log, loaded=None):
+    """
+    Float path: writes the premultiplied layer, with opacity, alpha override and gamma applied, into out.
+    loaded is an optional (img, a_img) pair already decoded by load_layer.
+    """
+    layer = job["layers_config"][idx]
+    img, a_img = loaded or load_layer(key, idx, job, log)
+    tone_layer_float(img, a_img, layer, out)
+    _log_gamma(layer, log)
+    return out
+
+def composite_key(key, job, log=print_log, loaded=None):
+    """
+    Loads, prepares and blends every layer of one key. Returns the composite RGBA image.
+    loaded optionally holds each layer's pre-decoded (img, a_img) pair, or None to decode here.
+    """
+    if job.get("float_pipeline"):
+        return composite_key_float(key, job, log, loaded)
+    cache = get_layer_cache(job)
+    composite_img = None
+    # Float blend planes for this key's layers, allocated on the first float blend and dropped with the key.
+    buffers = None
+    for idx, layer in enumerate(job["layers_config"]):
+        cache_key = layer_cache_key(key, idx, job) if cache else None
+        img = cache.get(cache_key) if cache_key else None
+        if img is None:
+            img = prepare_layer(key, idx, job, log, loaded[idx] if loaded else None)
+            if cache_key:
+                cache.put(cache_key, img, img.width * img.height * 4)
+        else:
+            log(f"  Layer '{layer['name']}' main image: {cache_key[0]} (cached)", DETAIL)
+
+        blend_mode = layer["blend_mode"].lower()
+        if composite_img is None:
+            composite_img = img
+        else:
+            if buffers is None and blend_mode != "normal" and not job.get("fixed_point"):
+                buffers = BlendBuffers(job["target_height"], job["target_width"])
+            composite_img = blend_images(composite_img, img, blend_mode, job.get("fixed_point"), buffers)
+    return composite_img
+
+def composite_key_float(key, job, log=print_log, loaded=None):
+    """
+    composite_key variant that keeps the running composite as one premultiplied float32 buffer.
+    Opacity, alpha override and gamma are applied to a reused float layer buffer, and the
+    result is quantized to 8 bits only once. Output differs from the 8-bit path by rounding only.
+    """
+    shape = (job["target_height"], job["target_width"], 4)
+    comp = np.empty(shape, dtype=np.float32)
+    layer_buf = np.empty(shape, dtype=np.float32)
+    scratch = BlendScratch(*shape[:2])
+    cache = get_layer_cache(job)
+    for idx, layer in enumerate(job["layers_config"]):
+        cache_key = layer_cache_key(key, idx, job) if cache else None
+        cached = cache.get(cache_key) if cache_key else None
+        if cached is None:
+            prepare_layer_float(key, idx, job, layer_buf, log, loaded[idx] if loaded else None)
+            if cache_key:
+                cache.put(cache_key, layer_buf.copy(), layer_buf.nbytes)
+        else:
+            np.copyto(layer_buf, cached)
+            log(f"  Layer '{layer['name']}' main image: {cache_key[0]} (cached)", DETAIL)
+
+        if idx == 0:
+            comp[...] = layer_buf
+        else:
+            blend_premultiplied(comp, layer_buf, kernel_mode(layer["blend_mode"]), scratch)
+    return quantize_premultiplied(comp)
+
+def get_output_path(key, job):
+    """Builds the export path for a key, creating the sub folder when the structure is preserved."""
+    if job["append_suffix"]:
+        filename = key + job["suffix_value"]
+    else:
+        filename = key
+    ext = OUTPUT_EXTENSIONS[job["output_format"].lower()]
+    export_folder = job["export_folder"]
+    if job["preserve_structure"]:
+        parent_path = job["parent_dict"][key]
+        rel_path = os.path.relpath(parent_path, job["folder"])
+        rel_dir = os.path.dirname(rel_path)
+        final_export_folder = os.path.join(export_folder, rel_dir)
+        os.makedirs(final_export_folder, exist_ok=True)
+        return os.path.join(final_export_folder, f"{filename}{ext}")
+    return os.path.join(export_folder, f"{filename}{ext}")
+
+# ---------------- Encoding ----------------
+OUTPUT_EXTENSIONS = {"jpg": ".jpg", "png": ".png", "webp": ".webp"}
+PNG_STRATEGIES = {
+    "default": zlib.Z_DEFAULT_STRATEGY,
+    "filtered": zlib.Z_FILTERED,
+    "huffman": zlib.Z_HUFFMAN_ONLY,
+    "rle": zlib.Z_RLE,
+    "fixed": zlib.Z_FIXED,
+}
+PNG_FILTER_ROWS = 16
+
+def png_compress_level(quality):
+    return max(0, min(9, int((100-quality)/10)))
+
+def encode_options(job):
+    """Encoder settings from a job; unset ones default to what save_composite always did."""
+    return {
+        "png_strategy": job.get("png_strategy") or "default",
+        "png_threads": int(job.get("png_threads") or 1),
+        "jpeg_progressive": bool(job.get("jpeg_progressive")),
+        "jpeg_optimize": bool(job.get("jpeg_optimize")),
+        "webp_lossless": bool(job.get("webp_lossless")),
+        "webp_method": int(job.get("webp_method", 4)),
+    }
+
+def save_composite(composite_img, output_path, output_format, quality, options=None):
+    """
+    Encodes the composite as JPEG (RGB), PNG with a compress level derived from quality, or WebP.
+    options (see encode_options) selects the zlib strategy, threaded PNG deflate and the JPEG and
+    WebP toggles. Returns the seconds spent encoding.
+    """
+    options = options or encode_options({})
+    start = time.perf_counter()
+    output_format = output_format.lower()
+    if output_format=="jpg":
+        rgb = composite_img if composite_img.mode in ("RGB", "RGBX") else composite_img.convert("RGB")
+        rgb.save(output_path, quality=quality, progressive=options["jpeg_progressive"],
+                                          optimize=options["jpeg_optimize"])
+    elif output_format=="webp":
+        composite_img.save(output_path, "WEBP", quality=quality, lossless=options["webp_lossless"],
+                           method=options["webp_method"])
+    elif options["png_threads"] > 1:
+        save_png_parallel(composite_img, output_path, png_compress_level(quality),
+                          PNG_STRATEGIES[options["png_strategy"]], options["png_threads"])
+    else:
+        composite_img.save(output_path, compress_level=png_compress_level(quality),
+                           compress_type=PNG_STRATEGIES[options["png_strategy"]])
+    return time.perf_counter() - start
+
+def _png_filter_rows(rows, prev):
+    """
+    Applies PNG adaptive filtering to a block of raw RGBA scanlines (n x stride uint8), choosing per
+    row the filter with the smallest sum of absolute signed bytes. prev is the scanline above the
+    block. Returns the n x (1 + stride) filtered block, filter type byte first.
+    """
+    x = rows.astype(np.int16)
+    b = np.concatenate([prev[None].astype(np.int16), x[:-1]])
+    a = np.zeros_like(x)
+    a[:, 4:] = x[:, :-4]
+    c = np.zeros_like(x)
+    c[:, 4:] = b[:, :-4]
+    p = a + b - c
+    pa, pb, pc = np.abs(p - a), np.abs(p - b), np.abs(p - c)
+    paeth = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+    filtered = np.stack([x, x - a, x - b, x - ((a + b) >> 1), x - paeth], axis=1).astype(np.uint8)
+    signed = filtered.astype(np.int16)
+    scores = np.minimum(signed, 256 - signed).sum(axis=2)
+    choice = scores.argmin(axis=1)
+    out = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    out[:, 0] = choice
+    out[:, 1:] = filtered[np.arange(rows.shape[0]), choice]
+    return out
+
+def _png_filter_block(rows, prev):
+    """_png_filter_rows over any number of rows, a few at a time to bound the temporaries. Returns bytes."""
+    parts = []
+    for y0 in range(0, rows.shape[0], PNG_FILTER_ROWS):
+        block = rows[y0:y0 + PNG_FILTER_ROWS]
+        parts.append(_png_filter_rows(block, prev).tobytes())
+        prev = block[-1]
+    return b"".join(parts)
+
+def _png_chunk(f, tag, data):
+    f.write(struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+def _png_header(f, width, height):
+    f.write(b"\x89PNG\r\n\x1a\n")
+    _png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+
+def _adler32_combine(adler1, adler2, len2):
+    """zlib's adler32_combine, which the zlib module does not expose."""
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = rem * sum1 % base
+    sum1 = (sum1 + (adler2 & 0xffff) + base - 1) % base
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + base - rem) % base
+    return sum1 | (sum2 << 16)
+
+def _deflate_png_block(rows, prev, compress_level, strategy, last):
+    data = _png_filter_block(rows, prev)
+    deflater = zlib.compressobj(compress_level, zlib.DEFLATED, -15, 9, strategy)
+    # A sync flush ends the block byte-aligned without the final-block bit, so blocks concatenate.
+    raw = deflater.compress(data) + deflater.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return raw, zlib.adler32(data), len(data)
+
+def save_png_parallel(img, output_path, compress_level, strategy, threads):
+    """
+    Writes an RGBA PNG with filtering and deflate split across threads, pigz style: row blocks are
+    filtered and deflated independently (zlib and most NumPy work release the GIL) and the raw
+    streams are joined into one zlib stream. Files come out slightly larger than PIL's, as blocks
+    do not share a history window.
+    """
+    rows = np.asarray(img.convert("RGBA"))
+    height, width = rows.shape[:2]
+    rows = rows.reshape(height, width * 4)
+    block_rows = max(PNG_FILTER_ROWS, -(-height // (threads * 4)))
+    blank = np.zeros(width * 4, dtype=np.uint8)
+
+    def deflate(y0):
+        prev = rows[y0 - 1] if y0 else blank
+        return _deflate_png_block(rows[y0:y0 + block_rows], prev, compress_level, strategy, y0 + block_rows >= height)
+
+    with ThreadPoolExecutor(threads) as pool:
+        blocks = list(pool.map(deflate, range(0, height, block_rows)))
+    adler = 1
+    for _, block_adler, length in blocks:
+        adler = _adler32_combine(adler, block_adler, length)
+    with open(output_path, "wb") as f:
+        _png_header(f, width, height)
+        _png_chunk(f, b"IDAT", b"\x78\x9c" + b"".join(raw for raw, _, _ in blocks) + struct.pack(">I", adler))
+        _png_chunk(f, b"IEND", b"")
+
+class StripPNGWriter:
+    """
+    Streams an RGBA PNG strip by strip, deflating each strip's filtered rows as it arrives.
+    Single threaded: the deflate stream runs through the strips in order.
+    """
+    def __init__(self, path, width, height, compress_level=6, strategy=zlib.Z_DEFAULT_STRATEGY):
+        self.path = path
+        self.width, self.height = width, height
+        self.rows_written = 0
+        self.seconds = 0.0
+        self.prev = np.zeros(width * 4, dtype=np.uint8)
+        self.deflater = zlib.compressobj(compress_level, zlib.DEFLATED, 15, 9, strategy)
+        self.f = open(path, "wb")
+        _png_header(self.f, width, height)
+
+    def write(self, strip):
+        start = time.perf_counter()
+        rows = np.asarray(strip.convert("RGBA")).reshape(strip.height, self.width * 4)
+        data = self.deflater.compress(_png_filter_block(rows, self.prev))
+        if data:
+            _png_chunk(self.f, b"IDAT", data)
+        self.prev = rows[-1].copy()
+        self.rows_written += strip.height
+        self.seconds += time.perf_counter() - start
+
+    def close(self):
+        if self.rows_written != self.height:
+            raise Exception(f"PNG strip writer got {self.rows_written} of {self.height} rows.")
+        start = time.perf_counter()
+        _png_chunk(self.f, b"IDAT", self.deflater.flush())
+        _png_chunk(self.f, b"IEND", b"")
+        self.f.close()
+        self.seconds += time.perf_counter() - start
+
+    def abort(self):
+        self.f.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class StripCanvasWriter:
+    """
+    Collects strips into one canvas and hands it to save_composite on close. PIL cannot stream JPEG
+    or WebP, so the canvas is a memory-mapped temporary file next to the output: its pages belong to
+    the file cache rather than the process. The JPEG encoder reads it row by row; libwebp copies the
+    whole frame (see strip_memory_warnings).
+    """
+    def __init__(self, path, width, height, output_format, quality, options):
+        self.path = path
+        self.output_format = output_format
+        self.quality = quality
+        self.options = options
+        # RGBX and RGBA canvases share the mapped buffer; JPEG encodes RGBX as RGB.
+        mode = "RGBX" if output_format.lower()=="jpg" else "RGBA"
+        self.file = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+        self.buffer = np.memmap(self.file, dtype=np.uint8, mode="w+", shape=(height, width, 4))
+        self.canvas = Image.frombuffer(mode, (width, height), self.buffer, "raw", mode, 0, 1)
+        self.rows_written = 0
+        self.seconds = 0.0
+
+    def write(self, strip):
+        y0 = self.rows_written
+        self.buffer[y0:y0 + strip.height] = np.asarray(strip.convert(self.canvas.mode))
+        self.rows_written += strip.height
+
+    def close(self):
+        try:
+            self.seconds = save_composite(self.canvas, self.path, self.output_format, self.quality, self.options)
+        finally:
+            self._release()
+
+    def abort(self):
+        self._release()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _release(self):
+        # Drop every view of the mapping before closing (and so deleting) the file.
+        self.canvas = None
+        if self.buffer is not None:
+            self.buffer._mmap.close()
+            self.buffer = None
+        self.file.close()
+
+def open_strip_writer(output_path, width, height, output_format, quality, options=None):
+    """Strip-wise counterpart of save_composite. The writer's seconds attribute totals its encode time."""
+    options = options or encode_options({})
+    if output_format.lower()=="png":
+        return StripPNGWriter(output_path, width, height, png_compress_level(quality),
+                              PNG_STRATEGIES[options["png_strategy"]])
+    return StripCanvasWriter(output_path, width, height, output_format, quality, options)
+
+# ---------------- Strip Compositing ----------------
+def _flip_roll_plan(transformations):
+    """
+    Folds a transformation list into one (dx, dy, flip_h, flip_v), the same way apply_transformations
+    fuses flips and rolls. Returns None if the list rotates, since a rotation mixes rows.
+    """
+    flip_h = flip_v = False
+    dx = dy = 0
+    for t in transformations:
+        action = t.get("action", "").lower()
+        params = t.get("params", {})
+        if action == "rotate":
+            return None
+        elif action == "flip":
+            direction = params.get("direction", "horizontal").lower()
+            if direction == "horizontal":
+                flip_h = not flip_h
+            elif direction == "vertical":
+                flip_v = not flip_v
+        elif action == "roll":
+            x_offset = int(params.get("x_offset", 0))
+            y_offset = int(params.get("y_offset", 0))
+            dx += -x_offset if flip_h else x_offset
+            dy += -y_offset if flip_v else y_offset
+    return dx, dy, flip_h, flip_v
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+class PNGRowReader:
+    """
+    Decodes an 8-bit, non-interlaced PNG a band of rows at a time, so strip mode never holds the
+    whole image. IDAT data is inflated only as far as the rows asked for; each band is handed to
+    Pillow as a small stand-alone PNG led by the decoded row above it, so unfiltering, palettes and
+    the conversion to mode are exactly Pillow's. Bands are read top to bottom; asking for rows
+    above the current band starts again from the top of the file, unless the reader parks: then
+    every decoded band is also written to a temporary file in folder, and rows already
+    decoded are read back from there (for layers read out of order, like vertical rolls and flips).
+    """
+    CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+    READ_BYTES = 1 << 20
+    SKIP_ROWS = 256
+
+    @classmethod
+    def open(cls, path, mode, park=False, folder=None):
+        """A reader for path converting to mode, or None if path is not a PNG this reader can stream."""
+        with open(path, "rb") as f:
+            head = f.read(29)
+        if len(head) < 29 or head[:8] != PNG_SIGNATURE or head[12:16] != b"IHDR":
+            return None
+        width, height, depth, color, _, _, interlace = struct.unpack(">IIBBBBB", head[16:29])
+        if depth != 8 or interlace or color not in cls.CHANNELS:
+            return None
+        return cls(path, mode, width, height, color, park, folder)
+
+    def __init__(self, path, mode, width, height, color, park=False, folder=None):
+        self.path = path
+        self.mode = mode
+        self.size = (width, height)
+        self.color = color
+        self.stride = 1 + width * self.CHANNELS[color]
+        self.f = None
+        self._restart()
+        self.park = SpilledRows(mode, self.size, folder) if park else None
+
+    def _restart(self):
+        if self.f:
+            self.f.close()
+        self.f = open(self.path, "rb")
+        self.f.seek(8)
+        self.chunk_left = 0
+        self.palette_chunks = []
+        self.inflater = zlib.decompressobj()
+        self.raw = bytearray()   # filtered scanlines from row self.start on
+        self.start = 0
+        self.prior = None        # decoded (unfiltered) row self.start - 1
+        self.band = None         # (first row, native image) of the last band decoded
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+        if getattr(self, "park", None) is not None:
+            self.park.close()
+            self.park = None
+
+    def _next_data(self):
+        """The next piece of IDAT data, reading at most READ_BYTES of the file."""
+        while not self.chunk_left:
+            header = self.f.read(8)
+            if len(header) < 8:
+                raise Exception(f"PNG ends before its image data does: {self.path}")
+            length, tag = struct.unpack(">I4s", header)
+            if tag == b"IDAT":
+                self.chunk_left = length
+                if not length:
+                    self.f.seek(4, os.SEEK_CUR)
+            elif tag == b"IEND":
+                raise Exception(f"PNG ends before its image data does: {self.path}")
+            else:
+                data = self.f.read(length)
+                self.f.seek(4, os.SEEK_CUR)
+                # The palette and transparency are the only chunks that change decoded pixels.
+                if tag in (b"PLTE", b"tRNS"):
+                    self.palette_chunks.append((tag, data))
+        data = self.f.read(min(self.chunk_left, self.READ_BYTES))
+        if not data:
+            raise Exception(f"PNG ends before its image data does: {self.path}")
+        self.chunk_left -= len(data)
+        if not self.chunk_left:
+            self.f.seek(4, os.SEEK_CUR)
+        return data
+
+    def _fill(self, y1):
+        """Inflates scanlines up to row y1."""
+        need = (y1 - self.start) * self.stride
+        while len(self.raw) < need:
+            data = self.inflater.unconsumed_tail or self._next_data()
+            self.raw += self.inflater.decompress(data, max(need - len(self.raw), self.stride))
+
+    def _decode(self, y1):
+        """Rows self.start..y1 as a native-mode Pillow image."""
+        deflater = zlib.compressobj(0)
+        parts = []
+        lead = 0
+        if self.prior is not None:
+            # An unfiltered copy of the row above lets the band's first row be unfiltered.
+            parts.append(deflater.compress(b"\x00" + self.prior))
+            lead = 1
+        with memoryview(self.raw) as view, view[:(y1 - self.start) * self.stride] as rows:
+            parts.append(deflater.compress(rows))
+        parts.append(deflater.flush())
+        f = io.BytesIO()
+        f.write(PNG_SIGNATURE)
+        _png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", self.size[0], y1 - self.start + lead, 8, self.color, 0, 0, 0))
+        for tag, chunk in self.palette_chunks:
+            _png_chunk(f, tag, chunk)
+        crc = zlib.crc32(b"IDAT")
+        f.write(struct.pack(">I", sum(len(part) for part in parts)) + b"IDAT")
+        for part in parts:
+            f.write(part)
+            crc = zlib.crc32(part, crc)
+        f.write(struct.pack(">I", crc & 0xffffffff))
+        _png_chunk(f, b"IEND", b"")
+        f.seek(0)
+        im = Image.open(f)
+        im.load()
+        if lead:
+            im = im.crop((0, lead, im.width, im.height))
+        self.band = (self.start, im)
+        return im
+
+    def _drop(self, y0, prior):
+        del self.raw[:(y0 - self.start) * self.stride]
+        self.start = y0
+        self.prior = prior
+
+    def _advance(self, y0):
+        """Drops the scanlines above row y0, keeping the decoded row y0 - 1."""
+        first, im = self.band if self.band else (0, None)
+        if im is None or not first < y0 <= first + im.height:
+            self._fill(y0)
+            # Rows filtered with None or Sub do not refer to the row above, so decoding can start at
+            # the last of them instead of at self.start.
+            filters = self.raw[:(y0 - self.start) * self.stride:self.stride]
+            restart = max(filters.rfind(b"\x00"), filters.rfind(b"\x01"))
+            if restart > 0:
+                self._drop(self.start + restart, None)
+            first, im = self.start, self._decode(y0)
+        self._drop(y0, im.crop((0, y0 - 1 - first, im.width, y0 - first)).tobytes())
+
+    def rows(self, y0, y1):
+        """Rows y0..y1 converted to the reader's mode."""
+        if self.park is not None:
+            # Decode and park every band down to y1, then read the rows back.
+            while self.start < y1:
+                stop = min(y1, self.start + self.SKIP_ROWS)
+                self._fill(stop)
+                im = self._decode(stop)
+                self.park.append(im.convert(self.mode))
+                self._drop(stop, im.crop((0, im.height - 1, im.width, im.height)).tobytes())
+            return self.park.rows(y0, y1)
+        if y0 < self.start:
+            self._restart()
+        while self.start < y0:
+            # Rows above y0 are still unfiltered, SKIP_ROWS at a time, to carry the row above y0 along.
+            self._advance(min(y0, self.start + self.SKIP_ROWS))
+        self._fill(y1)
+        return self._decode(y1).convert(self.mode)
+
+class SpilledRows:
+    """
+    Image rows parked in a temporary file, for sources strip mode cannot stream (other formats,
+    interlaced PNGs, layers that rotate) and for PNGRowReader's parked bands. Images are appended
+    band by band and can then be released; rows(y0, y1) reads back only those rows.
+    """
+    BAND_ROWS = 256
+
+    def __init__(self, mode, size, folder=None):
+        self.mode = mode
+        self.size = size
+        self.row_bytes = size[0] * Image.getmodebands(mode)
+        self.file = tempfile.TemporaryFile(dir=folder)
+
+    @classmethod
+    def from_image(cls, img, folder=None):
+        rows = cls(img.mode, img.size, folder)
+        rows.append(img)
+        return rows
+
+    def append(self, img):
+        """Writes img's rows after those already parked."""
+        self.file.seek(0, os.SEEK_END)
+        for y0 in range(0, img.height, self.BAND_ROWS):
+            self.file.write(img.crop((0, y0, img.width, min(y0 + self.BAND_ROWS, img.height))).tobytes())
+
+    def rows(self, y0, y1):
+        self.file.seek(y0 * self.row_bytes)
+        return Image.frombytes(self.mode, (self.size[0], y1 - y0), self.file.read((y1 - y0) * self.row_bytes))
+
+    def close(self):
+        self.file.close()
+
+def open_row_source(path, mode, folder=None, in_order=True, log=print_log):
+    """
+    A PNGRowReader for path if it can be streamed (parking its bands in folder unless rows are read
+    in_order), else the whole decoded image spilled to folder.
+    """
+    reader = PNGRowReader.open(path, mode, not in_order, folder)
+    if reader is not None:
+        return reader
+    log(f"    Decoding {os.path.basename(path)} whole and parking it on disk for strips.", DETAIL)
+    return SpilledRows.from_image(Image.open(path).convert(mode), folder)
+
+def _resampled_rows(src, target_size, y0, y1):
+    """Rows y0..y1 of src resized to target_size, reading only the source rows they depend on."""
+    tw, th = target_size
+    if src.size == target_size:
+        return src.rows(y0, y1)
+    sw, sh = src.size
+    top, bottom = y0 * sh / th, y1 * sh / th
+    # Lanczos reads 3 source rows either side of each output row per unit of downscaling.
+    margin = 3 * max(sh / th, 1) + 2
+    r0 = max(0, int(top - margin))
+    r1 = min(sh, int(np.ceil(bottom + margin)))
+    return src.rows(r0, r1).resize((tw, y1 - y0), Image.LANCZOS, box=(0, top - r0, sw, bottom - r0))
+
+def _wrapped_rows(src, target_size, start, count):
+    """count resampled rows starting at start, wrapping past the bottom edge like a vertical roll."""
+    th = target_size[1]
+    start %= th
+    if start + count <= th:
+        return _resampled_rows(src, target_size, start, start + count)
+    head = th - start
+    tail = _resampled_rows(src, target_size, start, th)
+    rows = Image.new(tail.mode, (target_size[0], count))
+    rows.paste(tail, (0, 0))
+    rows.paste(_resampled_rows(src, target_size, 0, count - head), (0, head))
+    return rows
+
+class LayerStrips:
+    """
+    One layer of a key opened for strip compositing. Sources are row sources at their own size:
+    PNGs are streamed (PNGRowReader, parking decoded bands when a vertical roll or flip reads them
+    out of order), anything else is decoded once and spilled to disk (SpilledRows), so no layer
+    stays decoded in memory. strip(y0, y1) resamples only those target rows, then applies the
+    layer's flips and rolls to them. Layers that rotate are resized and transformed full frame up
+    front and spilled instead.
+    """
+    def __init__(self, key, idx, job, log=print_log):
+        layer = job["layers_config"][idx]
+        self.target_size = (job["target_width"], job["target_height"])
+        folder = job.get("export_folder")
+        filtered_trans = _layer_transformations(layer)
+        self.plan = _flip_roll_plan(filtered_trans)
+        self.image = self.alpha = None
+        if self.plan is None:
+            img = load_layer_image(key, idx, job, log)
+            self.image = SpilledRows.from_image(img, folder)
+            img = None
+            self.plan = (0, 0, False, False)
+        else:
+            img_path = job["main_layer_dicts"][idx].get(key)
+            if not img_path:
+                raise Exception(f"Missing main image for layer '{layer['name']}' (key: {key}).")
+            log(f"  Layer '{layer['name']}' main image: {img_path}", DETAIL)
+            dy, flip_v = self.plan[1], self.plan[3]
+            self.image = open_row_source(img_path, "RGBA", folder, not (dy % self.target_size[1] or flip_v), log)
+            if self.image.size != self.target_size:
+                log(f"    Resampling strips to {self.target_size[0]}x{self.target_size[1]}.", DETAIL)
+            if filtered_trans:
+                log(f"    Applied transformations: {filtered_trans}", DETAIL)
+        if layer["use_alpha"]:
+            override_path = job["alpha_override_maps"][idx].get(key)
+            if override_path:
+                log(f"    Alpha override image: {override_path}", DETAIL)
+                self.alpha = open_row_source(override_path, "L", folder, log=log)
+            else:
+                log("    No alpha override image found; using main alpha.", DETAIL)
+
+    def close(self):
+        for source in (self.image, self.alpha):
+            if source is not None:
+                source.close()
+
+    def strip(self, y0, y1):
+        """Returns the (img, a_img) rows y0..y1 of what load_layer would give for the full frame."""
+        tw, th = self.target_size
+        dx, dy, flip_h, flip_v = self.plan
+        # Output row y comes from source row y - dy, or th - 1 - y - dy once flipped vertically.
+        start = th - y1 - dy if flip_v else y0 - dy
+        img = _wrapped_rows(self.image, self.target_size, start, y1 - y0)
+        if dx % tw:
+            img = ImageChops.offset(img, dx % tw, 0)
+        if flip_h and flip_v:
+            img = img.transpose(Image.ROTATE_180)
+        elif flip_h:
+            img = img.transpose(Image.FLIP_LEFT_RIGHT)
+        elif flip_v:
+            img = img.transpose(Image.FLIP_TOP_BOTTOM)
+        a_img = _resampled_rows(self.alpha, self.target_size, y0, y1) if self.alpha is not None else None
+        return img, a_img
+
+def composite_key_strips(key, job, output_path, log=print_log):
+    """
+    composite_key + save_composite, job["strip_height"] target rows at a time: each strip is
+    resampled, toned, blended and handed to the encoder before the next one starts, so working
+    memory scales with the strip height rather than the frame (see LayerStrips for how sources are
+    read, and strip_memory_warnings for the exceptions). Returns the seconds spent encoding.
+    Where a layer is resampled, each band is resized on its own, so rows can differ slightly from
+    the full-frame resize (usually a level or two, more on high-frequency detail); same-size
+    sources give identical pixels.
+    """
+    strip_height = max(1, min(int(job["strip_height"]), job["target_height"]))
+    sources = []
+    try:
+        for idx, layer in enumerate(job["layers_config"]):
+            sources.append(LayerStrips(key, idx, job, log))
+            _log_gamma(layer, log)
+        return _composite_strips(job, sources, output_path, strip_height)
+    finally:
+        for source in sources:
+            source.close()
+
+def _composite_strips(job, sources, output_path, strip_height):
+    width, height = job["target_width"], job["target_height"]
+    float_pipeline = job.get("float_pipeline")
+    if float_pipeline:
+        comp = np.empty((strip_height, width, 4), dtype=np.float32)
+        layer_buf = np.empty_like(comp)
+        scratch = BlendScratch(strip_height, width)
+    else:
+        buffers = None if job.get("fixed_point") else BlendBuffers(strip_height, width)
+
+    writer = open_strip_writer(output_path, width, height, job["output_format"], job["quality"], encode_options(job))
+    try:
+        for y0 in range(0, height, strip_height):
+            y1 = min(y0 + strip_height, height)
+            n = y1 - y0
+            strip = None
+            for idx, layer in enumerate(job["layers_config"]):
+                img, a_img = sources[idx].strip(y0, y1)
+                blend_mode = layer["blend_mode"]
+                if float_pipeline:
+                    tone_layer_float(img, a_img, layer, layer_buf[:n])
+                    if idx == 0:
+                        comp[:n] = layer_buf[:n]
+                    else:
+                        blend_premultiplied(comp[:n], layer_buf[:n], kernel_mode(blend_mode), scratch.rows(n))
+                else:
+                    img = tone_layer(img, a_img, layer)
+                    strip = img if strip is None else blend_images(strip, img, blend_mode, job.get("fixed_point"),
+                                                                   buffers)
+            if float_pipeline:
+                strip = quantize_premultiplied(comp[:n])
+            writer.write(strip)
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    return writer.seconds
+
+def strip_memory_warnings(job):
+    """
+    Where strip mode cannot keep memory proportional to the strip height for this job:
+    one message per rotating layer, non-PNG source layer and WebP output.
+    """
+    warnings = []
+    for idx, layer in enumerate(job["layers_config"]):
+        if _flip_roll_plan(_layer_transformations(layer)) is None:
+            warnings.append(f"Strip mode: layer '{layer['name']}' rotates, so each of its images is prepared "
+                            "full frame (then parked on disk) before compositing.")
+        elif any(not path.lower().endswith(".png") for path in job["main_layer_dicts"][idx].values()):
+            warnings.append(f"Strip mode: layer '{layer['name']}' has non-PNG images, which are decoded whole, "
+                            "one at a time, and parked on disk.")
+    if job["output_format"].lower()=="webp":
+        warnings.append("Strip mode: the WebP encoder takes the whole frame, so each output is held in memory "
+                        "while it encodes. Use PNG output to keep memory bounded by the strip height.")
+    return warnings
+
+def process_key(key, job, log=print_log):
+    """
+    Composites and saves one key (strip by strip when job["strip_height"] is set).
+    Returns (output_path, encode_seconds).
+    """
+    log(f"Processing composite for key: '{key}'")
+    output_path = get_output_path(key, job)
+    if job.get("strip_height"):
+        encode_seconds = composite_key_strips(key, job, output_path, log)
+    else:
+        composite_img = composite_key(key, job, log)
+        encode_seconds = save_composite(composite_img, output_path, job["output_format"], job["quality"],
+                                        encode_options(job))
+    log(f"  Encoded in {encode_seconds:.3f}s.", DETAIL)
+    log(f"Composite for key '{key}' saved to: {output_path}\n")
+    return output_path, encode_seconds
+
+# ---------------- Process Pool ----------------
+
+def _run_key(key, job, log):
+    """Runs process_key, trapping errors. Returns a result dict (key, output_path, seconds, encode_seconds, error)."""
+    start = time.perf_counter()
+    output_path = encode_seconds = None
+    error = None
+    try:
+        output_path, encode_seconds = process_key(key, job, log)
+        encode_seconds = round(encode_seconds, 4)
+    except Exception as e:
+        error = str(e)
+        log(f"Error processing key '{key}': {e}\n")
+    return {"key": key, "output_path": output_path, "seconds": round(time.perf_counter() - start, 4),
+            "encode_seconds": encode_seconds, "error": error, "skipped": False}
+
+_worker_job = None
+
+def _init_worker(job):
+    """Pool initializer: receives the layer dictionaries once instead of with every key."""
+    global _worker_job
+    _worker_job = job
+
+def _process_key_buffered(key):
+    """
+    Runs one key in a worker, collecting log lines so the parent can print them in key order.
+    Returns (lines, result, cache_hits, cache_misses); lines holds (msg, level) pairs.
+    """
+    lines = []
+    cache = get_layer_cache(_worker_job)
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    result = _run_key(key, _worker_job, _buffer_log(lines))
+    if cache:
+        return lines, result, cache.hits - hits, cache.misses - misses
+    return lines, result, 0, 0
+
+def _process_keys_serial(keys, job, stop_event, log, record, stats):
+    cache = get_layer_cache(job)
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    try:
+        for key in keys:
+            if stop_event.is_set():
+                log("Processing stopped by user.")
+                return False
+            record(_run_key(key, job, log))
+        return True
+    finally:
+        if cache:
+            stats["hits"] += cache.hits - hits
+            stats["misses"] += cache.misses - misses
+
+def _process_keys_parallel(keys, job, stop_event, log, record, stats, workers):
+    log(f"Compositing with {workers} worker processes.")
+    # Every worker keeps its own layer cache, so split the budget to keep layer_cache_mb a total.
+    if get_layer_cache(job):
+        job = dict(job, layer_cache_mb=float(job["layer_cache_mb"]) / workers)
+        share = job["layer_cache_mb"]
+        share = f"{share:.1f} MB" if share >= 1 else f"{share * 1024:.0f} KB"
+        log(f"Layer cache: {share} per worker process.", DETAIL)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(job,)) as executor:
+        key_iter = iter(keys)
+        pending = deque()
+        # Keep a couple of keys queued per worker; submitting everything up front would make cancelling slow.
+        for key in key_iter:
+            pending.append(executor.submit(_process_key_buffered, key))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            if stop_event.is_set():
+                for future in pending:
+                    future.cancel()
+                log("Processing stopped by user.")
+                return False
+            lines, result, hits, misses = pending.popleft().result()
+            for msg, level in lines:
+                log(msg, level)
+            record(result)
+            stats["hits"] += hits
+            stats["misses"] += misses
+            next_key = next(key_iter, None)
+            if next_key is not None:
+                pending.append(executor.submit(_process_key_buffered, next_key))
+    return True
+
+# ---------------- Shared Memory ----------------
+SharedBuffer = namedtuple("SharedBuffer", "name shape dtype")
+
+class SharedBufferPool:
+    """
+    A fixed set of equally sized multiprocessing.shared_memory blocks, owned by the creating process.
+    acquire() lends out a free block as a SharedBuffer handle (block name, shape, dtype). Only the
+    handle is pickled to other processes, which map the same pages with attach_buffer().
+    """
+    def __init__(self, block_bytes, blocks):
+        self.block_bytes = block_bytes
+        self.blocks = {}
+        self.free = deque()
+        self.lock = threading.Lock()
+        try:
+            for _ in range(blocks):
+                shm = shared_memory.SharedMemory(create=True, size=max(1, block_bytes))
+                self.blocks[shm.name] = shm
+                self.free.append(shm.name)
+        except Exception:
+            self.close()
+            raise
+
+    def acquire(self, shape, dtype=np.uint8):
+        dtype = np.dtype(dtype)
+        if int(np.prod(shape)) * dtype.itemsize > self.block_bytes:
+            raise ValueError(f"Shared buffer of shape {shape} does not fit a {self.block_bytes} byte block.")
+        with self.lock:
+            if not self.free:
+                raise Exception("Shared buffer pool exhausted.")
+            name = self.free.popleft()
+        return SharedBuffer(name, tuple(shape), dtype.str)
+
+    def release(self, handle):
+        with self.lock:
+            self.free.append(handle.name)
+
+    def view(self, handle):
+        """The owning process's array over a lent block."""
+        return np.ndarray(handle.shape, handle.dtype, buffer=self.blocks[handle.name].buf)
+
+    def close(self):
+        for shm in self.blocks.values():
+            try:
+                shm.close()
+            except BufferError:
+                # An image still wraps the block; the mapping goes away with the process.
+                pass
+            shm.unlink()
+        self.blocks.clear()
+        self.free.clear()
+
+_attached_blocks = {}
+
+def attach_buffer(handle):
+    """Maps a SharedBuffer lent by another process's pool as a NumPy array, without copying."""
+    shm = _attached_blocks.get(handle.name)
+    if shm is None:
+        shm = _attached_blocks[handle.name] = shared_memory.SharedMemory(name=handle.name)
+    return np.ndarray(handle.shape, handle.dtype, buffer=shm.buf)
+
+def image_from_buffer(arr):
+    """Wraps an H x W (L) or H x W x 4 (RGBA) uint8 array as a read-only PIL image sharing its memory."""
+    mode = "L" if arr.ndim == 2 else "RGBA"
+    return Image.frombuffer(mode, (arr.shape[1], arr.shape[0]), arr, "raw", mode, 0, 1)
+
+# ---------------- Pipelined Stages ----------------
+
+def _decode_plan(key, job, cache, claimed):
+    """
+    Which layers of key the decode stage loads: not those already in the layer cache, nor shared
+    layers that a key ahead of it in the pipeline is decoding, since keys are composited in order
+    and that key puts the layer in the cache first. Returns (plan, claims): one bool per layer,
+    and the cache keys this key decodes, which are added to claimed until it has been composited.
+    If a skipped layer is gone from the cache after all, composite_key loads it itself.
+    """
+    plan = []
+    claims = set()
+    frame_bytes = job["target_width"] * job["target_height"] * (16 if job.get("float_pipeline") else 4)
+    cached = cache is not None and frame_bytes <= cache.max_bytes
+    for idx in range(len(job["layers_config"])):
+        cache_key = layer_cache_key(key, idx, job) if cached else None
+        if cache_key and (cache_key in claimed or cache_key in cache):
+            plan.append(False)
+            continue
+        plan.append(True)
+        if cache_key:
+            claims.add(cache_key)
+    claimed.update(claims)
+    return plan, claims
+
+def _decode_key(key, job, plan):
+    """
+    Decode stage: loads the layers of a key that plan (from _decode_plan) marks.
+    Returns (lines, loaded, error, seconds); loaded holds (img, a_img) or None per layer.
+    """
+    start = time.perf_counter()
+    lines = []
+    loaded = []
+    try:
+        for idx, decode in enumerate(plan):
+            loaded.append(load_layer(key, idx, job, _buffer_log(lines)) if decode else None)
+        return lines, loaded, None, time.perf_counter() - start
+    except Exception as e:
+        return lines, None, str(e), time.perf_counter() - start
+
+def _encode_key(composite_img, output_path, job):
+    """Encode stage: writes one composite. Returns the seconds spent."""
+    return save_composite(composite_img, output_path, job["output_format"], job["quality"], encode_options(job))
+
+def _decode_key_shared(key, handles):
+    """
+    Worker side of the process decode stage: writes each layer's (img, a_img) into the shared
+    blocks in handles (None for layers to skip). Returns (lines, has_alpha, error, seconds).
+    """
+    start = time.perf_counter()
+    lines = []
+    has_alpha = []
+    try:
+        for idx, handle in enumerate(handles):
+            if handle is None:
+                has_alpha.append(False)
+                continue
+            img, a_img = load_layer(key, idx, _worker_job, _buffer_log(lines))
+            np.copyto(attach_buffer(handle[0]), np.asarray(img))
+            if a_img is not None:
+                np.copyto(attach_buffer(handle[1]), np.asarray(a_img))
+            has_alpha.append(a_img is not None)
+            del img, a_img
+        return lines, has_alpha, None, time.perf_counter() - start
+    except Exception as e:
+        return lines, None, str(e), time.perf_counter() - start
+
+def _encode_key_shared(handle, output_path):
+    """Worker side of the process encode stage: encodes the composite held in a shared block."""
+    composite_img = image_from_buffer(attach_buffer(handle))
+    try:
+        return _encode_key(composite_img, output_path, _worker_job)
+    finally:
+        del composite_img
+
+class _ThreadStages:
+    """Decode and encode stages of the pipelined mode on thread pools in this process."""
+    def __init__(self, job, prefetch_depth, write_depth):
+        self.job = job
+        self.decoder = ThreadPoolExecutor(prefetch_depth)
+        self.writer = ThreadPoolExecutor(write_depth)
+
+    def submit_decode(self, key, plan):
+        return self.decoder.submit(_decode_key, key, self.job, plan)
+
+    def collect_decode(self, ticket):
+        return ticket.result()
+
+    def release_decode(self, ticket):
+        pass
+
+    def cancel_decode(self, ticket):
+        ticket.cancel()
+
+    def submit_encode(self, composite_img, output_path):
+        return self.writer.submit(_encode_key, composite_img, output_path, self.job)
+
+    def collect_encode(self, ticket):
+        return ticket.result()
+
+    def shutdown(self):
+        self.decoder.shutdown()
+        self.writer.shutdown()
+
+class _SharedMemoryStages:
+    """
+    Decode and encode stages of the pipelined mode on a pool of worker processes. Decoded layers
+    and finished composites stay in a SharedBufferPool: this process lends blocks out, workers
+    write or read the pixels in place, and only handles, log lines and timings are pickled.
+    """
+    def __init__(self, job, prefetch_depth, write_depth, processes):
+        self.job = job
+        self.frame = (job["target_height"], job["target_width"], 4)
+        layers = job["layers_config"]
+        per_key = len(layers) + sum(1 for layer in layers if layer["use_alpha"])
+        # Keys being decoded, plus the one being composited, plus composites waiting to be encoded.
+        blocks = (prefetch_depth + 1) * per_key + write_depth
+        self.buffers = SharedBufferPool(int(np.prod(self.frame)), blocks)
+        self.pool = ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(job,))
+
+    def submit_decode(self, key, plan):
+        handles = []
+        for decode, layer in zip(plan, self.job["layers_config"]):
+            if not decode:
+                handles.append(None)
+            else:
+                handles.append((self.buffers.acquire(self.frame),
+                                self.buffers.acquire(self.frame[:2]) if layer["use_alpha"] else None))
+        return self.pool.submit(_decode_key_shared, key, handles), handles
+
+    def collect_decode(self, ticket):
+        future, handles = ticket
+        lines, has_alpha, error, seconds = future.result()
+        if error:
+            return lines, None, error, seconds
+        loaded = []
+        for handle, alpha in zip(handles, has_alpha):
+            if handle is None:
+                loaded.append(None)
+            else:
+                a_img = image_from_buffer(self.buffers.view(handle[1])) if alpha else None
+                loaded.append((image_from_buffer(self.buffers.view(handle[0])), a_img))
+        return lines, loaded, None, seconds
+
+    def release_decode(self, ticket):
+        for handle in ticket[1]:
+            if handle is not None:
+                self.buffers.release(handle[0])
+                if handle[1] is not None:
+                    self.buffers.release(handle[1])
+
+    def cancel_decode(self, ticket):
+        ticket[0].cancel()
+
+    def submit_encode(self, composite_img, output_path):
+        # The composite is built in private memory, so it takes one copy into a block to hand it over.
+        handle = self.buffers.acquire(self.frame)
+        np.copyto(self.buffers.view(handle), np.asarray(composite_img.convert("RGBA")))
+        return self.pool.submit(_encode_key_shared, handle, output_path), handle
+
+    def collect_encode(self, ticket):
+        future, handle = ticket
+        try:
+            return future.result()
+        finally:
+            self.buffers.release(handle)
+
+    def shutdown(self):
+        self.pool.shutdown()
+        self.buffers.close()
+
+def _process_keys_pipelined(keys, job, stop_event, log, record, stats):
+    """
+    Single-process compositing with overlapping stages: the decode stage loads the next prefetch_depth
+    keys, this thread composites, and the encode stage writes up to write_depth outputs. The stages
+    run on threads, or with job["stage_processes"] on worker processes that exchange pixels through
+    shared memory. Memory is bounded by the two queue depths. Log lines stay in key order.
+    """
+    prefetch_depth = max(1, int(job.get("prefetch_depth", 2)))
+    write_depth = max(1, int(job.get("write_depth", 2)))
+    stage_processes = int(job.get("stage_processes") or 0)
+    if stage_processes > 0:
+        log(f"Pipelined compositing: {prefetch_depth} key(s) prefetched, {write_depth} write(s) in flight, "
+            f"{stage_processes} stage process(es) on shared memory.")
+        stages = _SharedMemoryStages(job, prefetch_depth, write_depth, stage_processes)
+    else:
+        log(f"Pipelined compositing: {prefetch_depth} key(s) prefetched, {write_depth} write(s) in flight.")
+        stages = _ThreadStages(job, prefetch_depth, write_depth)
+    cache = get_layer_cache(job)
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    key_iter = iter(keys)
+    decoding = deque()
+    writing = deque()
+    # Cache keys of shared layers a queued key is decoding, so later keys wait for the cache instead.
+    claimed = set()
+
+    def submit_decode(key):
+        plan, claims = _decode_plan(key, job, cache, claimed)
+        decoding.append((key, stages.submit_decode(key, plan), claims))
+
+    def finish_write():
+        key, output_path, ticket, seconds = writing.popleft()
+        try:
+            encode_seconds = stages.collect_encode(ticket)
+            seconds += encode_seconds
+            log(f"  Encoded in {encode_seconds:.3f}s.", DETAIL)
+            log(f"Composite for key '{key}' saved to: {output_path}\n")
+            record({"key": key, "output_path": output_path, "seconds": round(seconds, 4),
+                    "encode_seconds": round(encode_seconds, 4), "error": None, "skipped": False})
+        except Exception as e:
+            log(f"Error processing key '{key}': {e}\n")
+            record({"key": key, "output_path": None, "seconds": round(seconds, 4),
+                    "encode_seconds": None, "error": str(e), "skipped": False})
+
+    completed = True
+    try:
+        for key in key_iter:
+            submit_decode(key)
+            if len(decoding) >= prefetch_depth:
+                break
+        try:
+            while decoding:
+                if stop_event.is_set():
+                    for _, ticket, _ in decoding:
+                        stages.cancel_decode(ticket)
+                    log("Processing stopped by user.")
+                    completed = False
+                    break
+                key, ticket, claims = decoding.popleft()
+                lines, loaded, error, seconds = stages.collect_decode(ticket)
+                next_key = next(key_iter, None)
+                if next_key is not None:
+                    submit_decode(next_key)
+
+                log(f"Processing composite for key: '{key}'")
+                for msg, level in lines:
+                    log(msg, level)
+                start = time.perf_counter()
+                try:
+                    if error:
+                        raise Exception(error)
+                    composite_img = composite_key(key, job, log, loaded)
+                    output_path = get_output_path(key, job)
+                except Exception as e:
+                    log(f"Error processing key '{key}': {e}\n")
+                    record({"key": key, "output_path": None, "error": str(e), "skipped": False,
+                            "seconds": round(seconds + time.perf_counter() - start, 4), "encode_seconds": None})
+                    continue
+                finally:
+                    loaded = None
+                    stages.release_decode(ticket)
+                    claimed.difference_update(claims)
+                seconds += time.perf_counter() - start
+                writing.append((key, output_path, stages.submit_encode(composite_img, output_path), seconds))
+                composite_img = None
+                while len(writing) >= write_depth:
+                    finish_write()
+        finally:
+            while writing:
+                finish_write()
+            if cache:
+                stats["hits"] += cache.hits - hits
+                stats["misses"] += cache.misses - misses
+    finally:
+        stages.shutdown()
+    return completed
+
+def process_keys(keys, job, stop_event, log=print_log, workers=1, results=None, progress=None):
+    """
+    Composites every key, serially, as a pipelined single process (job["pipelined"]),
+    or across a pool of worker processes. Strip mode (job["strip_height"]) streams each
+    key to its encoder itself, so it runs serially or pooled but never pipelined. Log lines are always emitted in key order.
+    If a results list is given, one dict per processed key (key, output_path, seconds,
+    encode_seconds, error, skipped) is appended to it; progress(done, total) is called after every key.
+    Returns False if stop_event interrupted the run.
+    """
+    if results is None:
+        results = []
+    first = len(results)
+    total = len(keys)
+    done = [0]
+    def record(result):
+        results.append(result)
+        done[0] += 1
+        if progress:
+            progress(done[0], total)
+
+    job = dict(job, shared_paths=find_shared_paths(job["main_layer_dicts"]))
+    if job.get("strip_height"):
+        for warning in strip_memory_warnings(job):
+            log(warning)
+    stats = {"hits": 0, "misses": 0}
+    if workers <= 1 and job.get("pipelined") and not job.get("strip_height"):
+        completed = _process_keys_pipelined(keys, job, stop_event, log, record, stats)
+    elif workers <= 1:
+        completed = _process_keys_serial(keys, job, stop_event, log, record, stats)
+    else:
+        completed = _process_keys_parallel(keys, job, stop_event, log, record, stats, workers)
+    if get_layer_cache(job):
+        log(f"Layer cache: {stats['hits']} hit(s), {stats['misses']} miss(es).")
+    encode_times = [r["encode_seconds"] for r in results[first:] if r["encode_seconds"] is not None]
+    if encode_times:
+        log(f"Encoding: {len(encode_times)} file(s) in {sum(encode_times):.2f}s "
+            f"({sum(encode_times) / len(encode_times):.3f}s per file).")
+    return completed
+
+# ---------------- Incremental Manifest ----------------
+
+MANIFEST_NAME = ".composer_manifest.json"
+# Job settings that change the pixels of an output; workers and caches do not.
+OUTPUT_SETTINGS = ("layers_config", "target_width", "target_height", "output_format", "quality", "float_pipeline")
+
+def job_config_hash(params):
+    """Hash of everything in the job settings that affects output pixels."""
+    settings = {name: params.get(name) for name in OUTPUT_SETTINGS}
+    if params.get("output_format") == "webp":
+        # Only lossless WebP changes pixels among the encoder options.
+        settings["webp_lossless"] = bool(params.get("webp_lossless"))
+    if params.get("fixed_point") and not params.get("float_pipeline"):
+        settings["fixed_point"] = True
+    if params.get("strip_height"):
+        # Strips resample their own row ranges, so resized layers depend on the strip height.
+        settings["strip_height"] = int(params["strip_height"])
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+def input_signature(key, job):
+    """[path, size, mtime_ns] of every main and alpha override image a key reads, or None if one is missing."""
+    signature = []
+    for idx, layer in enumerate(job["layers_config"]):
+        paths = [job["main_layer_dicts"][idx].get(key)]
+        if layer["use_alpha"]:
+            a_path = job["alpha_override_maps"][idx].get(key)
+            if a_path:
+                paths.append(a_path)
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except (OSError, TypeError):
+                return None
+            signature.append([path, st.st_size, st.st_mtime_ns])
+    return signature
+
+def load_manifest(export_folder):
+    try:
+        with open(os.path.join(export_folder, MANIFEST_NAME), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(export_folder, manifest):
+    path = os.path.join(export_folder, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+def filter_up_to_date(keys, job, manifest, config_hash):
+    """
+    Splits keys into (stale, up_to_date, signatures). A key is up to date when its output exists and
+    the manifest recorded the same config hash and input sizes/mtimes when it was written.
+    """
+    stale, up_to_date, signatures = [], [], {}
+    for key in keys:
+        output_path = get_output_path(key, job)
+        signature = input_signature(key, job)
+        signatures[key] = signature
+        entry = manifest.get(os.path.relpath(output_path, job["export_folder"]))
+        if (signature is not None and entry and entry.get("config") == config_hash
+                and entry.get("inputs") == signature and os.path.exists(output_path)):
+            up_to_date.append(key)
+        else:
+            stale.append(key)
+    return stale, up_to_date, signatures
+
+# ---------------- Job Runner ----------------
+
+def validate_layers_config(layers_config):
+    """Checks opacities, blend modes and the single Parent layer; raises ValueError with a user-facing message."""
+    if not layers_config:
+        raise ValueError("No layer configuration available.")
+    for layer in layers_config:
+        try:
+            op = float(layer["main_opacity"])
+            if not (0.0<=op<=1.0):
+                raise ValueError
+            if layer["use_alpha"]:
+                aop = float(layer["alpha_opacity"])
+                if not (0.0<=aop<=1.0):
+                    raise ValueError
+        except:
+            raise ValueError(f"Opacity values for layer '{layer['name']}' must be numbers between 0 and 1.")
+        if layer["blend_mode"].lower() not in _KERNEL_MODES:
+            raise ValueError(f"Layer '{layer['name']}' has an unknown blend mode '{layer['blend_mode']}'.")
+    parent_layers = [layer for layer in layers_config if layer["main_mode"].lower()=="parent"]
+    if len(parent_layers)!=1:
+        raise ValueError("There must be exactly one layer set to 'Parent'.")
+
+def run_composite(params, stop_event, log=print_log, results=None, progress=None):
+    """
+    Runs a whole composite job: resolves layers, then composites and saves every common key.
+    params holds the folders, target size, layers_config and export options collected by the GUI
+    (or the CLI). With params["incremental"], keys whose output is recorded in the export folder's
+    manifest with unchanged inputs and settings are skipped. progress(done, total) counts the
+    keys actually composited.
+    Returns (key_count, completed); key_count is 0 when no key has every layer.
+    """
+    os.makedirs(params["export_folder"], exist_ok=True)
+    cache_dir = CATALOGUE_CACHE_DIR if params.get("cache_scan") else None
+    parent_dict, main_layer_dicts, alpha_override_maps = build_layer_dicts(
+        params["folder"], params["layers_config"], log, cache_dir)
+
+    common_keys = find_common_keys(parent_dict, main_layer_dicts)
+    log(f"Processing composite for {len(common_keys)} key(s) (intersection across all layers).\n")
+    if not common_keys:
+        return 0, True
+
+    job = dict(params, parent_dict=parent_dict, main_layer_dicts=main_layer_dicts,
+               alpha_override_maps=alpha_override_maps)
+    if results is None:
+        results = []
+    if not params.get("incremental"):
+        completed = process_keys(common_keys, job, stop_event, log, params.get("workers", 1), results, progress)
+        return len(common_keys), completed
+
+    export_folder = params["export_folder"]
+    manifest = load_manifest(export_folder)
+    config_hash = job_config_hash(params)
+    stale, up_to_date, signatures = filter_up_to_date(common_keys, job, manifest, config_hash)
+    log(f"Incremental: {len(up_to_date)} key(s) up to date, {len(stale)} to composite.\n")
+    for key in up_to_date:
+        results.append({"key": key, "output_path": get_output_path(key, job), "seconds": 0.0,
+                        "encode_seconds": None, "error": None, "skipped": True})
+    first_new = len(results)
+    try:
+        completed = process_keys(stale, job, stop_event, log, params.get("workers", 1), results, progress)
+    finally:
+        # Record whatever finished, even if the run was stopped or crashed part way.
+        for result in results[first_new:]:
+            if not result["error"] and signatures[result["key"]] is not None:
+                rel_path = os.path.relpath(result["output_path"], export_folder)
+                manifest[rel_path] = {"config": config_hash, "inputs": signatures[result["key"]]}
+        save_manifest(export_folder, manifest)
+    return len(common_keys), completed
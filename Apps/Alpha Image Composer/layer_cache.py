@@ -0,0 +1,89 @@
+# layer_cache.py
+# The prepared-layer LRU and the cached 8-bit lookup tables, shared by composer_engine.py
+# (alpha_composer.py) and actions.py (main.py) without either tool importing the other.
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+import numpy as np
+
+# ---------------- Lookup Tables ----------------
+
+IDENTITY_TABLE = tuple(range(256))
+
+@lru_cache(maxsize=256)
+def opacity_table(opacity):
+    """256-entry lookup table for p -> int(p * opacity)."""
+    return tuple(int(p * opacity) for p in range(256))
+
+@lru_cache(maxsize=256)
+def gamma_table(gamma):
+    """256-entry lookup table for the gamma curve, computed with the same float32 maths as before."""
+    if gamma == 1.0:
+        return IDENTITY_TABLE
+    arr = np.arange(256, dtype=np.float32)/255.0
+    adjusted = np.power(arr, 1.0/gamma)
+    return tuple(np.clip(adjusted*255, 0, 255).astype(np.uint8).tolist())
+
+@lru_cache(maxsize=256)
+def alpha_table(opacity, gamma):
+    """Opacity followed by gamma, fused into one alpha lookup table."""
+    g = gamma_table(gamma)
+    return tuple(g[v] for v in opacity_table(opacity))
+
+@lru_cache(maxsize=256)
+def opacity_lut(opacity):
+    """opacity_table as a read-only uint8 array (clipped to 0-255) for np.take on arrays."""
+    lut = np.clip(np.array(opacity_table(opacity)), 0, 255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+@lru_cache(maxsize=256)
+def gamma_lut(gamma):
+    """gamma_table as a read-only uint8 array for np.take on arrays."""
+    lut = np.array(gamma_table(gamma), dtype=np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+# ---------------- Layer Cache ----------------
+
+class LayerCache:
+    """
+    Bounded LRU of fully prepared layers (resized, transformed, opacity/alpha/gamma applied).
+    Entries are treated as read-only by the pipelines; the budget is counted in bytes.
+    Safe to share between the pipelined mode's decode threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self.entries[key] = (value, nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
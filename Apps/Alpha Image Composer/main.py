@@ -5,7 +5,7 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import tkinter.scrolledtext as scrolledtext
 from PIL import Image
-from actions import process_layer  # Import our layer processing function
+from actions import ACTIONS, get_source_cache, load_source_image, process_layer  # Import our layer processing function
 
 # Global list to hold layer configuration dictionaries.
 layer_configs = []
@@ -30,8 +30,8 @@ def add_layer_config():
     ttk.Button(layer_window, text="Browse", command=browse_image).grid(row=0, column=2, padx=5, pady=5)
     
     tk.Label(layer_window, text="Select Action:").grid(row=1, column=0, padx=5, pady=5)
-    # For simplicity, list a few actions. (You can extend this list as registered in actions.py.)
-    action_options = ["apply_opacity", "blend_normal", "blend_screen", "blend_multiply"]
+    # Every action registered in actions.py.
+    action_options = list(ACTIONS)
     action_var = tk.StringVar(value=action_options[0])
     action_combo = ttk.Combobox(layer_window, textvariable=action_var, values=action_options, state="readonly")
     action_combo.grid(row=1, column=1, padx=5, pady=5)
@@ -87,8 +87,10 @@ def compose_images():
     base_path = filedialog.askopenfilename(title="Select Base Image", filetypes=[("Image Files", "*.png;*.jpg;*.jpeg")])
     if not base_path:
         return
-    base_img = Image.open(base_path).convert("RGBA")
-    composite = base_img.copy()
+    # Sources are decoded once and reused by later compose runs until the file changes.
+    source_cache = get_source_cache()
+    hits, misses = source_cache.hits, source_cache.misses
+    composite = load_source_image(base_path)
     log_text.delete("1.0", tk.END)
     log_text.insert(tk.END, "Starting composition...\n")
     
@@ -102,6 +104,7 @@ def compose_images():
         except Exception as e:
             log_text.insert(tk.END, f"Error processing layer {idx+1}: {str(e)}\n")
             continue
+    log_text.insert(tk.END, f"Source cache: {source_cache.hits - hits} hit(s), {source_cache.misses - misses} miss(es).\n")
     
     export_path = filedialog.asksaveasfilename(title="Save Composite Image", defaultextension=".png", filetypes=[("PNG Image", "*.png")])
     if export_path:
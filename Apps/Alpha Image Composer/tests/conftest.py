@@ -0,0 +1,5 @@
+# The composer's modules are imported as top-level scripts, so the tests need the app folder on the path.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
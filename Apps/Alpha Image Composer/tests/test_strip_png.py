@@ -0,0 +1,329 @@
+# Round trips of strip mode's PNG streaming (PNGRowReader, StripPNGWriter, save_png_parallel)
+# against Pillow, and of strip compositing against full-frame compositing.
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import composer_engine as ce
+
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+def _filter_row(kind, row, prev, bpp):
+    """PNG filter type kind applied to one raw scanline, given the raw scanline above it."""
+    x = row.astype(np.int16)
+    b = prev.astype(np.int16)
+    a = np.zeros_like(x)
+    a[bpp:] = x[:-bpp]
+    c = np.zeros_like(x)
+    c[bpp:] = b[:-bpp]
+    if kind == 1:
+        x = x - a
+    elif kind == 2:
+        x = x - b
+    elif kind == 3:
+        x = x - ((a + b) >> 1)
+    elif kind == 4:
+        p = a + b - c
+        pa, pb, pc = np.abs(p - a), np.abs(p - b), np.abs(p - c)
+        x = x - np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+    return bytes([kind]) + (x & 0xff).astype(np.uint8).tobytes()
+
+def write_png(path, arr, color, filters=(4,), idat_bytes=None, chunks=(), depth=8, interlace=0):
+    """
+    Writes arr (H x W x channels uint8) as a PNG of the given colour type, filtering row y with
+    filters[y % len(filters)] and splitting the zlib stream into IDAT chunks of idat_bytes.
+    chunks are extra (tag, data) pairs written before the image data (PLTE, tRNS).
+    """
+    height, width = arr.shape[:2]
+    rows = arr.reshape(height, -1)
+    bpp = CHANNELS[color]
+    prev = np.zeros(rows.shape[1], dtype=np.uint8)
+    raw = []
+    for y in range(height):
+        raw.append(_filter_row(filters[y % len(filters)], rows[y], prev, bpp))
+        prev = rows[y]
+    data = zlib.compress(b"".join(raw), 6)
+    idat_bytes = idat_bytes or len(data)
+    with open(path, "wb") as f:
+        f.write(ce.PNG_SIGNATURE)
+        ce._png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, depth, color, 0, 0, interlace))
+        for tag, chunk in chunks:
+            ce._png_chunk(f, tag, chunk)
+        for i in range(0, len(data), idat_bytes):
+            ce._png_chunk(f, b"IDAT", data[i:i + idat_bytes])
+        ce._png_chunk(f, b"IEND", b"")
+    return path
+
+def pillow_rows(path, mode, y0, y1):
+    with Image.open(path) as im:
+        return np.asarray(im.convert(mode))[y0:y1]
+
+def read_rows(reader, y0, y1):
+    return np.asarray(reader.rows(y0, y1))
+
+# Reads that go forwards, skip ahead past SKIP_ROWS, jump back to the top and run to the bottom.
+ACCESS = [(0, 1), (1, 9), (9, 10), (300, 317), (317, 600), (5, 6), (0, 600), (599, 600), (250, 420)]
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(12)
+
+@pytest.mark.parametrize("park", [False, True])
+@pytest.mark.parametrize("filters", [(0,), (1,), (2,), (3,), (4,), (0, 1, 2, 3, 4), (2, 3, 4, 4, 1)])
+def test_every_filter_type(tmp_path, rng, filters, park):
+    arr = rng.integers(0, 256, (600, 13, 4), dtype=np.uint8)
+    arr[::7] //= 3  # some smoother rows, so the filters see varied data
+    path = write_png(str(tmp_path / "f.png"), arr, 6, filters)
+    reader = ce.PNGRowReader.open(path, "RGBA", park, str(tmp_path))
+    try:
+        for y0, y1 in ACCESS:
+            assert np.array_equal(read_rows(reader, y0, y1), arr[y0:y1]), (y0, y1)
+    finally:
+        reader.close()
+
+def _palette_chunks(rng, colours, alpha):
+    plte = rng.integers(0, 256, (colours, 3), dtype=np.uint8).tobytes()
+    chunks = [(b"PLTE", plte)]
+    if alpha:
+        chunks.append((b"tRNS", rng.integers(0, 256, colours // 2, dtype=np.uint8).tobytes()))
+    return chunks
+
+# Pillow warns when it converts a palette with tRNS to L; the reader and the reference both do.
+@pytest.mark.filterwarnings("ignore:Palette images with Transparency")
+@pytest.mark.parametrize("park", [False, True])
+@pytest.mark.parametrize("color, trns", [(0, False), (0, True), (2, False), (2, True), (3, False), (3, True),
+                                         (4, False), (6, False)])
+@pytest.mark.parametrize("mode", ["RGBA", "L"])
+def test_colour_types_match_pillow(tmp_path, rng, color, trns, mode, park):
+    arr = rng.integers(0, 256, (290, 11, CHANNELS[color]), dtype=np.uint8)
+    chunks = []
+    if color == 3:
+        arr %= 40
+        chunks = _palette_chunks(rng, 40, trns)
+    elif trns:
+        # A transparent colour that some pixels actually have.
+        key = arr[3, 4]
+        chunks = [(b"tRNS", b"".join(struct.pack(">H", v) for v in key))]
+    path = write_png(str(tmp_path / "c.png"), arr, color, (0, 4, 2), chunks=chunks)
+    reader = ce.PNGRowReader.open(path, mode, park, str(tmp_path))
+    try:
+        for y0, y1 in [(0, 40), (270, 290), (3, 5), (0, 290)]:
+            assert np.array_equal(read_rows(reader, y0, y1), pillow_rows(path, mode, y0, y1)), (y0, y1)
+    finally:
+        reader.close()
+
+@pytest.mark.parametrize("idat_bytes", [1, 7, 100, 4096])
+def test_multi_idat_files(tmp_path, rng, idat_bytes, monkeypatch):
+    arr = rng.integers(0, 256, (600, 9, 3), dtype=np.uint8)
+    path = write_png(str(tmp_path / "m.png"), arr, 2, (1, 4), idat_bytes=idat_bytes)
+    # Reads smaller than a chunk, so chunks are also consumed in pieces.
+    monkeypatch.setattr(ce.PNGRowReader, "READ_BYTES", 5)
+    reader = ce.PNGRowReader.open(path, "RGBA", False)
+    try:
+        for y0, y1 in ACCESS:
+            assert np.array_equal(read_rows(reader, y0, y1), pillow_rows(path, "RGBA", y0, y1))
+    finally:
+        reader.close()
+
+def test_empty_idat_chunks_are_skipped(tmp_path, rng):
+    arr = rng.integers(0, 256, (20, 5, 4), dtype=np.uint8)
+    path = str(tmp_path / "e.png")
+    data = zlib.compress(b"".join(_filter_row(0, row, row, 4) for row in arr.reshape(20, -1)))
+    with open(path, "wb") as f:
+        f.write(ce.PNG_SIGNATURE)
+        ce._png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", 5, 20, 8, 6, 0, 0, 0))
+        ce._png_chunk(f, b"IDAT", b"")
+        ce._png_chunk(f, b"IDAT", data[:10])
+        ce._png_chunk(f, b"IDAT", b"")
+        ce._png_chunk(f, b"IDAT", data[10:])
+        ce._png_chunk(f, b"IEND", b"")
+    reader = ce.PNGRowReader.open(path, "RGBA")
+    try:
+        assert np.array_equal(read_rows(reader, 0, 20), arr)
+    finally:
+        reader.close()
+
+def test_pillow_written_files(tmp_path, rng):
+    arr = rng.integers(0, 256, (700, 64, 4), dtype=np.uint8)
+    path = str(tmp_path / "p.png")
+    Image.fromarray(arr, "RGBA").save(path, compress_level=9)
+    reader = ce.PNGRowReader.open(path, "RGBA")
+    try:
+        for y0, y1 in ACCESS + [(650, 700)]:
+            assert np.array_equal(read_rows(reader, y0, y1), arr[y0:y1])
+    finally:
+        reader.close()
+
+def test_truncated_file_raises(tmp_path, rng):
+    arr = rng.integers(0, 256, (50, 8, 4), dtype=np.uint8)
+    path = write_png(str(tmp_path / "t.png"), arr, 6)
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:len(data) // 2])
+    reader = ce.PNGRowReader.open(path, "RGBA")
+    try:
+        with pytest.raises(Exception, match="ends before its image data"):
+            reader.rows(0, 50)
+    finally:
+        reader.close()
+
+def _interlaced_png(path):
+    # 1 x 1 Adam7: only the first pass has a pixel.
+    with open(path, "wb") as f:
+        f.write(ce.PNG_SIGNATURE)
+        ce._png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 6, 0, 0, 1))
+        ce._png_chunk(f, b"IDAT", zlib.compress(b"\x00\x0a\x14\x1e\x28"))
+        ce._png_chunk(f, b"IEND", b"")
+    return path
+
+def _sixteen_bit_png(path, rng):
+    Image.fromarray(rng.integers(0, 65535, (6, 5), dtype=np.uint16)).save(path)
+    return path
+
+def _low_depth_palette_png(path, rng):
+    im = Image.fromarray(rng.integers(0, 4, (6, 5), dtype=np.uint8), "P")
+    im.putpalette([0, 0, 0, 255, 0, 0, 0, 255, 0, 0, 0, 255])
+    im.save(path, bits=2)
+    return path
+
+def _jpeg(path, rng):
+    Image.fromarray(rng.integers(0, 256, (6, 5, 3), dtype=np.uint8)).save(path)
+    return path
+
+@pytest.mark.parametrize("make, name", [(lambda p, rng: _interlaced_png(p), "u.png"), (_sixteen_bit_png, "u.png"),
+                                        (_low_depth_palette_png, "u.png"), (_jpeg, "u.jpg")],
+                         ids=["interlaced", "16-bit", "2-bit-palette", "jpeg"])
+def test_unstreamable_files_fall_back_to_pillow(tmp_path, rng, make, name):
+    path = make(str(tmp_path / name), rng)
+    with open(path, "rb") as f:
+        head = f.read(29)
+    if head.startswith(ce.PNG_SIGNATURE):
+        depth, _, _, _, interlace = struct.unpack(">BBBBB", head[24:29])
+        assert depth != 8 or interlace
+    assert ce.PNGRowReader.open(path, "RGBA") is None
+    logs = []
+    source = ce.open_row_source(path, "RGBA", str(tmp_path), log=lambda msg, level=ce.INFO: logs.append(msg))
+    try:
+        assert isinstance(source, ce.SpilledRows)
+        assert logs and "whole" in logs[0]
+        height = source.size[1]
+        assert np.array_equal(np.asarray(source.rows(0, height)), pillow_rows(path, "RGBA", 0, height))
+    finally:
+        source.close()
+
+def test_adler32_combine(rng):
+    first, second = rng.bytes(100003), rng.bytes(77777)
+    combined = ce._adler32_combine(zlib.adler32(first), zlib.adler32(second), len(second))
+    assert combined == zlib.adler32(first + second)
+
+@pytest.mark.parametrize("threads", [1, 3, 8])
+def test_save_png_parallel_round_trip(tmp_path, rng, threads):
+    arr = rng.integers(0, 256, (301, 17, 4), dtype=np.uint8)
+    arr[100:200] = arr[100]  # repeated rows, so some blocks compress well
+    path = str(tmp_path / f"par{threads}.png")
+    ce.save_png_parallel(Image.fromarray(arr, "RGBA"), path, 6, zlib.Z_DEFAULT_STRATEGY, threads)
+    assert np.array_equal(pillow_rows(path, "RGBA", 0, 301), arr)
+    reader = ce.PNGRowReader.open(path, "RGBA")
+    try:
+        assert np.array_equal(read_rows(reader, 0, 301), arr)
+    finally:
+        reader.close()
+
+@pytest.mark.parametrize("strip_height", [1, 7, 13, 64, 500])
+def test_strip_png_writer_round_trip(tmp_path, rng, strip_height):
+    arr = rng.integers(0, 256, (97, 23, 4), dtype=np.uint8)
+    path = str(tmp_path / "w.png")
+    writer = ce.StripPNGWriter(path, 23, 97, 6, zlib.Z_RLE)
+    for y0 in range(0, 97, strip_height):
+        writer.write(Image.fromarray(arr[y0:y0 + strip_height], "RGBA"))
+    writer.close()
+    assert np.array_equal(pillow_rows(path, "RGBA", 0, 97), arr)
+
+def test_strip_png_writer_rejects_missing_rows(tmp_path, rng):
+    path = str(tmp_path / "short.png")
+    writer = ce.StripPNGWriter(path, 4, 10)
+    writer.write(Image.fromarray(rng.integers(0, 256, (6, 4, 4), dtype=np.uint8), "RGBA"))
+    with pytest.raises(Exception, match="6 of 10 rows"):
+        writer.close()
+    writer.abort()
+    assert not os.path.exists(path)
+
+# ---------------- Strip compositing ----------------
+
+def _layer(name, constant, mode, blend="Normal", transformations=(), **extra):
+    layer = {"name": name, "main_constant": constant, "main_mode": mode, "main_opacity": "1.0",
+             "use_alpha": False, "alpha_constant": "", "alpha_mode": "Child", "alpha_opacity": "1.0",
+             "blend_mode": blend, "gamma": "1.0",
+             "transformations": [dict(t, match=name) for t in transformations]}
+    layer.update(extra)
+    return layer
+
+ROLL_FLIP = [{"action": "roll", "params": {"x_offset": "9", "y_offset": "-31"}},
+             {"action": "flip", "params": {"direction": "vertical"}},
+             {"action": "roll", "params": {"x_offset": "0", "y_offset": "5"}}]
+
+def _composite(folder, export, layers, size, strip_height, output_format="png"):
+    pd, mld, aom = ce.build_layer_dicts(folder, layers, lambda msg, level=ce.INFO: None)
+    keys = ce.find_common_keys(pd, mld)
+    job = dict(folder=folder, export_folder=export, target_width=size[0], target_height=size[1],
+               layers_config=layers, output_format=output_format, quality=90, append_suffix=False,
+               suffix_value="", preserve_structure=False, layer_cache_mb=0, strip_height=strip_height,
+               parent_dict=pd, main_layer_dicts=mld, alpha_override_maps=aom)
+    os.makedirs(export, exist_ok=True)
+    ce.process_keys(keys, job, threading.Event(), lambda msg, level=ce.INFO: None)
+    return {key: np.asarray(Image.open(ce.get_output_path(key, job))).astype(int) for key in keys}
+
+def _sources(folder, rng, size):
+    os.makedirs(folder, exist_ok=True)
+    w, h = size
+    y, x = np.mgrid[0:h, 0:w]
+    for key in ("a", "b"):
+        base = rng.integers(0, 256, (h, w, 4), dtype=np.uint8)
+        base[..., 3] = 255
+        Image.fromarray(base, "RGBA").save(os.path.join(folder, f"{key}_base.png"))
+        # A smooth layer with a varying alpha, as photographic overlays are.
+        over = np.stack([x * 255 // w, y * 255 // h, (x + y) * 127 // (w + h), 64 + y * 191 // h], axis=-1)
+        Image.fromarray(over.astype(np.uint8), "RGBA").save(os.path.join(folder, f"{key}_over.png"))
+        Image.fromarray(((x * 7 + y * 3) % 256).astype(np.uint8), "L").save(os.path.join(folder, f"{key}_mask.png"))
+
+LAYERS = [
+    _layer("base", "_base", "Parent"),
+    _layer("over", "_over", "Child", "Screen", ROLL_FLIP, use_alpha=True, alpha_constant="_mask"),
+    _layer("shade", "_over", "Child", "Multiply", [{"action": "flip", "params": {"direction": "horizontal"}}],
+           main_opacity="0.6", gamma="1.3"),
+]
+
+@pytest.mark.parametrize("strip_height", [1, 7, 13, 40, 1000])
+def test_strips_match_full_frame_for_same_size_sources(tmp_path, rng, strip_height):
+    size = (37, 53)
+    _sources(str(tmp_path / "src"), rng, size)
+    full = _composite(str(tmp_path / "src"), str(tmp_path / "full"), LAYERS, size, 0)
+    strips = _composite(str(tmp_path / "src"), str(tmp_path / "strips"), LAYERS, size, strip_height)
+    assert full.keys() == strips.keys() == {"a", "b"}
+    for key in full:
+        assert np.array_equal(full[key], strips[key]), key
+
+@pytest.mark.parametrize("strip_height", [1, 7, 16])
+def test_strips_of_resized_sources_stay_close_to_full_frame(tmp_path, rng, strip_height):
+    # Each band is resized on its own, so rows may differ from the full-frame resize by rounding.
+    _sources(str(tmp_path / "src"), rng, (50, 70))
+    size = (37, 53)
+    full = _composite(str(tmp_path / "src"), str(tmp_path / "full"), LAYERS, size, 0)
+    strips = _composite(str(tmp_path / "src"), str(tmp_path / "strips"), LAYERS, size, strip_height)
+    for key in full:
+        diff = np.abs(full[key] - strips[key])
+        assert diff.max() <= 2, key
+        assert (diff > 0).mean() < 0.05, key
+
+def test_strip_sources_leave_no_temporary_files(tmp_path, rng):
+    size = (37, 53)
+    _sources(str(tmp_path / "src"), rng, size)
+    export = str(tmp_path / "out")
+    _composite(str(tmp_path / "src"), export, LAYERS, size, 9, output_format="jpg")
+    assert sorted(os.listdir(export)) == ["a.jpg", "b.jpg"]
@@ -0,0 +1,135 @@
+"""
+Adaptive, depth-aware tessellation of the sphere, shared by mesh-from-images.py and
+reprojection-from-image.py.
+
+Instead of a uniform lat_steps x lon_steps grid, vertices are placed where the depth map changes:
+ring latitudes and the vertices along each ring follow an importance map (1 + detail * depth
+gradient), rings get fewer vertices towards the poles (in proportion to sin(theta)), and neighbouring
+rings with different vertex counts are stitched together so the surface has no cracks. The overall
+density is scaled to land on a target triangle count.
+
+The tessellation is returned in texture space, (u, v) per vertex with v = 0 at the top (theta = 0),
+so each script turns it into 3D positions with its own displacement formula.
+"""
+import numpy as np
+
+# Longest side of the importance map; gradients finer than this are not needed to place vertices.
+IMPORTANCE_SIZE = 512
+DEFAULT_DETAIL = 4.0
+
+def depth_importance(depth_map, detail=DEFAULT_DETAIL, size=IMPORTANCE_SIZE):
+    """
+    Linear vertex density over the equirect: sqrt(1 + detail * |grad depth| / mean |grad depth|),
+    on a grid of at most size columns (block-averaged from the depth map, lightly blurred).
+    """
+    depth_map = np.asarray(depth_map, dtype=np.float32)
+    H, W = depth_map.shape
+    step = max(1, -(-max(H, W) // size))
+    h, w = H // step, W // step
+    small = depth_map[:h * step, :w * step].reshape(h, step, w, step).mean(axis=(1, 3))
+
+    # Gradient magnitude, wrapping around in longitude.
+    gx = (np.roll(small, -1, axis=1) - np.roll(small, 1, axis=1)) / 2
+    gy = np.gradient(small, axis=0) if h > 1 else np.zeros_like(small)
+    grad = np.hypot(gx, gy)
+    # 3x3 box blur so vertices gather on both sides of an edge.
+    padded = np.pad(grad, ((1, 1), (0, 0)), mode="edge")
+    grad = sum(np.roll(padded, dx, axis=1)[1 + dy:1 + dy + h] for dy in (-1, 0, 1) for dx in (-1, 0, 1)) / 9
+
+    mean = grad.mean()
+    density = 1 + detail * grad / mean if mean > 0 else np.ones_like(grad)
+    return np.sqrt(density)
+
+def _inverse_cdf(weights, count):
+    """count + 1 positions in [0, 1], from 0 to 1, spaced so each interval holds equal weight."""
+    cdf = np.concatenate([[0.0], np.cumsum(weights, dtype=np.float64)])
+    cdf /= cdf[-1]
+    positions = np.interp(np.arange(count + 1) / count, cdf, np.linspace(0, 1, len(weights) + 1))
+    positions[0], positions[-1] = 0.0, 1.0
+    return positions
+
+def _layout(importance, k):
+    """Ring latitudes (v, including both poles) and vertex intervals per interior ring for density scale k."""
+    rows = importance.mean(axis=1)
+    rings = max(2, int(round(k * rows.mean())))
+    v = _inverse_cdf(rows, rings)
+    h = importance.shape[0]
+    row_of = np.minimum((v[1:-1] * h).astype(np.intp), h - 1)
+    counts = np.maximum(3, np.rint(2 * k * np.sin(np.pi * v[1:-1]) * rows[row_of])).astype(np.intp)
+    return v, row_of, counts
+
+def _triangle_count(counts):
+    # Each pole fan has one triangle per interval of its ring; each band between rings a and b has a + b.
+    return int(2 * counts.sum())
+
+def _zip_rings(a_start, a_u, b_start, b_u):
+    """
+    Triangles between an upper ring a and the ring b below it, both open polylines from u = 0 to
+    u = 1 (their first and last vertices coincide on the sphere). Walking both rings in u order,
+    each step forward on a or b adds one triangle, with the same winding as the uniform grid.
+    """
+    na, nb = len(a_u) - 1, len(b_u) - 1
+    step_u = np.concatenate([a_u[1:], b_u[1:]])
+    on_b = np.concatenate([np.zeros(na, dtype=bool), np.ones(nb, dtype=bool)])
+    order = np.lexsort((on_b, step_u))
+    on_b = on_b[order]
+    j = np.cumsum(on_b) - on_b
+    i = np.arange(na + nb) - j
+    tris = np.empty((na + nb, 3), dtype=np.int64)
+    tris[:, 0] = a_start + i
+    tris[:, 1] = np.where(on_b, b_start + j + 1, a_start + i + 1)
+    tris[:, 2] = b_start + j
+    return tris
+
+def seam_longitude(u):
+    """
+    u with the seam's duplicate vertices (u = 1) moved to u = 0, for computing positions and
+    sampling depth: both copies of a seam vertex then land on the same point, and only their UVs
+    differ. Sampling at u = 1 would read the depth map's last column instead of its first.
+    """
+    return np.where(u >= 1, np.zeros_like(u), u)
+
+def adaptive_sphere_grid(depth_map, target_triangles, detail=DEFAULT_DETAIL):
+    """
+    Adaptive tessellation with about target_triangles triangles (never more, unless the minimum of
+    two pole fans around one ring already exceeds it). Returns float32 u and v per vertex and int32
+    (F, 3) faces. Each ring starts at u = 0 and ends with a duplicate vertex at u = 1, so the texture
+    seam has its own UVs; place vertices at seam_longitude(u) so the copies coincide. Pole vertices
+    are one per pole triangle, at the middle of its edge's u.
+    """
+    importance = depth_importance(depth_map, detail)
+
+    # Triangles grow with the square of the density scale; a few corrections settle it.
+    k = np.sqrt(max(target_triangles, 1) / 4.0)
+    for _ in range(8):
+        count = _triangle_count(_layout(importance, k)[2])
+        if abs(count - target_triangles) <= 0.005 * target_triangles:
+            break
+        k *= np.sqrt(target_triangles / count)
+    v, row_of, counts = _layout(importance, k)
+    while _triangle_count(counts) > target_triangles and k > 1e-3 and len(counts) > 1:
+        k *= 0.99
+        v, row_of, counts = _layout(importance, k)
+
+    ring_u = [_inverse_cdf(importance[row], n) for row, n in zip(row_of, counts)]
+    north_u = (ring_u[0][:-1] + ring_u[0][1:]) / 2
+    south_u = (ring_u[-1][:-1] + ring_u[-1][1:]) / 2
+
+    u_parts = [north_u] + ring_u + [south_u]
+    v_parts = ([np.zeros(len(north_u))] + [np.full(len(ru), vi) for ru, vi in zip(ring_u, v[1:-1])]
+               + [np.ones(len(south_u))])
+    starts = np.concatenate([[0], np.cumsum([len(p) for p in u_parts])])
+
+    faces = []
+    # North pole fan: (pole, next, current) as in the uniform grid's first band.
+    first = starts[1] + np.arange(len(north_u))
+    faces.append(np.stack([starts[0] + np.arange(len(north_u)), first + 1, first], axis=1))
+    for r in range(len(ring_u) - 1):
+        faces.append(_zip_rings(starts[r + 1], ring_u[r], starts[r + 2], ring_u[r + 1]))
+    # South pole fan: (current, next, pole).
+    last = starts[-3] + np.arange(len(south_u))
+    faces.append(np.stack([last, last + 1, starts[-2] + np.arange(len(south_u))], axis=1))
+
+    u = np.concatenate(u_parts).astype(np.float32)
+    v = np.concatenate(v_parts).astype(np.float32)
+    return u, v, np.concatenate(faces).astype(np.int32)
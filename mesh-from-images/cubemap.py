@@ -0,0 +1,113 @@
+"""
+Equirectangular <-> cubemap resampling for tiled depth inference.
+
+Directions use x right, y down, z forward; longitude 0 is the image centre column and latitude
++90 degrees the top row. Faces may be wider than 90 degrees (fov) so neighbouring faces overlap and
+can be blended. All maps are built with NumPy and sampled with cv2.remap.
+"""
+import cv2
+import numpy as np
+
+# (forward, right, down) of each face: front, right, back, left, up, down.
+FACE_AXES = np.array([
+    [[0, 0, 1], [1, 0, 0], [0, 1, 0]],
+    [[1, 0, 0], [0, 0, -1], [0, 1, 0]],
+    [[0, 0, -1], [-1, 0, 0], [0, 1, 0]],
+    [[-1, 0, 0], [0, 0, 1], [0, 1, 0]],
+    [[0, -1, 0], [1, 0, 0], [0, 0, 1]],
+    [[0, 1, 0], [1, 0, 0], [0, 0, -1]],
+], dtype=np.float32)
+
+def _half_extent(fov):
+    """Half width of a face's image plane at unit distance for a field of view in degrees."""
+    return np.float32(np.tan(np.radians(fov) / 2))
+
+def equirect_directions(width, height):
+    """Unit view directions (x, y, z) of every pixel centre of a width x height equirect, float32 H x W each."""
+    lon = ((np.arange(width, dtype=np.float32) + 0.5) / width - 0.5) * np.float32(2 * np.pi)
+    lat = (0.5 - (np.arange(height, dtype=np.float32) + 0.5) / height) * np.float32(np.pi)
+    cos_lat = np.cos(lat)[:, None]
+    x = cos_lat * np.sin(lon)[None, :]
+    y = np.broadcast_to(-np.sin(lat)[:, None], (height, width))
+    z = cos_lat * np.cos(lon)[None, :]
+    return x, y, z
+
+def face_equirect_maps(face, size, fov, width, height):
+    """
+    Equirect pixel coordinates (map_x, map_y) sampled by each pixel of a size x size face,
+    for an equirect of width x height.
+    """
+    forward, right, down = FACE_AXES[face]
+    t = _half_extent(fov)
+    a = ((np.arange(size, dtype=np.float32) + 0.5) / size * 2 - 1) * t
+    dx = forward[0] + a[None, :] * right[0] + a[:, None] * down[0]
+    dy = forward[1] + a[None, :] * right[1] + a[:, None] * down[1]
+    dz = forward[2] + a[None, :] * right[2] + a[:, None] * down[2]
+    lon = np.arctan2(dx, dz)
+    lat = np.arctan2(-dy, np.hypot(dx, dz))
+    map_x = (lon / np.float32(2 * np.pi) + 0.5) * width - 0.5
+    map_y = (0.5 - lat / np.float32(np.pi)) * height - 0.5
+    return map_x, map_y
+
+def sample_equirect(img, map_x, map_y):
+    """
+    cv2.remap of an equirect at float pixel coordinates, wrapping around in longitude and clamping
+    at the poles.
+    """
+    height, width = img.shape[:2]
+    # One extra wrapped column so bilinear samples between the last and first column work.
+    padded = np.concatenate([img, img[:, :1]], axis=1)
+    map_x = np.mod(map_x, width).astype(np.float32)
+    map_y = np.clip(map_y, 0, height - 1).astype(np.float32)
+    return cv2.remap(padded, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+def equirect_to_faces(img, size, fov=90.0):
+    """
+    Splits an equirect into six size x size perspective faces of the given field of view.
+    Returns (faces, maps), where maps[k] are face k's equirect sample coordinates.
+    """
+    height, width = img.shape[:2]
+    maps = [face_equirect_maps(face, size, fov, width, height) for face in range(len(FACE_AXES))]
+    faces = [sample_equirect(img, map_x, map_y) for map_x, map_y in maps]
+    return faces, maps
+
+def faces_to_equirect(faces, width, height, fov=90.0):
+    """
+    Stitches six single-channel faces (as made by equirect_to_faces) into a float32 width x height
+    equirect. Where faces overlap they are blended with weights falling linearly from 1 inside the
+    90 degree cube face to 0 at the face edge, so there are no hard seams.
+    """
+    size = faces[0].shape[0]
+    t = _half_extent(fov)
+    x, y, z = equirect_directions(width, height)
+    total = np.zeros((height, width), dtype=np.float32)
+    weight_sum = np.zeros((height, width), dtype=np.float32)
+    for face, values in enumerate(faces):
+        forward, right, down = FACE_AXES[face]
+        depth = x * forward[0] + y * forward[1] + z * forward[2]
+        ahead = depth > 1e-6
+        inv = np.divide(1.0, depth, out=np.zeros_like(depth), where=ahead)
+        a = (x * right[0] + y * right[1] + z * right[2]) * inv
+        b = (x * down[0] + y * down[1] + z * down[2]) * inv
+        extent = np.maximum(np.abs(a), np.abs(b))
+        if t > 1:
+            weight = np.clip((t - extent) / (t - 1), 0, 1)
+        else:
+            weight = (extent <= t).astype(np.float32)
+        weight[~ahead] = 0
+        map_x = (a / t + 1) * (size / 2) - 0.5
+        map_y = (b / t + 1) * (size / 2) - 0.5
+        sampled = cv2.remap(np.asarray(values, dtype=np.float32), map_x.astype(np.float32), map_y.astype(np.float32),
+                            cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        total += sampled * weight
+        weight_sum += weight
+    np.divide(total, weight_sum, out=total, where=weight_sum > 0)
+    return total
+
+def align_to_reference(values, reference):
+    """values mapped by the scale and offset that best fit them to reference (least squares)."""
+    v = np.asarray(values, dtype=np.float64).ravel()
+    r = np.asarray(reference, dtype=np.float64).ravel()
+    design = np.stack([v, np.ones_like(v)], axis=1)
+    (scale, offset), *_ = np.linalg.lstsq(design, r, rcond=None)
+    return (np.asarray(values, dtype=np.float32) * np.float32(scale) + np.float32(offset))
@@ -0,0 +1,357 @@
+"""
+MiDaS depth estimation shared by mesh-from-images.py and reprojection-from-image.py.
+
+DepthService loads the model and its input transform once, from the local torch hub cache, and
+reuses them for every image. Images are run through the model on the CPU in batches, and
+stream_depth_maps hands each depth map to the caller while the next batch is being inferred.
+With a DepthCache, depth maps of images seen before (same content, model and transform) are read
+from disk instead, so re-running a script with different mesh parameters skips inference.
+With cubemap tiling, each panorama is inferred as six overlapping perspective faces at the model's
+native input size and stitched back to an equirect (see cubemap.py).
+"""
+import hashlib
+import os
+import queue
+import threading
+import cv2
+import numpy as np
+import torch
+from cubemap import align_to_reference, equirect_to_faces, faces_to_equirect, sample_equirect
+
+MIDAS_REPO = "intel-isl/MiDaS"
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+# Transform (from the MiDaS hubconf "transforms" entry) matching each model; others use default_transform.
+MODEL_TRANSFORMS = {
+    "MiDaS_small": "small_transform",
+    "DPT_Large": "dpt_transform",
+    "DPT_Hybrid": "dpt_transform",
+}
+# Native input size of each model (the transform's target); others use 384.
+MODEL_INPUT_SIZES = {"MiDaS_small": 256}
+TILINGS = ("none", "cubemap")
+# Field of view of the cubemap faces in degrees; beyond 90 neighbouring faces overlap and are blended.
+CUBEMAP_FOV = 100.0
+DEPTH_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mesh-from-images", "depth")
+DEPTH_CACHE_MB = 2048
+# Bumped when the stored depth maps change meaning, so old entries are not reused.
+DEPTH_CACHE_VERSION = 1
+
+def list_images(inputs):
+    """
+    Expands image files and directories (their images, sorted, not recursive) into a list of image paths.
+    """
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            names = sorted(n for n in os.listdir(item) if n.lower().endswith(IMAGE_EXTENSIONS))
+            paths.extend(os.path.join(item, n) for n in names if os.path.isfile(os.path.join(item, n)))
+        elif os.path.isfile(item):
+            paths.append(item)
+        else:
+            raise FileNotFoundError(f"Image file not found: {item}")
+    return paths
+
+def batch_output_path(template, image_path, batch, suffix="", ext=None):
+    """
+    Output file for one image: template itself for a single image, else a file in template's folder
+    named after the image (plus suffix), with template's extension unless ext is given.
+    """
+    if not batch:
+        return template
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    ext = ext if ext is not None else os.path.splitext(template)[1]
+    return os.path.join(os.path.dirname(template), stem + suffix + ext)
+
+def read_image(image_path):
+    """Loads an image as an RGB array."""
+    img = cv2.imread(image_path)
+    if img is None:
+        raise FileNotFoundError(f"Could not read image: {image_path}")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+def normalize_depth(depth_map):
+    """Normalize the depth map to [0, 1]"""
+    return (depth_map - depth_map.min()) / (depth_map.max() - depth_map.min())
+
+def local_repo_dir():
+    """The MiDaS checkout in the torch hub cache, or None if it has not been downloaded."""
+    owner, name = MIDAS_REPO.split("/")
+    for ref in ("master", "main"):
+        path = os.path.join(torch.hub.get_dir(), f"{owner}_{name}_{ref}")
+        if os.path.isfile(os.path.join(path, "hubconf.py")):
+            return path
+    return None
+
+def file_digest(path, chunk_size=1 << 20):
+    """SHA-1 of a file's content."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class DepthCache:
+    """
+    Depth maps on disk, one float16 .npy file per (image content, model, transform), read back as
+    read-only memory maps. Reading an entry marks it as recently used; after each write the least
+    recently used entries are deleted until the folder holds at most max_bytes.
+    """
+
+    def __init__(self, folder=DEPTH_CACHE_DIR, max_bytes=DEPTH_CACHE_MB * 1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, image_path, model_type, depth_method):
+        """Cache key of an image's depth map: its content hash plus the model and transform (and tiling)."""
+        text = f"{DEPTH_CACHE_VERSION}|{file_digest(image_path)}|{model_type}|{depth_method}"
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + ".npy")
+
+    def get(self, key):
+        """The cached float16 depth map as a read-only memory map, or None."""
+        path = self._path(key)
+        try:
+            depth_map = np.load(path, mmap_mode="r")
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return depth_map
+
+    def put(self, key, depth_map):
+        """Stores a depth map as float16 and returns the stored (float16) array."""
+        depth_map = np.asarray(depth_map, dtype=np.float16)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, depth_map)
+        os.replace(tmp_path, path)
+        self.evict()
+        return depth_map
+
+    def evict(self):
+        """Deletes least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(".npy"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Already removed by another process, or still mapped (Windows).
+                continue
+            total -= size
+
+class DepthService:
+    """
+    A loaded MiDaS model. threads sets torch.set_num_threads for CPU inference; batch_size is the
+    number of images run through the model at once (images are batched only while their transformed
+    inputs have the same size, as equirects of one resolution do). hub_dir overrides the torch hub
+    cache folder. With a DepthCache, cached depth maps are returned without running the model.
+    tiling="cubemap" infers each image as six face_size faces (default: the model's native size)
+    with a tile_fov degree field of view, instead of one downsampled panorama.
+    The model code and weights are loaded from the hub cache without network access, on the first
+    image that is not in the depth cache. If they are not cached yet, FileNotFoundError is raised
+    unless allow_download is set, in which case they are downloaded once into the cache.
+    """
+
+    def __init__(self, model_type="MiDaS_small", threads=None, batch_size=4, hub_dir=None, allow_download=False,
+                 cache=None, tiling=None, face_size=None, tile_fov=CUBEMAP_FOV):
+        if threads:
+            torch.set_num_threads(int(threads))
+        if hub_dir:
+            torch.hub.set_dir(hub_dir)
+        self.model_type = model_type
+        self.transform_name = MODEL_TRANSFORMS.get(model_type, "default_transform")
+        self.tiling = None if tiling in (None, "none") else tiling
+        if self.tiling not in (None, "cubemap"):
+            raise ValueError(f"Unknown tiling '{tiling}' (expected one of {', '.join(TILINGS)}).")
+        self.face_size = int(face_size or MODEL_INPUT_SIZES.get(model_type, 384))
+        self.tile_fov = float(tile_fov)
+        # Identifies how depth is produced from the image, for the cache key.
+        self.depth_method = self.transform_name
+        if self.tiling:
+            self.depth_method += f"+{self.tiling}{self.face_size}@{self.tile_fov:g}"
+        self.batch_size = max(1, int(batch_size))
+        self.allow_download = allow_download
+        self.cache = cache
+        self.model = None
+        self.transform = None
+
+    def _load_model(self):
+        if self.model is not None:
+            return
+        repo = local_repo_dir()
+        if repo is not None:
+            model = torch.hub.load(repo, self.model_type, source="local")
+            transforms = torch.hub.load(repo, "transforms", source="local")
+        elif self.allow_download:
+            model = torch.hub.load(MIDAS_REPO, self.model_type)
+            transforms = torch.hub.load(MIDAS_REPO, "transforms")
+        else:
+            raise FileNotFoundError(
+                f"MiDaS is not in the torch hub cache ({torch.hub.get_dir()}). "
+                "Run once with --allow_download to fetch it; later runs load it offline.")
+        model.eval()
+        self.transform = getattr(transforms, self.transform_name)
+        self.model = model
+
+    def _predict(self, batch):
+        """Runs the model on a batch of (path, image, input, cache key) and returns their normalized depth maps."""
+        depth_maps = []
+        with torch.no_grad():
+            prediction = self.model(torch.cat([inp for _, _, inp, _ in batch]))
+            for k, (_, img, _, _) in enumerate(batch):
+                resized = torch.nn.functional.interpolate(
+                    prediction[k:k + 1].unsqueeze(1),
+                    size=img.shape[:2],
+                    mode="bicubic",
+                    align_corners=False,
+                ).squeeze()
+                depth_maps.append(normalize_depth(resized.cpu().numpy()))
+        return depth_maps
+
+    def _predict_cubemap(self, img):
+        """
+        Depth of one equirect from six overlapping cubemap faces, inferred in one batch. MiDaS depth is
+        only known up to scale and offset per inference, so each face is fitted to a prediction of the
+        whole panorama before the faces are stitched back to an equirect and resized to the image.
+        """
+        height, width = img.shape[:2]
+        size = self.face_size
+        faces, maps = equirect_to_faces(img, size, self.tile_fov)
+        with torch.no_grad():
+            whole = self.model(self.transform(img))[0].cpu().numpy()
+            predictions = self.model(torch.cat([self.transform(face) for face in faces])).cpu().numpy()
+        scale_x = whole.shape[1] / width
+        scale_y = whole.shape[0] / height
+        aligned = []
+        for prediction, (map_x, map_y) in zip(predictions, maps):
+            if prediction.shape != (size, size):
+                prediction = cv2.resize(prediction, (size, size), interpolation=cv2.INTER_CUBIC)
+            reference = sample_equirect(whole, (map_x + 0.5) * scale_x - 0.5, (map_y + 0.5) * scale_y - 0.5)
+            aligned.append(align_to_reference(prediction, reference))
+        # Stitch at about the faces' resolution, then resize like the untiled prediction.
+        stitched = faces_to_equirect(aligned, min(width, 4 * size), min(height, 2 * size), self.tile_fov)
+        depth_map = cv2.resize(stitched, (width, height), interpolation=cv2.INTER_CUBIC)
+        return normalize_depth(depth_map)
+
+    def iter_depth_maps(self, images):
+        """
+        Yields (path, depth_map) for each image (a path, directory or list of them, see list_images),
+        in order. Depth maps are float32, normalized between 0 and 1. With a cache they are rounded
+        to float16 whether or not they came from the cache, so cached and fresh runs give the same meshes.
+        """
+        batch = []
+        for path in list_images(images):
+            key = self.cache.key(path, self.model_type, self.depth_method) if self.cache else None
+            cached = self.cache.get(key) if key else None
+            if cached is not None:
+                # Finish the pending batch first so depth maps come out in input order.
+                if batch:
+                    yield from self._finish(batch)
+                    batch = []
+                yield path, cached.astype(np.float32)
+                continue
+            self._load_model()
+            img = read_image(path)
+            if self.tiling:
+                # The six faces of one image are the batch.
+                yield path, self._store(key, self._predict_cubemap(img))
+                continue
+            inp = self.transform(img)
+            if batch and (len(batch) == self.batch_size or inp.shape != batch[0][2].shape):
+                yield from self._finish(batch)
+                batch = []
+            batch.append((path, img, inp, key))
+        if batch:
+            yield from self._finish(batch)
+
+    def _finish(self, batch):
+        """Predicts a batch and yields (path, depth_map) for it, storing the depth maps in the cache."""
+        for (path, _, _, key), depth_map in zip(batch, self._predict(batch)):
+            yield path, self._store(key, depth_map)
+
+    def _store(self, key, depth_map):
+        """Puts a depth map in the cache (if any) and returns it as the cache will return it."""
+        if key:
+            depth_map = self.cache.put(key, depth_map).astype(np.float32)
+        return depth_map
+
+    def stream_depth_maps(self, images, prefetch=1):
+        """
+        iter_depth_maps run in a background thread: while the caller builds and writes the mesh for one
+        depth map, the next batch is already being read and inferred. At most prefetch batches of
+        finished depth maps wait for the caller. Errors are raised in the caller.
+        """
+        results = queue.Queue(maxsize=max(1, int(prefetch)) * self.batch_size)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for item in self.iter_depth_maps(images):
+                    if not put(item):
+                        return
+                put(done)
+            except BaseException as e:
+                put(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = results.get()
+                if item is done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Also reached when the caller stops early: unblock and finish the producer.
+            stop.set()
+            thread.join()
+
+    def depth_map(self, image_path):
+        """The normalized depth map of a single image."""
+        return next(self.iter_depth_maps([image_path]))[1]
+
+def add_depth_arguments(parser):
+    """Adds the DepthService options to a script's argument parser."""
+    parser.add_argument("--model", type=str, default="MiDaS_small", help="MiDaS model type (e.g. MiDaS_small, DPT_Hybrid, DPT_Large)")
+    parser.add_argument("--threads", type=int, default=None, help="CPU threads for depth inference (torch.set_num_threads; default: torch's choice)")
+    parser.add_argument("--batch_size", type=int, default=4, help="Images run through the depth model at once")
+    parser.add_argument("--hub_dir", type=str, default=None, help="Torch hub cache folder holding the MiDaS code and weights")
+    parser.add_argument("--allow_download", action="store_true", help="Download MiDaS into the hub cache if it is not there yet (later runs work offline)")
+    parser.add_argument("--tiling", type=str, choices=TILINGS, default="none", help="Infer depth on the whole panorama, or on six overlapping cubemap faces at the model's native size (more detail)")
+    parser.add_argument("--face_size", type=int, default=None, help="Cubemap face size in pixels (default: the model's native input size)")
+    parser.add_argument("--tile_fov", type=float, default=CUBEMAP_FOV, help="Cubemap face field of view in degrees; over 90 the faces overlap and are blended")
+    parser.add_argument("--depth_cache", type=str, default=DEPTH_CACHE_DIR, help="Folder caching depth maps by image content, model and transform")
+    parser.add_argument("--depth_cache_mb", type=int, default=DEPTH_CACHE_MB, help="Depth cache size limit in MB, least recently used maps are dropped first (0 disables the cache)")
+
+def depth_service_from_args(args):
+    cache = DepthCache(args.depth_cache, args.depth_cache_mb * 1024 * 1024) if args.depth_cache_mb > 0 else None
+    return DepthService(args.model, args.threads, args.batch_size, args.hub_dir, args.allow_download, cache,
+                        args.tiling, args.face_size, args.tile_fov)
@@ -1,204 +1,317 @@
 import argparse
+import itertools
+import json
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
-import torch
+from adaptive_mesh import DEFAULT_DETAIL, adaptive_sphere_grid, seam_longitude
+from depth_service import (DepthService, add_depth_arguments, batch_output_path, depth_service_from_args,
+                           list_images)
+from mesh_grid import grid_faces, sample_depth, sample_depth_grid
+from mesh_writers import MESH_FORMATS, mesh_format, save_mesh
 
-def get_depth_map(image_path):
+# 180° rotation about the X-axis, applied to every mesh before it is saved.
+X_ROTATION = np.array([[1, 0, 0],
+                       [0, -1, 0],
+                       [0, 0, -1]], dtype=np.float32)
+
+def get_depth_map(image_path, service=None):
     """
     Load an equirectangular image and compute a depth map using MiDaS.
     The resulting depth map is normalized between 0 and 1.
+    Pass a DepthService to reuse its loaded model; otherwise one is loaded for this call.
     """
-    img = cv2.imread(image_path)
-    if img is None:
-        raise FileNotFoundError(f"Could not read image: {image_path}")
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    
-    model = torch.hub.load("intel-isl/MiDaS", "MiDaS_small")
-    model.eval()
-    
-    transform = torch.hub.load("intel-isl/MiDaS", "transforms").small_transform
-    input_batch = transform(img)
-    
-    with torch.no_grad():
-        prediction = model(input_batch)
-        prediction = torch.nn.functional.interpolate(
-            prediction.unsqueeze(1),
-            size=img.shape[:2],
-            mode="bicubic",
-            align_corners=False,
-        ).squeeze()
-    
-    depth_map = prediction.cpu().numpy()
-    depth_map = (depth_map - depth_map.min()) / (depth_map.max() - depth_map.min())
-    return depth_map
-
-def sample_depth(depth_map, u, v):
+    service = service or DepthService(allow_download=True)
+    return service.depth_map(image_path)
+
+class SphereGrid:
     """
-    Bilinearly interpolate the depth map at continuous coordinates (u, v) in [0,1].
+    Everything about a sphere mesh that does not depend on the displacement parameters: the depth
+    sampled at every vertex, the per-vertex trigonometric terms, UVs and faces. Building it once lets
+    displace() be called for many radius/strength/hole_threshold/pole_factor values cheaply.
+    depth and the trig terms broadcast to the vertex layout: rings x longitudes for the lat/lon grid,
+    one flat array for the adaptive tessellation.
     """
-    H, W = depth_map.shape
-    x = u * (W - 1)
-    y = v * (H - 1)
-    x0 = int(np.floor(x))
-    y0 = int(np.floor(y))
-    x1 = min(x0 + 1, W - 1)
-    y1 = min(y0 + 1, H - 1)
-    dx = x - x0
-    dy = y - y0
-    d00 = depth_map[y0, x0]
-    d10 = depth_map[y0, x1]
-    d01 = depth_map[y1, x0]
-    d11 = depth_map[y1, x1]
-    depth_val = (d00 * (1 - dx) * (1 - dy) +
-                 d10 * dx * (1 - dy) +
-                 d01 * (1 - dx) * dy +
-                 d11 * dx * dy)
-    return depth_val
+
+    def __init__(self, depth, pole_weight, sin_theta, cos_theta, cos_phi, sin_phi, uvs, faces):
+        self.depth = depth
+        self.pole_weight = pole_weight  # 1 - sin(theta), float64
+        self.sin_theta = sin_theta
+        self.cos_theta = cos_theta
+        self.cos_phi = cos_phi
+        self.sin_phi = sin_phi
+        self.uvs = uvs
+        self.faces = faces
+
+    @classmethod
+    def regular(cls, lat_steps, lon_steps, depth_map):
+        """
+        The UV sphere grid: N = (lat_steps + 1) * lon_steps vertices and F = 2 * lat_steps * lon_steps
+        faces, vertex i * lon_steps + j being latitude ring i, longitude j.
+        UVs are computed from spherical coordinates:
+          u = phi / (2*pi)
+          v = theta / pi (flipped vertically to match typical texture orientation)
+        """
+        # theta in [0, pi] per latitude ring, phi in [0, 2pi) per longitude.
+        theta = np.pi * np.arange(lat_steps + 1) / lat_steps
+        phi = 2 * np.pi * np.arange(lon_steps) / lon_steps
+        u = phi / (2 * np.pi)
+        v = theta / np.pi
+
+        # Use bilinear interpolation for an accurate depth sample.
+        d = sample_depth_grid(depth_map, u, v)
+
+        uvs = np.empty((lat_steps + 1, lon_steps, 2), dtype=np.float32)
+        uvs[..., 0] = u[None, :]
+        uvs[..., 1] = (1 - v)[:, None]
+
+        return cls(d, (1 - np.sin(theta))[:, None],
+                   np.sin(theta).astype(np.float32)[:, None], np.cos(theta).astype(np.float32)[:, None],
+                   np.cos(phi).astype(np.float32), np.sin(phi).astype(np.float32),
+                   uvs.reshape(-1, 2), grid_faces(lat_steps, lon_steps))
+
+    @classmethod
+    def adaptive(cls, target_triangles, depth_map, detail=DEFAULT_DETAIL):
+        """
+        An adaptive tessellation (see adaptive_mesh.py) of about target_triangles triangles: denser
+        where the depth map has edges, sparser on flat regions and towards the poles.
+        """
+        u, v, faces = adaptive_sphere_grid(depth_map, target_triangles, detail)
+        # Positions and depth wrap around at the seam; only the UVs keep u = 1.
+        seam_u = seam_longitude(u)
+        theta = np.pi * v.astype(np.float64)
+        phi = 2 * np.pi * seam_u.astype(np.float64)
+        d = sample_depth(np.asarray(depth_map, dtype=np.float32), seam_u, v).astype(np.float32)
+        return cls(d, 1 - np.sin(theta),
+                   np.sin(theta).astype(np.float32), np.cos(theta).astype(np.float32),
+                   np.cos(phi).astype(np.float32), np.sin(phi).astype(np.float32),
+                   np.stack([u, 1 - v], axis=1), faces)
+
+    @property
+    def vertex_count(self):
+        return self.depth.size
+
+    def displace(self, radius, displacement_strength, hole_threshold=0.8, pole_factor=1.0):
+        """
+        float32 (N, 3) vertices at radius, displaced along their direction by the sampled depth.
+        For vertices where the depth value is small (below the hole_threshold), the displacement is
+        subtracted (inward), creating a hole effect; otherwise it is added. A scaling factor based on
+        the polar angle is applied to enhance displacement near the poles.
+        """
+        d = self.depth
+        # Compute scaling based on the polar angle.
+        scaling = (1 + pole_factor * self.pole_weight).astype(np.float32)
+
+        # Invert displacement for small depth values: radius -/+ d * strength * scaling.
+        offset = d * np.float32(displacement_strength)
+        offset *= scaling
+        np.negative(offset, out=offset, where=d < hole_threshold)
+        displaced_radius = offset
+        displaced_radius += np.float32(radius)
+
+        # Standard spherical coordinates on the unit sphere, scaled by the displaced radius.
+        vertices = np.empty(d.shape + (3,), dtype=np.float32)
+        np.multiply(displaced_radius, self.sin_theta, out=vertices[..., 2])
+        np.multiply(vertices[..., 2], self.cos_phi, out=vertices[..., 0])
+        np.multiply(vertices[..., 2], self.sin_phi, out=vertices[..., 1])
+        np.multiply(displaced_radius, self.cos_theta, out=vertices[..., 2])
+        return vertices.reshape(-1, 3)
 
 def generate_sphere_mesh(radius, lat_steps, lon_steps, depth_map, displacement_strength, hole_threshold=0.8, pole_factor=1.0):
     """
-    Create a UV sphere mesh whose vertices are displaced based on a depth map.
-    For vertices where the depth value is small (below the hole_threshold),
-    the displacement is subtracted (inward), creating a hole effect.
-    For vertices with depth values equal to or above the threshold, the displacement is added.
-    
-    A scaling factor based on the polar angle is applied to enhance displacement near the poles.
-    Returns vertices, UV coordinates, and faces.
-    UVs are computed from spherical coordinates:
-      u = phi / (2*pi)
-      v = theta / pi (flipped vertically to match typical texture orientation)
+    Create a UV sphere mesh whose vertices are displaced based on a depth map (see SphereGrid.displace).
+    Returns vertices, UV coordinates, and faces as arrays: float32 (N, 3) vertices, float32 (N, 2)
+    UVs and int32 (F, 3) faces, where N = (lat_steps + 1) * lon_steps and F = 2 * lat_steps * lon_steps.
     """
-    vertices = []
-    uvs = []
-    grid = []
-    H, W = depth_map.shape
-
-    for i in range(lat_steps + 1):
-        row = []
-        theta = np.pi * i / lat_steps  # theta in [0, pi]
-        for j in range(lon_steps):
-            phi = 2 * np.pi * j / lon_steps  # phi in [0, 2pi]
-
-            # Standard spherical coordinates on unit sphere.
-            x = np.sin(theta) * np.cos(phi)
-            y = np.sin(theta) * np.sin(phi)
-            z = np.cos(theta)
-            
-            # Compute UV coordinates.
-            u = phi / (2 * np.pi)
-            v = theta / np.pi
-            uv = (u, 1 - v)
-            
-            # Use bilinear interpolation for an accurate depth sample.
-            d = sample_depth(depth_map, u, v)
-            
-            # Compute scaling based on the polar angle.
-            scaling = 1 + pole_factor * (1 - np.sin(theta))
-            
-            # Invert displacement for small depth values:
-            if d < hole_threshold:
-                displaced_radius = radius - d * displacement_strength * scaling
-            else:
-                displaced_radius = radius + d * displacement_strength * scaling
-
-            vertex = (displaced_radius * x,
-                      displaced_radius * y,
-                      displaced_radius * z)
-            index = len(vertices)
-            vertices.append(vertex)
-            uvs.append(uv)
-            row.append(index)
-        grid.append(row)
-
-    faces = []
-    for i in range(lat_steps):
-        for j in range(lon_steps):
-            j_next = (j + 1) % lon_steps
-            v00 = grid[i][j]
-            v01 = grid[i][j_next]
-            v10 = grid[i+1][j]
-            v11 = grid[i+1][j_next]
-            faces.append((v00, v01, v10))
-            faces.append((v01, v11, v10))
-    
-    return vertices, uvs, faces
-
-def save_obj(obj_filename, vertices, uvs, faces, mtl_filename=None):
+    grid = SphereGrid.regular(lat_steps, lon_steps, depth_map)
+    vertices = grid.displace(radius, displacement_strength, hole_threshold, pole_factor)
+    return vertices, grid.uvs, grid.faces
+
+def generate_sphere_mesh_adaptive(radius, target_triangles, depth_map, displacement_strength, hole_threshold=0.8, pole_factor=1.0, detail=DEFAULT_DETAIL):
     """
-    Save the mesh as an OBJ file with texture coordinates.
-    If an mtl_filename is provided, reference it in the OBJ file.
+    generate_sphere_mesh on an adaptive tessellation (see adaptive_mesh.py) of about target_triangles
+    triangles: denser where the depth map has edges, sparser on flat regions and towards the poles.
+    The displacement is the same as generate_sphere_mesh's; returns the same kinds of arrays.
     """
-    with open(obj_filename, 'w') as f:
-        if mtl_filename:
-            f.write(f"mtllib {os.path.basename(mtl_filename)}\n")
-            f.write("usemtl material_0\n")
-        for v in vertices:
-            f.write("v {:.6f} {:.6f} {:.6f}\n".format(v[0], v[1], v[2]))
-        for uv in uvs:
-            f.write("vt {:.6f} {:.6f}\n".format(uv[0], uv[1]))
-        for face in faces:
-            f.write("f {0}/{0} {1}/{1} {2}/{2}\n".format(face[0] + 1, face[1] + 1, face[2] + 1))
-
-def save_mtl(mtl_filename, texture_filename):
+    grid = SphereGrid.adaptive(target_triangles, depth_map, detail)
+    vertices = grid.displace(radius, displacement_strength, hole_threshold, pole_factor)
+    return vertices, grid.uvs, grid.faces
+
+def parse_values(text):
     """
-    Save an MTL file that references the texture image.
+    Values of a sweep argument: a number, a comma-separated list ("0.1,0.2,0.4") or an inclusive
+    range start:stop:count ("0.1:0.5:5").
     """
-    with open(mtl_filename, 'w') as f:
-        f.write("newmtl material_0\n")
-        f.write("Ka 1.000 1.000 1.000\n")
-        f.write("Kd 1.000 1.000 1.000\n")
-        f.write("Ks 0.000 0.000 0.000\n")
-        f.write("d 1.0\n")
-        f.write("illum 2\n")
-        f.write(f"map_Kd {os.path.basename(texture_filename)}\n")
+    try:
+        if ":" in text:
+            start, stop, count = text.split(":")
+            if int(count) < 1:
+                raise ValueError(text)
+            return [float(x) for x in np.linspace(float(start), float(stop), int(count))]
+        return [float(x) for x in text.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number, a comma-separated list or start:stop:count, got '{text}'")
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Generate a depth map from an equirectangular image, displace a sphere's vertices based on the depth map, and apply the image as a texture. For vertices with small depth values (below the threshold), the displacement is subtracted. Depth values are sampled using bilinear interpolation for improved accuracy."
-    )
-    parser.add_argument("image", type=str, help="Path to the equirectangular image file")
-    parser.add_argument("--output", type=str, default="displaced_sphere.obj", help="Output OBJ filename")
+def variant_output_path(output, strength, hole_threshold, pole_factor):
+    """output with the variant's parameters added to its name, e.g. sphere_s0.2_h0.8_p1.obj."""
+    stem, ext = os.path.splitext(output)
+    return f"{stem}_s{strength:g}_h{hole_threshold:g}_p{pole_factor:g}{ext}"
+
+def write_variant(grid, output, texture_filename, fmt, radius, strength, hole_threshold, pole_factor):
+    """Displaces grid with one parameter combination, saves it and returns its report entry."""
+    start = time.perf_counter()
+    vertices = grid.displace(radius, strength, hole_threshold, pole_factor) @ X_ROTATION.T
+    displaced = time.perf_counter()
+    files = save_mesh(output, vertices, grid.uvs, grid.faces, texture_filename, fmt)
+    written = time.perf_counter()
+    return {
+        "output": output,
+        "files": files,
+        "strength": strength,
+        "hole_threshold": hole_threshold,
+        "pole_factor": pole_factor,
+        "vertices": len(vertices),
+        "faces": len(grid.faces),
+        "hole_vertices": int(np.count_nonzero(grid.depth < hole_threshold)),
+        "bytes": sum(os.path.getsize(f) for f in files),
+        "displace_seconds": round(displaced - start, 4),
+        "write_seconds": round(written - displaced, 4),
+    }
+
+def add_mesh_arguments(parser):
+    """Adds the input, output and tessellation options shared by the default mode and sweep."""
+    parser.add_argument("image", type=str, nargs="+", help="Equirectangular image file(s), or folders of them")
+    parser.add_argument("--output", type=str, default="displaced_sphere.obj", help="Output mesh filename (.obj, .ply or .glb). With several images, each mesh is named after its image in this file's folder")
+    parser.add_argument("--format", type=str, choices=MESH_FORMATS, default=None, help="Mesh format to write (default: from the --output extension, else obj). PLY and GLB are binary; GLB embeds the texture")
     parser.add_argument("--radius", type=float, default=1.0, help="Base radius of the sphere")
     parser.add_argument("--lat_steps", type=int, default=100, help="Number of latitude steps")
     parser.add_argument("--lon_steps", type=int, default=200, help="Number of longitude steps")
-    parser.add_argument("--strength", type=float, default=0.2, help="Displacement strength factor")
-    parser.add_argument("--hole_threshold", type=float, default=0.8, help="Depth threshold (0 to 1) below which displacement is subtracted")
-    parser.add_argument("--pole_factor", type=float, default=1.0, help="Additional scaling factor for displacement at the poles (ceiling/floor)")
-    parser.add_argument("--depth_output", type=str, default=None, help="Optional filename to save the depth map image (e.g., depth_map.png)")
-    args = parser.parse_args()
+    parser.add_argument("--target_triangles", type=int, default=0, help="Use an adaptive, depth-aware tessellation with about this many triangles instead of the lat/lon grid (0 = grid)")
+    parser.add_argument("--detail", type=float, default=DEFAULT_DETAIL, help="How strongly the adaptive tessellation concentrates triangles on depth edges (0 = evenly spread)")
 
-    if not os.path.exists(args.image):
-        raise FileNotFoundError(f"Image file not found: {args.image}")
+def sweep(argv):
+    """
+    mesh-from-images.py sweep: writes one mesh per combination of the --strength, --hole_threshold
+    and --pole_factor values. The depth map and the grid (depth samples, trig terms, UVs, faces)
+    are computed once per image; the variants are displaced and written in parallel, and a JSON
+    report lists each variant's counts and timings.
+    """
+    parser = argparse.ArgumentParser(
+        prog="mesh-from-images.py sweep",
+        description="Generate one displaced sphere mesh per combination of displacement parameters, reusing the depth map and mesh grid. Each value argument takes a number, a comma-separated list or start:stop:count."
+    )
+    add_mesh_arguments(parser)
+    parser.add_argument("--strength", type=parse_values, default=[0.2], help="Displacement strength factor values")
+    parser.add_argument("--hole_threshold", type=parse_values, default=[0.8], help="Depth threshold values (0 to 1) below which displacement is subtracted")
+    parser.add_argument("--pole_factor", type=parse_values, default=[1.0], help="Pole scaling factor values")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Variants displaced and written at once")
+    parser.add_argument("--report", type=str, default=None, help="JSON report filename (default: <output>_sweep.json)")
+    add_depth_arguments(parser)
+    args = parser.parse_args(argv)
 
-    print("Generating depth map from image...")
-    depth_map = get_depth_map(args.image)
+    images = list_images(args.image)
+    if not images:
+        raise FileNotFoundError(f"No images found in: {', '.join(args.image)}")
+    batch = len(images) > 1
+    fmt = mesh_format(args.output, args.format)
+    combinations = list(itertools.product(args.strength, args.hole_threshold, args.pole_factor))
+    report_path = args.report or os.path.splitext(args.output)[0] + "_sweep.json"
 
-    if args.depth_output:
-        print(f"Saving depth map to {args.depth_output}...")
-        depth_img = (depth_map * 255).astype(np.uint8)
-        cv2.imwrite(args.depth_output, depth_img)
+    service = depth_service_from_args(args)
+    report = {"format": fmt, "radius": args.radius, "images": []}
+    print(f"Sweeping {len(combinations)} variant(s) over {len(images)} image(s)...")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        for n, (image_path, depth_map) in enumerate(service.stream_depth_maps(images), 1):
+            depth_seconds = time.perf_counter() - start
+            print(f"[{n}/{len(images)}] {image_path}")
+            grid_start = time.perf_counter()
+            if args.target_triangles > 0:
+                grid = SphereGrid.adaptive(args.target_triangles, depth_map, args.detail)
+            else:
+                grid = SphereGrid.regular(args.lat_steps, args.lon_steps, depth_map)
+            grid_seconds = time.perf_counter() - grid_start
 
-    print("Generating sphere mesh with improved depth detection...")
-    vertices, uvs, faces = generate_sphere_mesh(
-        args.radius, args.lat_steps, args.lon_steps,
-        depth_map, args.strength, args.hole_threshold, args.pole_factor
+            output = batch_output_path(args.output, image_path, batch, ext="." + fmt)
+            futures = [pool.submit(write_variant, grid, variant_output_path(output, *params), image_path, fmt,
+                                   args.radius, *params)
+                       for params in combinations]
+            variants = []
+            for future in futures:
+                variants.append(future.result())
+                print(f"  {variants[-1]['output']}")
+            report["images"].append({
+                "image": image_path,
+                "depth_seconds": round(depth_seconds, 4),
+                "grid_seconds": round(grid_seconds, 4),
+                "variants_seconds": round(time.perf_counter() - grid_start - grid_seconds, 4),
+                "variants": variants,
+            })
+            start = time.perf_counter()
+    if service.cache:
+        print(f"Depth cache: {service.cache.hits} hit(s), {service.cache.misses} miss(es).")
+
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Sweep report saved to {report_path}.")
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "sweep":
+        sweep(sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser(
+        description="Generate a depth map from an equirectangular image, displace a sphere's vertices based on the depth map, and apply the image as a texture. For vertices with small depth values (below the threshold), the displacement is subtracted. Depth values are sampled using bilinear interpolation for improved accuracy.",
+        epilog="To try several --strength/--hole_threshold/--pole_factor values at once, run: mesh-from-images.py sweep --help"
     )
+    add_mesh_arguments(parser)
+    parser.add_argument("--strength", type=float, default=0.2, help="Displacement strength factor")
+    parser.add_argument("--hole_threshold", type=float, default=0.8, help="Depth threshold (0 to 1) below which displacement is subtracted")
+    parser.add_argument("--pole_factor", type=float, default=1.0, help="Additional scaling factor for displacement at the poles (ceiling/floor)")
+    parser.add_argument("--depth_output", type=str, default=None, help="Optional filename to save the depth map image (e.g., depth_map.png). With several images, <image>_depth files are written to its folder")
+    add_depth_arguments(parser)
+    args = parser.parse_args()
+
+    images = list_images(args.image)
+    if not images:
+        raise FileNotFoundError(f"No images found in: {', '.join(args.image)}")
+    batch = len(images) > 1
+    fmt = mesh_format(args.output, args.format)
 
-    # Apply a 180° rotation about the X-axis using an explicit rotation matrix.
-    R = np.array([[1, 0, 0],
-                  [0, -1, 0],
-                  [0, 0, -1]])
-    vertices = [tuple(R @ np.array(v)) for v in vertices]
+    service = depth_service_from_args(args)
+    print(f"Generating depth maps for {len(images)} image(s)...")
+    for n, (image_path, depth_map) in enumerate(service.stream_depth_maps(images), 1):
+        if batch:
+            print(f"[{n}/{len(images)}] {image_path}")
+        if args.depth_output:
+            depth_output = batch_output_path(args.depth_output, image_path, batch, suffix="_depth")
+            print(f"Saving depth map to {depth_output}...")
+            depth_img = (depth_map * 255).astype(np.uint8)
+            cv2.imwrite(depth_output, depth_img)
 
-    obj_base, _ = os.path.splitext(args.output)
-    mtl_filename = obj_base + ".mtl"
+        if args.target_triangles > 0:
+            print(f"Generating adaptive sphere mesh (about {args.target_triangles} triangles)...")
+            vertices, uvs, faces = generate_sphere_mesh_adaptive(
+                args.radius, args.target_triangles,
+                depth_map, args.strength, args.hole_threshold, args.pole_factor, args.detail
+            )
+        else:
+            print("Generating sphere mesh with improved depth detection...")
+            vertices, uvs, faces = generate_sphere_mesh(
+                args.radius, args.lat_steps, args.lon_steps,
+                depth_map, args.strength, args.hole_threshold, args.pole_factor
+            )
 
-    print(f"Saving MTL file to {mtl_filename}...")
-    save_mtl(mtl_filename, args.image)
+        # Apply a 180° rotation about the X-axis using an explicit rotation matrix.
+        vertices = vertices @ X_ROTATION.T
 
-    print(f"Saving OBJ file to {args.output}...")
-    save_obj(args.output, vertices, uvs, faces, mtl_filename)
+        output = batch_output_path(args.output, image_path, batch, ext="." + fmt)
+        print(f"Saving {fmt.upper()} file to {output} (texture: {image_path})...")
+        save_mesh(output, vertices, uvs, faces, image_path, fmt)
+    if service.cache:
+        print(f"Depth cache: {service.cache.hits} hit(s), {service.cache.misses} miss(es).")
     print("Mesh generation complete.")
 
 if __name__ == '__main__':
@@ -0,0 +1,77 @@
+"""
+Depth sampling and grid topology shared by mesh-from-images.py and reprojection-from-image.py.
+"""
+import numpy as np
+
+def sample_depth(depth_map, u, v):
+    """
+    Bilinearly interpolate the depth map at continuous coordinates (u, v) in [0,1].
+    u and v may be scalars or arrays of the same shape.
+    """
+    H, W = depth_map.shape
+    x = np.asarray(u) * (W - 1)
+    y = np.asarray(v) * (H - 1)
+    x0 = np.floor(x).astype(np.intp)
+    y0 = np.floor(y).astype(np.intp)
+    x1 = np.minimum(x0 + 1, W - 1)
+    y1 = np.minimum(y0 + 1, H - 1)
+    dx = x - x0
+    dy = y - y0
+    d00 = depth_map[y0, x0]
+    d10 = depth_map[y0, x1]
+    d01 = depth_map[y1, x0]
+    d11 = depth_map[y1, x1]
+    depth_val = (d00 * (1 - dx) * (1 - dy) +
+                 d10 * dx * (1 - dy) +
+                 d01 * (1 - dx) * dy +
+                 d11 * dx * dy)
+    return depth_val
+
+def sample_depth_grid(depth_map, u, v):
+    """
+    Bilinearly interpolate the depth map on the grid of 1-D coordinate arrays u (columns) and
+    v (rows), both in [0,1]. Returns a float32 array of shape (len(v), len(u)).
+    The interpolation is done one axis at a time, so only two rows-by-columns temporaries are needed.
+    """
+    depth_map = np.asarray(depth_map, dtype=np.float32)
+    H, W = depth_map.shape
+    x = np.asarray(u, dtype=np.float64) * (W - 1)
+    y = np.asarray(v, dtype=np.float64) * (H - 1)
+    x0 = np.floor(x).astype(np.intp)
+    y0 = np.floor(y).astype(np.intp)
+    x1 = np.minimum(x0 + 1, W - 1)
+    y1 = np.minimum(y0 + 1, H - 1)
+    dx = (x - x0).astype(np.float32)
+    dy = (y - y0).astype(np.float32)[:, None]
+
+    # Interpolate along x on the two source rows of every grid row, then along y.
+    rows = depth_map[y0]
+    top = rows[:, x0] * (1 - dx)
+    top += rows[:, x1] * dx
+    rows = depth_map[y1]
+    bottom = rows[:, x0] * (1 - dx)
+    bottom += rows[:, x1] * dx
+    top *= 1 - dy
+    bottom *= dy
+    top += bottom
+    return top
+
+def grid_faces(lat_steps, lon_steps):
+    """
+    int32 (2 * lat_steps * lon_steps, 3) faces of a grid of lat_steps + 1 rings with lon_steps
+    vertices each, wrapping around in longitude: two triangles per quad, ring by ring.
+    """
+    ring = np.arange(lat_steps, dtype=np.int32)[:, None] * lon_steps
+    col = np.arange(lon_steps, dtype=np.int32)[None, :]
+    v00 = ring + col
+    v01 = ring + (col + 1) % lon_steps
+    v10 = v00 + lon_steps
+    v11 = v01 + lon_steps
+    faces = np.empty((lat_steps, lon_steps, 2, 3), dtype=np.int32)
+    faces[..., 0, 0] = v00
+    faces[..., 0, 1] = v01
+    faces[..., 0, 2] = v10
+    faces[..., 1, 0] = v01
+    faces[..., 1, 1] = v11
+    faces[..., 1, 2] = v10
+    return faces.reshape(-1, 3)
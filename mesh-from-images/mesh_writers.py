@@ -0,0 +1,201 @@
+"""
+Mesh writers shared by mesh-from-images.py and reprojection-from-image.py.
+
+Meshes are passed as NumPy arrays: float32 (N, 3) vertices, float32 (N, 2) UVs (v up, as in OBJ)
+and int32 (F, 3) zero-based faces, one UV per vertex. Every writer works on fixed-size chunks or
+straight from the array buffers, so multi-million-vertex meshes are written without per-vertex
+Python work or a full-size text or interleaved copy.
+"""
+import json
+import os
+import struct
+import numpy as np
+
+MESH_FORMATS = ("obj", "ply", "glb")
+# Rows formatted or interleaved per write.
+CHUNK_ROWS = 65536
+
+def mesh_format(filename, fmt=None):
+    """The format to write: fmt if given, else the filename's extension if it is a known format, else obj."""
+    if fmt:
+        fmt = fmt.lower()
+        if fmt not in MESH_FORMATS:
+            raise ValueError(f"Unknown mesh format '{fmt}' (expected one of {', '.join(MESH_FORMATS)}).")
+        return fmt
+    ext = os.path.splitext(filename)[1].lower().lstrip(".")
+    return ext if ext in MESH_FORMATS else "obj"
+
+# ---------------- OBJ ----------------
+
+def _write_rows(f, fmt, rows):
+    """Writes fmt % row for every row of a 2-D array, formatting CHUNK_ROWS rows per string operation."""
+    for start in range(0, len(rows), CHUNK_ROWS):
+        chunk = rows[start:start + CHUNK_ROWS]
+        f.write((fmt * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+def save_obj(obj_filename, vertices, uvs, faces, mtl_filename=None):
+    """
+    Save the mesh as an OBJ file with texture coordinates.
+    If an mtl_filename is provided, reference it in the OBJ file.
+    """
+    faces = np.asarray(faces)
+    with open(obj_filename, 'w') as f:
+        if mtl_filename:
+            f.write(f"mtllib {os.path.basename(mtl_filename)}\n")
+            f.write("usemtl material_0\n")
+        _write_rows(f, "v %.6f %.6f %.6f\n", np.asarray(vertices))
+        _write_rows(f, "vt %.6f %.6f\n", np.asarray(uvs))
+        # OBJ file indices are 1-indexed; each corner is written as vertex/uv.
+        for start in range(0, len(faces), CHUNK_ROWS):
+            corners = np.repeat(faces[start:start + CHUNK_ROWS].astype(np.int64) + 1, 2, axis=1)
+            _write_rows(f, "f %d/%d %d/%d %d/%d\n", corners)
+
+def save_mtl(mtl_filename, texture_filename):
+    """
+    Save an MTL file that references the texture image.
+    """
+    with open(mtl_filename, 'w') as f:
+        f.write("newmtl material_0\n")
+        f.write("Ka 1.000 1.000 1.000\n")
+        f.write("Kd 1.000 1.000 1.000\n")
+        f.write("Ks 0.000 0.000 0.000\n")
+        f.write("d 1.0\n")
+        f.write("illum 2\n")
+        f.write(f"map_Kd {os.path.basename(texture_filename)}\n")
+
+# ---------------- PLY ----------------
+
+PLY_FACE = np.dtype([("count", "u1"), ("indices", "<i4", (3,))])
+
+def save_ply(ply_filename, vertices, uvs, faces, texture_filename=None):
+    """
+    Save the mesh as a binary little-endian PLY with per-vertex texture coordinates (s, t).
+    The texture is referenced by a "TextureFile" comment, which MeshLab and Blender read.
+    """
+    vertices = np.asarray(vertices)
+    uvs = np.asarray(uvs)
+    faces = np.asarray(faces)
+    header = ["ply", "format binary_little_endian 1.0"]
+    if texture_filename:
+        header.append(f"comment TextureFile {os.path.basename(texture_filename)}")
+    header += [
+        f"element vertex {len(vertices)}",
+        "property float x", "property float y", "property float z",
+        "property float s", "property float t",
+        f"element face {len(faces)}",
+        "property list uchar int vertex_indices",
+        "end_header",
+    ]
+    with open(ply_filename, 'wb') as f:
+        f.write(("\n".join(header) + "\n").encode("ascii"))
+        rows = np.empty((min(CHUNK_ROWS, len(vertices)), 5), dtype="<f4")
+        for start in range(0, len(vertices), CHUNK_ROWS):
+            n = min(CHUNK_ROWS, len(vertices) - start)
+            rows[:n, :3] = vertices[start:start + n]
+            rows[:n, 3:] = uvs[start:start + n]
+            f.write(memoryview(rows[:n]))
+        records = np.empty(min(CHUNK_ROWS, len(faces)), dtype=PLY_FACE)
+        records["count"] = 3
+        for start in range(0, len(faces), CHUNK_ROWS):
+            n = min(CHUNK_ROWS, len(faces) - start)
+            records["indices"][:n] = faces[start:start + n]
+            f.write(memoryview(records[:n]))
+
+# ---------------- GLB ----------------
+
+GLB_MAGIC = 0x46546C67  # "glTF"
+GLB_JSON = 0x4E4F534A   # "JSON"
+GLB_BIN = 0x004E4942    # "BIN\0"
+TEXTURE_MIME_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg"}
+
+def _pad4(n):
+    return (4 - n % 4) % 4
+
+def save_glb(glb_filename, vertices, uvs, faces, texture_filename=None):
+    """
+    Save the mesh as a binary glTF 2.0 (GLB) file: one mesh with positions, texture coordinates
+    and uint32 indices, and, if texture_filename is given, that PNG or JPEG embedded as the base
+    colour texture so the file is self-contained. Positions keep the same axes as the OBJ output.
+    """
+    vertices = np.ascontiguousarray(vertices, dtype="<f4")
+    # glTF puts the texture origin at the top left, OBJ at the bottom left.
+    texcoords = np.empty((len(uvs), 2), dtype="<f4")
+    texcoords[:, 0] = np.asarray(uvs)[:, 0]
+    np.subtract(1.0, np.asarray(uvs)[:, 1], out=texcoords[:, 1])
+    indices = np.ascontiguousarray(faces, dtype="<u4")
+    image = None
+    if texture_filename:
+        mime_type = TEXTURE_MIME_TYPES.get(os.path.splitext(texture_filename)[1].lower())
+        if mime_type is None:
+            raise ValueError(f"GLB textures must be PNG or JPEG files: {texture_filename}")
+        with open(texture_filename, 'rb') as f:
+            image = f.read()
+
+    # Lay the binary buffer out as positions, texture coordinates, indices and image, each 4-byte aligned.
+    blobs = [memoryview(vertices).cast("B"), memoryview(texcoords).cast("B"), memoryview(indices).cast("B")]
+    if image is not None:
+        blobs.append(memoryview(image))
+    views, offset = [], 0
+    for blob in blobs:
+        views.append({"buffer": 0, "byteOffset": offset, "byteLength": blob.nbytes})
+        offset += blob.nbytes + _pad4(blob.nbytes)
+    bin_length = offset
+    views[0]["target"] = views[1]["target"] = 34962  # ARRAY_BUFFER
+    views[2]["target"] = 34963                       # ELEMENT_ARRAY_BUFFER
+
+    has_vertices = len(vertices) > 0
+    gltf = {
+        "asset": {"version": "2.0", "generator": "mesh-from-images"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [{"primitives": [{"attributes": {"POSITION": 0, "TEXCOORD_0": 1}, "indices": 2, "material": 0}]}],
+        "materials": [{"pbrMetallicRoughness": {"metallicFactor": 0.0, "roughnessFactor": 1.0}, "doubleSided": True}],
+        "buffers": [{"byteLength": bin_length}],
+        "bufferViews": views,
+        "accessors": [
+            {"bufferView": 0, "componentType": 5126, "count": len(vertices), "type": "VEC3",
+             "min": vertices.min(axis=0).tolist() if has_vertices else [0.0, 0.0, 0.0],
+             "max": vertices.max(axis=0).tolist() if has_vertices else [0.0, 0.0, 0.0]},
+            {"bufferView": 1, "componentType": 5126, "count": len(texcoords), "type": "VEC2"},
+            {"bufferView": 2, "componentType": 5125, "count": indices.size, "type": "SCALAR"},
+        ],
+    }
+    if image is not None:
+        gltf["images"] = [{"bufferView": 3, "mimeType": mime_type}]
+        gltf["samplers"] = [{"magFilter": 9729, "minFilter": 9987, "wrapS": 10497, "wrapT": 33071}]
+        gltf["textures"] = [{"source": 0, "sampler": 0}]
+        gltf["materials"][0]["pbrMetallicRoughness"]["baseColorTexture"] = {"index": 0}
+
+    json_bytes = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+    json_bytes += b" " * _pad4(len(json_bytes))
+    total = 12 + 8 + len(json_bytes) + 8 + bin_length
+    if total >= 2 ** 32:
+        raise ValueError("Mesh is too large for a single GLB file (4 GB limit); write PLY or OBJ instead.")
+    with open(glb_filename, 'wb') as f:
+        f.write(struct.pack("<III", GLB_MAGIC, 2, total))
+        f.write(struct.pack("<II", len(json_bytes), GLB_JSON))
+        f.write(json_bytes)
+        f.write(struct.pack("<II", bin_length, GLB_BIN))
+        for blob in blobs:
+            f.write(blob)
+            f.write(b"\0" * _pad4(blob.nbytes))
+
+def save_mesh(filename, vertices, uvs, faces, texture_filename=None, fmt=None):
+    """
+    Writes the mesh in the format given by fmt or the filename's extension (see mesh_format).
+    OBJ output also gets an MTL file next to it when a texture is given. Returns the files written.
+    """
+    fmt = mesh_format(filename, fmt)
+    if fmt == "ply":
+        save_ply(filename, vertices, uvs, faces, texture_filename)
+        return [filename]
+    if fmt == "glb":
+        save_glb(filename, vertices, uvs, faces, texture_filename)
+        return [filename]
+    mtl_filename = None
+    if texture_filename:
+        mtl_filename = os.path.splitext(filename)[0] + ".mtl"
+        save_mtl(mtl_filename, texture_filename)
+    save_obj(filename, vertices, uvs, faces, mtl_filename)
+    return [mtl_filename, filename] if mtl_filename else [filename]